@@ -12,14 +12,14 @@ import {
 } from './gateway';
 import { ClientProfile, KeysProfile } from './gatewayOptions';
 import { getReasonPhrase, StatusCodes } from 'http-status-codes';
-import { CheckpointNotFoundError, handleError } from './errors';
-import { RequestArgs } from './interface';
+import { CheckpointExistsError, CheckpointNotFoundError, handleError } from './errors';
+import { BatchRequestArgs, RequestArgs } from './interface';
 
 const main = async () => {
     const router = express();
     router.use(express.json());
 
-    const { OK, ACCEPTED, BAD_REQUEST, INTERNAL_SERVER_ERROR, NOT_FOUND } = StatusCodes;
+    const { OK, ACCEPTED, BAD_REQUEST, CONFLICT, INTERNAL_SERVER_ERROR, NOT_FOUND } = StatusCodes;
 
     router.post('/transactions/checkpoint/create', async (req: Request, resp: Response) => {
         try {
@@ -70,6 +70,19 @@ const main = async () => {
                 });
             }
 
+            // Lets clients tell a retried transaction that was already committed from a failure
+            if (parsedErr instanceof CheckpointExistsError) {
+                return resp.status(CONFLICT).json({
+                    status: {
+                        code: CONFLICT,
+                        message: getReasonPhrase(CONFLICT),
+                    },
+                    reason: `${err.name}: ${err.message}`,
+                    details: err?.details || 'none',
+                    timestamp: new Date().toISOString(),
+                });
+            }
+
             if (String(err.message).includes('Conversion')) {
                 return resp.status(BAD_REQUEST).json({
                     status: {
@@ -94,6 +107,64 @@ const main = async () => {
         }
     });
 
+    router.post('/transactions/checkpoint/createBatch', async (req: Request, resp: Response) => {
+        const created: string[] = [];
+        try {
+            const { channelName, chaincodeName, contractName, clientName, checkpoints } = req.body as BatchRequestArgs;
+            console.log(`Creating ${checkpoints.length} checkpoints from client ${clientName}`);
+
+            // One gateway connection for the whole batch, checkpoints are submitted in order
+            const { gateway, network, contract } = await setupConnection(
+                clientName,
+                channelName,
+                chaincodeName,
+                contractName
+            );
+            isConnected(gateway, network, contract);
+            console.log('Gateway connection is setup.');
+            for (const checkpointData of checkpoints) {
+                await createCheckpoint(
+                    contract,
+                    checkpointData.id,
+                    checkpointData.hash,
+                    checkpointData.url,
+                    checkpointData.algorithm,
+                    checkpointData.cAccuracy,
+                    checkpointData.loss,
+                    checkpointData.round,
+                    checkpointData.fedSession
+                );
+                created.push(checkpointData.id);
+            }
+            return resp.status(ACCEPTED).json({
+                status: {
+                    code: ACCEPTED,
+                    message: getReasonPhrase(ACCEPTED),
+                },
+                result: created.map((id) => `Model ${id} created at ${contractName}`),
+                timestamp: new Date().toISOString(),
+            });
+        } catch (err) {
+            console.error(err);
+            const parsedErr = handleError(err);
+            let status: StatusCodes = INTERNAL_SERVER_ERROR;
+            if (parsedErr instanceof CheckpointNotFoundError) {
+                status = BAD_REQUEST;
+            } else if (parsedErr instanceof CheckpointExistsError) {
+                status = CONFLICT;
+            }
+            return resp.status(status).json({
+                status: {
+                    code: status,
+                    message: getReasonPhrase(status),
+                },
+                reason: `${err.name}: ${err.message} (created ${created.length} checkpoints before the failure: ${created.join(', ') || 'none'})`,
+                details: err?.details || 'none',
+                timestamp: new Date().toISOString(),
+            });
+        }
+    });
+
     router.get('/query/checkpoint/:cpID', async (req: Request, resp: Response) => {
         const cpID = req.params.cpID;
         const channelName = req.query.chn as string;
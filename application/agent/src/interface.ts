@@ -29,4 +29,16 @@ export interface RequestArgs {
     clientName: string;
 
     checkpointData: CheckpointArgs;
-}
\ No newline at end of file
+}
+
+export interface BatchRequestArgs {
+    channelName: string;
+
+    chaincodeName: string;
+
+    contractName: string;
+
+    clientName: string;
+
+    checkpoints: CheckpointArgs[];
+}
@@ -0,0 +1,235 @@
+"""End-to-end benchmark of federated sessions against local stand-ins for IPFS and the Fabric gateway.
+
+Runs a ``BFLServer`` with N in-process ``BFLClient``s on synthetic data shaped like the preprocessed UNSW-NB15
+dataset, for every combination of client count and model size, and reports rounds per second, bytes moved, peak
+RSS and the mean latency of every phase recorded by ``utils.profiler``. No Fabric network, IPFS daemon or dataset is
+needed. Run from the fed-learn directory:
+
+    python -m benchmarks.e2e --clients 2 4 8 --units 16 30 64 --rounds 3 --output e2e.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import psutil
+
+from benchmarks.fakes import FakeGateway, FakeIPFS
+from benchmarks.synthetic import synthetic_data
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[2, 4], help="Client counts to benchmark")
+    parser.add_argument("--units", type=int, nargs="+", default=[30], help="LSTM units of the model sizes to benchmark")
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds per session")
+    parser.add_argument("--epochs", type=int, default=1, help="Local epochs per round")
+    parser.add_argument("--rows", type=int, default=2000, help="Training rows per client, a quarter more for testing")
+    parser.add_argument("--ipfs-latency", type=float, default=0.0, help="Seconds added to every IPFS operation")
+    parser.add_argument("--gateway-latency", type=float, default=0.0, help="Seconds added to every gateway request")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+class PeakRSS:
+    """Poll the resident set size of the process on a background thread and keep its peak."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> 'PeakRSS':
+        self.peak = self._process.memory_info().rss
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def make_proxy_class():
+    """Build the in-process client proxy once flwr can be imported."""
+    from flwr.common import DisconnectRes
+    from flwr.server.client_proxy import ClientProxy
+
+    class LocalClientProxy(ClientProxy):
+        """Proxy calling a client of the same process, counting the bytes of the parameters it carries."""
+
+        def __init__(self, cid: str, client):
+            super().__init__(cid)
+            self.client = client
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+        def get_properties(self, ins, timeout: Optional[float]):
+            return self.client.get_properties(ins)
+
+        def get_parameters(self, ins, timeout: Optional[float]):
+            res = self.client.get_parameters(ins)
+            self.bytes_received += sum(len(tensor) for tensor in res.parameters.tensors)
+            return res
+
+        def fit(self, ins, timeout: Optional[float]):
+            self.bytes_sent += sum(len(tensor) for tensor in ins.parameters.tensors)
+            res = self.client.fit(ins)
+            self.bytes_received += sum(len(tensor) for tensor in res.parameters.tensors)
+            return res
+
+        def evaluate(self, ins, timeout: Optional[float]):
+            self.bytes_sent += sum(len(tensor) for tensor in ins.parameters.tensors)
+            return self.client.evaluate(ins)
+
+        def reconnect(self, ins, timeout: Optional[float]):
+            return DisconnectRes(reason="")
+
+    return LocalClientProxy
+
+
+def phase_latencies(spans: List[dict]) -> Dict[str, Dict[str, float]]:
+    """Number of spans and mean duration in milliseconds of every phase."""
+    durations: Dict[str, List[float]] = {}
+    for span in spans:
+        durations.setdefault(span["name"], []).append(span["duration"])
+    return {
+        name: {"count": len(values), "mean_ms": 1000 * float(np.mean(values))}
+        for name, values in sorted(durations.items())
+    }
+
+
+def run_session(args: argparse.Namespace, num_clients: int, units: int, ipfs: FakeIPFS, gateway: FakeGateway,
+                workdir: str) -> dict:
+    """Run one federated session and measure it."""
+    from flwr.client.app import to_client
+    import models.net as net
+    from bflcm import BFLClientManager
+    from client import BFLClient
+    from server import BFLServer, evaluate_config_fn
+    from strategy.BFedAvg import BFedAvg
+    from strategy.metrics import MetricsAggregator
+    from utils.profiler import profiler
+
+    LocalClientProxy = make_proxy_class()
+    profiler.clear()
+    gateway.reset()
+    ipfs.bytes_added = ipfs.bytes_read = 0
+
+    with PeakRSS() as rss:
+        proxies = []
+        clients = []
+        for i in range(1, num_clients + 1):
+            x_train, y_train = synthetic_data(args.rows, args.seed + i)
+            x_test, y_test = synthetic_data(args.rows // 4, args.seed + 1000 + i)
+            client = BFLClient(str(i), net.get_model(units), x_train, y_train, x_test, y_test, ipfs_client=ipfs)
+            clients.append(client)
+            proxies.append(LocalClientProxy(str(i), to_client(client)))
+
+        strategy = BFedAvg(
+            min_fit_clients=num_clients,
+            min_evaluate_clients=num_clients,
+            min_available_clients=num_clients,
+            on_fit_config_fn=lambda server_round, fed_session: {
+                'server_round': server_round, 'fed_session': fed_session, 'epoch': args.epochs
+            },
+            on_evaluate_config_fn=evaluate_config_fn,
+            evaluate_metrics_aggregation_fn=MetricsAggregator(),
+            fit_metrics_aggregation_fn=MetricsAggregator(),
+        )
+        server = BFLServer('1', "BiLSTM", workdir, ipfs_client=ipfs, strategy=strategy,
+                           client_manager=BFLClientManager())
+        server.model = net.get_model(units)
+        for proxy in proxies:
+            server.client_manager().register(proxy)
+
+        start = time.perf_counter()
+        server.fit(num_rounds=args.rounds, timeout=None)
+        elapsed = time.perf_counter() - start
+        # Local models still being published are part of the session
+        for client in clients:
+            client.terminate()
+
+    return {
+        "clients": num_clients,
+        "units": units,
+        "parameters": int(sum(weights.size for weights in server.model.get_weights())),
+        "rounds": args.rounds,
+        "seconds": elapsed,
+        "rounds_per_sec": args.rounds / elapsed,
+        "bytes": {
+            "ipfs_added": ipfs.bytes_added,
+            "ipfs_read": ipfs.bytes_read,
+            "gateway": gateway.bytes_received,
+            "to_clients": sum(proxy.bytes_sent for proxy in proxies),
+            "from_clients": sum(proxy.bytes_received for proxy in proxies),
+        },
+        "gateway_requests": gateway.requests,
+        "peak_rss_mb": rss.peak / 2**20,
+        "phases": phase_latencies(profiler.spans()),
+    }
+
+
+def print_result(result: dict):
+    moved = result["bytes"]
+    print(
+        f"clients={result['clients']:<4} units={result['units']:<4} params={result['parameters']:<8} "
+        f"rounds/s={result['rounds_per_sec']:.3f} ipfs={moved['ipfs_added'] / 2**20:.1f}MB "
+        f"gateway={moved['gateway'] / 2**10:.1f}KB "
+        f"transport={(moved['to_clients'] + moved['from_clients']) / 2**20:.1f}MB "
+        f"peak_rss={result['peak_rss_mb']:.0f}MB"
+    )
+    for name, phase in result["phases"].items():
+        print(f"    {name:<20} n={phase['count']:<5} mean={phase['mean_ms']:.2f}ms")
+
+
+def main(argv: List[str] | None = None):
+    args = parse_args(argv)
+    gateway = FakeGateway(latency=args.gateway_latency).start()
+    ipfs = FakeIPFS(latency=args.ipfs_latency)
+    workdir = tempfile.mkdtemp(prefix="bfl-bench-")
+
+    # The repo reads its settings from the environment when imported, so they are set before any import
+    os.environ.update({
+        "FL_S_HOST": "127.0.0.1",
+        "FL_S_PORT": "8080",
+        "NUM_CLIENTS": str(max(args.clients)),
+        "IPFS_SWARM_TARGET": ipfs.swarm_target,
+        "EXPRESS_HOST": gateway.host,
+        "EXPRESS_PORT": str(gateway.port),
+        "TEMP_SAVE_PATH": workdir,
+        "CKPT_CACHE_DIR": os.path.join(workdir, "cache"),
+        "PROFILE": "true",
+    })
+    for key, value in {"CENTRAL_EVAL": "false", "KEEP_LOCAL_CHECKPOINTS": "false"}.items():
+        os.environ.setdefault(key, value)
+
+    results = []
+    try:
+        for units in args.units:
+            for num_clients in args.clients:
+                result = run_session(args, num_clients, units, ipfs, gateway, workdir)
+                print_result(result)
+                results.append(result)
+    finally:
+        gateway.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,178 @@
+"""In-process stand-ins for the IPFS daemon and the Fabric checkpoint gateway."""
+import hashlib as hl
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import urlparse
+
+
+class _FakeSwarm:
+    def connect(self, target: str):
+        return {"Strings": [f"connect {target} success"]}
+
+
+class FakeIPFS:
+    """Content-addressed in-memory blob store implementing the parts of ``ipfshttpclient.Client`` used by the repo.
+
+    Every operation sleeps ``latency`` seconds, and the bytes added and read are counted.
+    """
+
+    def __init__(self, latency: float = 0.0, swarm_target: str = "/ip4/127.0.0.1/tcp/4001"):
+        self.latency = latency
+        self.swarm_target = swarm_target
+        self.swarm = _FakeSwarm()
+        self.bytes_added = 0
+        self.bytes_read = 0
+        self._blobs: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def add_bytes(self, blob: bytes) -> str:
+        time.sleep(self.latency)
+        cid = "bafk" + hl.sha256(blob).hexdigest()[:52]
+        with self._lock:
+            self._blobs[cid] = bytes(blob)
+            self.bytes_added += len(blob)
+        return cid
+
+    def add(self, filepath: str) -> dict:
+        with open(filepath, 'rb') as f:
+            return {"Hash": self.add_bytes(f.read()), "Name": filepath}
+
+    def cat(self, url: str) -> bytes:
+        time.sleep(self.latency)
+        with self._lock:
+            blob = self._blobs[url.rstrip('/').split('/')[-1]]
+            self.bytes_read += len(blob)
+        return blob
+
+    def id(self) -> dict:
+        return {"ID": "fake", "Addresses": [self.swarm_target]}
+
+    def close(self):
+        pass
+
+
+class FakeGateway:
+    """HTTP stand-in for the Node gateway of ``application/agent``, serving the checkpoint endpoints from memory.
+
+    Implements ``POST /transactions/checkpoint/create``, ``POST /transactions/checkpoint/createBatch``,
+    ``GET /query/checkpoint/:cpID`` and ``GET /health`` with the response layout of the real gateway. Checkpoints are
+    stored per contract like on the ledger, and every request sleeps ``latency`` seconds.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.latency = latency
+        self.bytes_received = 0
+        self.requests = 0
+        self._checkpoints: Dict[str, List[dict]] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-gateway", daemon=True)
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> 'FakeGateway':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        """Forget every checkpoint and counter, e.g. between benchmark runs."""
+        with self._lock:
+            self._checkpoints.clear()
+            self.bytes_received = 0
+            self.requests = 0
+
+    def _create(self, body: dict, checkpoint_data: dict) -> str:
+        checkpoint = {
+            "ID": checkpoint_data["id"],
+            "Hash": checkpoint_data["hash"],
+            "URL": checkpoint_data["url"],
+            "Owner": body["clientName"],
+            "Algorithm": checkpoint_data["algorithm"],
+            "CurAccuracy": checkpoint_data["cAccuracy"],
+            "Loss": checkpoint_data["loss"],
+            "Round": checkpoint_data["round"],
+            "FedSession": checkpoint_data["fedSession"],
+        }
+        with self._lock:
+            self._checkpoints.setdefault(body["contractName"], []).append(checkpoint)
+        return f"Model {checkpoint['ID']} created at {body['contractName']}"
+
+    def _query(self, contract: str, cp_id: str):
+        with self._lock:
+            checkpoints = list(self._checkpoints.get(contract, []))
+        if cp_id == 'all':
+            return checkpoints
+        if cp_id in ('latest', 'latestcheckpoint'):
+            if not checkpoints:
+                return None
+            return max(checkpoints, key=lambda checkpoint: (checkpoint["FedSession"], checkpoint["Round"]))
+        return next((checkpoint for checkpoint in checkpoints if checkpoint["ID"] == cp_id), None)
+
+    def _handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, code: int, content: dict):
+                payload = json.dumps(dict(content, status={"code": code, "message": "fake"})).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _not_found(self, reason: str):
+                self._reply(404, {"reason": reason, "details": "none"})
+
+            def do_POST(self):
+                time.sleep(gateway.latency)
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length)
+                with gateway._lock:
+                    gateway.bytes_received += length
+                    gateway.requests += 1
+                body = json.loads(raw)
+                path = urlparse(self.path).path
+                if path == "/transactions/checkpoint/create":
+                    self._reply(202, {"result": gateway._create(body, body["checkpointData"])})
+                elif path == "/transactions/checkpoint/createBatch":
+                    self._reply(202, {"result": [gateway._create(body, data) for data in body["checkpoints"]]})
+                else:
+                    self._not_found(f"No route {path}")
+
+            def do_GET(self):
+                time.sleep(gateway.latency)
+                with gateway._lock:
+                    gateway.requests += 1
+                url = urlparse(self.path)
+                if url.path == "/health":
+                    self._reply(200, {})
+                    return
+                prefix = "/query/checkpoint/"
+                if not url.path.startswith(prefix):
+                    self._not_found(f"No route {url.path}")
+                    return
+                query = dict(pair.split('=', 1) for pair in url.query.split('&') if '=' in pair)
+                data = gateway._query(query.get("ctn", ""), url.path[len(prefix):])
+                if data is None:
+                    self._not_found("CheckpointNotFoundError: The checkpoint does not exist!")
+                    return
+                self._reply(200, {"result": data})
+
+        return Handler
@@ -0,0 +1,172 @@
+"""Micro-benchmarks of the data, serialization, hashing and metrics aggregation hot paths.
+
+Every case is timed over several repeats and reported by its median. Results can be saved as a baseline and later
+runs compared against it, failing when a case got slower than the threshold. Run from the fed-learn directory:
+
+    python -m benchmarks.micro --save baseline.json
+    python -m benchmarks.micro --compare baseline.json --threshold 0.2
+
+Baselines are machine specific, compare runs from the same host only.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from benchmarks.fakes import FakeIPFS
+from benchmarks.synthetic import synthetic_frame
+
+# (case name, function to time, number of repeats)
+Case = Tuple[str, Callable[[], object], int]
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="Dataset sizes of the data cases")
+    parser.add_argument("--units", type=int, nargs="+", default=[16, 30, 64, 128],
+                        help="LSTM units of the model sizes of the serialization and hashing cases")
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Client counts of the metrics aggregation cases")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeats per case, fewer for the largest datasets")
+    parser.add_argument("--filter", default="", help="Only run the cases whose name contains this string")
+    parser.add_argument("--save", help="Save the results as a baseline to this JSON file")
+    parser.add_argument("--compare", help="Compare the results with the baseline of this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative slowdown of a case's median reported as a regression")
+    return parser.parse_args(argv)
+
+
+def data_cases(rows: List[int], repeat: int) -> Iterator[Case]:
+    from data import loader
+    from data.preprocessing import CATEGORICAL_COLS, DROP_COLS, LABEL_COL
+
+    for n in rows:
+        df = synthetic_frame(n)
+        numeric = [col for col in df.select_dtypes(include=[np.number]).columns if col not in DROP_COLS + [LABEL_COL]]
+        matrix = loader.preprocess(df).to_numpy(dtype=np.float32)
+        times = repeat if n < 1_000_000 else max(1, repeat // 2)
+        yield f"loader.preprocess[{n}]", lambda df=df: loader.preprocess(df), times
+        yield f"loader.rm_outliers[{n}]", lambda df=df: loader.rm_outliers(df), times
+        yield f"loader.normalize[{n}]", lambda df=df, cols=numeric: loader.normalize(df, cols), times
+        yield f"loader.one_hot[{n}]", lambda df=df: loader.one_hot(df, CATEGORICAL_COLS), times
+        yield f"loader.partition[{n}]", lambda matrix=matrix: loader.partition(3, 1, matrix), times
+
+
+def model_cases(units: List[int], repeat: int) -> Iterator[Case]:
+    import models.net as net
+    from flwr.common import ndarrays_to_parameters, parameters_to_ndarrays
+    from utils.saver import hash_params, save_params
+
+    ipfs = FakeIPFS()
+    for size in units:
+        weights = net.get_model(size).get_weights()
+        parameters = ndarrays_to_parameters(weights)
+        yield f"saver.hash_params[{size}]", lambda weights=weights: hash_params(weights), repeat * 4
+        yield f"saver.hash_params_serialized[{size}]", lambda parameters=parameters: hash_params(parameters), repeat * 4
+        yield f"saver.save_params[{size}]", lambda weights=weights: save_params(ipfs, weights), repeat * 4
+        yield (
+            f"parameters.round_trip[{size}]",
+            lambda weights=weights: parameters_to_ndarrays(ndarrays_to_parameters(weights)),
+            repeat * 4,
+        )
+
+
+def metrics_cases(clients: List[int], repeat: int) -> Iterator[Case]:
+    from strategy.metrics import MetricsAggregator
+
+    rng = np.random.default_rng(0)
+    for n in clients:
+        # The metrics reported by clients after evaluate, and after fit with the timing of their phases
+        evaluate_results = [
+            (int(rng.integers(1000, 50_000)), {
+                "accuracy": float(rng.random()), "specificity": float(rng.random()), "sensitivity": float(rng.random()),
+            })
+            for _ in range(n)
+        ]
+        fit_results = [
+            (num, dict(metrics, loss=float(rng.random()), time_train=float(rng.random()), time_hash=float(rng.random())))
+            for num, metrics in evaluate_results
+        ]
+        aggregate = MetricsAggregator()
+        aggregate_extra = MetricsAggregator(['min', 'max', 'p50', 'p90'])
+        yield f"metrics.evaluate[{n}]", lambda results=evaluate_results: aggregate(results), repeat * 20
+        yield f"metrics.fit[{n}]", lambda results=fit_results: aggregate(results), repeat * 20
+        yield f"metrics.fit_extra[{n}]", lambda results=fit_results: aggregate_extra(results), repeat * 20
+
+
+def measure(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Time ``fn`` after one warm-up call, in milliseconds."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(1000 * (time.perf_counter() - start))
+    return {"median_ms": statistics.median(times), "min_ms": min(times), "repeat": repeat}
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """Print the change of every case against the baseline and return the names of the regressed ones."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<45} {result['median_ms']:>12.3f}ms  (not in baseline)")
+            continue
+        before = baseline[name]["median_ms"]
+        change = result["median_ms"] / before - 1 if before > 0 else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<45} {before:>12.3f}ms -> {result['median_ms']:>12.3f}ms  {change:+7.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = parse_args(argv)
+    from utils.profiler import profiler
+
+    # Recorded spans would pile up over the repeats, the spans themselves are covered by the end-to-end benchmark
+    profiler.enabled = False
+
+    results: Dict[str, dict] = {}
+    cases = [
+        data_cases(args.rows, args.repeat),
+        model_cases(args.units, args.repeat),
+        metrics_cases(args.clients, args.repeat),
+    ]
+    for group in cases:
+        for name, fn, repeat in group:
+            if args.filter not in name:
+                continue
+            results[name] = measure(fn, repeat)
+            if not args.compare:
+                print(f"{name:<45} {results[name]['median_ms']:>12.3f}ms  (min {results[name]['min_ms']:.3f}ms)")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                            "processor": platform.processor(), "numpy": np.__version__},
+                "results": results,
+            }, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,48 @@
+"""Synthetic data shaped like UNSW-NB15, so that benchmarks need no dataset."""
+import numpy as np
+import pandas as pd
+
+# Rows of the preprocessed UNSW-NB15 dataset are one-hot encoded to this many features
+NUM_FEATURES = 196
+
+NUMERIC_COLS = [
+    'dur', 'spkts', 'dpkts', 'sbytes', 'dbytes', 'rate', 'sttl', 'dttl', 'sload', 'dload', 'sloss', 'dloss',
+    'sinpkt', 'dinpkt', 'sjit', 'djit', 'swin', 'stcpb', 'dtcpb', 'dwin', 'tcprtt', 'synack', 'ackdat', 'smean',
+    'dmean', 'trans_depth', 'response_body_len', 'ct_srv_src', 'ct_state_ttl', 'ct_dst_ltm', 'ct_src_dport_ltm',
+    'ct_dst_sport_ltm', 'ct_dst_src_ltm', 'is_ftp_login', 'ct_ftp_cmd', 'ct_flw_http_mthd', 'ct_src_ltm',
+    'ct_srv_dst', 'is_sm_ips_ports',
+]
+# Number of distinct values of the categorical columns, which one-hot encode to NUM_FEATURES with NUMERIC_COLS
+CATEGORIES = {'proto': 133, 'service': 13, 'state': 11}
+ATTACK_CATS = ['Normal', 'Generic', 'Exploits', 'Fuzzers', 'DoS', 'Reconnaissance', 'Analysis', 'Backdoor',
+               'Shellcode', 'Worms']
+
+
+def synthetic_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Random raw rows with the columns of the UNSW-NB15 csv files.
+
+    Numeric features are heavy-tailed so that outlier capping kicks in, and categorical values are skewed towards a
+    few frequent ones like in the real traffic.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {'id': np.arange(1, rows + 1)}
+    for col in NUMERIC_COLS:
+        columns[col] = rng.lognormal(mean=2.0, sigma=2.0, size=rows)
+    for col, count in CATEGORIES.items():
+        # Every value appears at least once, the rest follow a Zipf-like distribution
+        weights = 1.0 / np.arange(1, count + 1)
+        codes = rng.choice(count, size=rows, p=weights / weights.sum())
+        codes[:min(rows, count)] = np.arange(min(rows, count))
+        columns[col] = np.array([f"{col}{i}" for i in range(count)], dtype=object)[codes]
+    label = rng.integers(0, 2, rows)
+    columns['attack_cat'] = np.where(label == 0, 'Normal', rng.choice(ATTACK_CATS[1:], size=rows))
+    columns['label'] = label
+    return pd.DataFrame(columns)
+
+
+def synthetic_data(rows: int, seed: int = 0):
+    """Random binary-labelled rows of the shape the BiLSTM expects, (rows, 1, NUM_FEATURES)."""
+    rng = np.random.default_rng(seed)
+    x = rng.random((rows, 1, NUM_FEATURES), dtype=np.float32)
+    y = rng.integers(0, 2, rows).astype(np.float32)
+    return x, y
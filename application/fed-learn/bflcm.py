@@ -14,12 +14,64 @@
 # ==============================================================================
 """Flower ClientManager."""
 
+import threading
+from logging import WARNING
+from typing import Dict
+
 from flwr.server import SimpleClientManager, client_proxy
+from flwr.server.grpc_server.grpc_client_proxy import GrpcClientProxy
 from flwr.common import GetPropertiesIns
+from flwr.common.logger import log
 
 class BFLClientManager(SimpleClientManager):
     """Provides a pool of available clients."""
 
+    def __init__(self) -> None:
+        super().__init__()
+        # Client id (as reported by the client's properties) -> proxy, for clients registered under another key
+        self._cid_index: Dict[str, client_proxy.ClientProxy] = {}
+        # gRPC clients whose properties are being fetched, by address, not yet available
+        self._pending: Dict[str, client_proxy.ClientProxy] = {}
+
+    def register(self, client: client_proxy.ClientProxy) -> bool:
+        if not isinstance(client, GrpcClientProxy):
+            return super().register(client)
+
+        # gRPC clients are registered under their address. Their properties can only be fetched once the connection
+        # is serving requests, after register returns, so they are indexed by a background thread. Until then they
+        # are kept out of the pool, so that no instruction is sent over the bridge alongside get_properties.
+        with self._cv:
+            if client.cid in self.clients or client.cid in self._pending:
+                return False
+            self._pending[client.cid] = client
+        threading.Thread(target=self._index_client, args=(client,), daemon=True).start()
+        return True
+
+    def unregister(self, client: client_proxy.ClientProxy) -> None:
+        with self._cv:
+            if self._pending.get(client.cid) is client:
+                del self._pending[client.cid]
+            for cid in [cid for cid, proxy in self._cid_index.items() if proxy is client]:
+                del self._cid_index[cid]
+        super().unregister(client)
+
+    def _index_client(self, client: client_proxy.ClientProxy):
+        try:
+            cid = str(client.get_properties(GetPropertiesIns({}), None).properties["cid"])
+        except Exception as err:
+            log(WARNING, f"Could not get the properties of client {client.cid}: {err}")
+            cid = None
+
+        with self._cv:
+            # Unregistered meanwhile
+            if self._pending.get(client.cid) is not client:
+                return
+            del self._pending[client.cid]
+            self.clients[client.cid] = client
+            if cid is not None:
+                self._cid_index[cid] = client
+            self._cv.notify_all()
+
     def get_client(self, cid: str, timeout: float = 0.0) -> client_proxy.ClientProxy:
         """Return client of id 'cid'. Can set wait to wait for the specific client to join. Otherwise return None.
 
@@ -28,8 +80,6 @@ class BFLClientManager(SimpleClientManager):
             timeout (float | None): Maximum time to wait for client availability, defaults to 0.
         """
         
-        # If self.clients use other as key but client class has cid 
-
         with self._cv:
             self._cv.wait_for(
                 lambda: self.__client_with_cid(cid) != None, timeout=timeout
@@ -40,9 +90,7 @@ class BFLClientManager(SimpleClientManager):
     def __client_with_cid(self, cid):
         
         # If self.clients dict use cid as key (Can be defined in start_simulation)
-        if cid in self.clients.keys():
+        if cid in self.clients:
             return self.clients[cid] 
 
-        res = [client for client in self.clients.values() if client.get_properties(GetPropertiesIns({}), 0).properties["cid"] == cid]
-        return res[0] if len(res) > 0 else None
-
+        return self._cid_index.get(cid)
@@ -14,6 +14,21 @@ class BFLHistory(History):
         self.metrics_distributed: Dict[str, List[Tuple[int, Scalar]]] = {}
         self.metrics_centralized: Dict[str, List[Tuple[int, Scalar]]] = {}
         self.elapsed: float = 0
+        # (round dispatched, client id, round folded into or None) of results that missed their round
+        self.late_arrivals: List[Tuple[int, str, int | None]] = []
+        # Timing spans of the session, see utils.profiler
+        self.spans: List[dict] = []
 
     def set_elapsed(self, elapsed):
-        self.elapsed = elapsed
\ No newline at end of file
+        self.elapsed = elapsed
+
+    def add_spans(self, spans: List[dict]):
+        self.spans.extend(spans)
+
+    def phase_durations(self) -> Dict[int, Dict[str, float]]:
+        """Total time in seconds spent in each phase, by round. Spans outside of a round are under round 0."""
+        durations: Dict[int, Dict[str, float]] = {}
+        for span in self.spans:
+            phases = durations.setdefault(span["round"] or 0, {})
+            phases[span["name"]] = phases.get(span["name"], 0.0) + span["duration"]
+        return durations
\ No newline at end of file
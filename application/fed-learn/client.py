@@ -1,14 +1,20 @@
 import flwr as fl
 from flwr.common.typing import Config, Scalar
-from typing import Dict
+from typing import Dict, List
 
 import tensorflow as tf
 import models.net as net
 from data.loader import load_data
+from data.partition import load_partition
+from data.pipeline import make_dataset
 from utils.config import NUM_CLIENTS, S_ADDR
 from subprocess import Popen
-from utils.saver import hash_params, save_params
-from utils.requestor import post_model, is_node_running
+from utils.saver import hash_params, load_params, save_params
+from utils.ckptcache import CheckpointCache
+from utils.requestor import checkpoint_data, post_model, post_models, is_node_running
+from utils.publisher import get_publisher
+from utils.compression import cast_floats, get_compressor
+from utils.profiler import profiler
 
 import os
 import os.path as path
@@ -39,24 +45,47 @@ class Callback(tf.keras.callbacks.Callback):
                 self.counter = 0
         self.counter += 1
 
+profiler.enabled = cfg.PROFILE
+
 batch_size=1000
+eval_batch_size=100
 
 class BFLClient(fl.client.NumPyClient):
 
-    def __init__(self, cid: str, model: tf.keras.Model, x_train, y_train, x_test, y_test) -> None:
+    def __init__(self, cid: str, model: tf.keras.Model, x_train, y_train, x_test, y_test,
+                 ipfs_client: ipfshttpclient.client.Client | None = None) -> None:
+        """
+        Args:
+            ipfs_client (ipfshttpclient.client.Client | None): IPFS client to use instead of starting the gateway and
+                the IPFS daemon of the peer, e.g. a stand-in for benchmarks. Defaults to None.
+        """
         self.model = model
         self.cid = cid
         self.x_train = x_train
         self.y_train = y_train
         self.x_test = x_test
         self.y_test = y_test
+        # Inputs may be keras sequences of a memory-mapped partition, which carry their own labels and batch size
+        self.num_train = getattr(x_train, "num_examples", len(x_train))
+        self.num_test = getattr(x_test, "num_examples", len(x_test))
+
+        # Input pipelines are built once and reused every round
+        self.train_ds = make_dataset(x_train, y_train, batch_size, shuffle=True, cache=cfg.TF_DATA_CACHE)
+        self.test_ds = make_dataset(x_test, y_test, eval_batch_size, cache=cfg.TF_DATA_CACHE)
         
         self.env_vars = cfg.get_env_for_client(str(cid))
         self.peer_name = self.env_vars["PEER_HOST_ALIAS"]
         self._gateway_ps: Popen = None
         self._ipfs_daemon: Popen = None
-        self._ipfs_client: ipfshttpclient.client.Client = None
-        self._setup()
+        self._ipfs_client: ipfshttpclient.client.Client = ipfs_client
+        self._external_ipfs = ipfs_client is not None
+
+        # Checkpoints are saved and registered in the background, so that fit can return right after training
+        self._publisher = get_publisher(max_pending=cfg.PUBLISH_MAX_PENDING, retries=cfg.PUBLISH_RETRIES)
+        # Global checkpoints sent by reference are read from here before IPFS
+        self._checkpoint_cache = CheckpointCache(cfg.CKPT_CACHE_DIR, cfg.CKPT_CACHE_MAX_BYTES) if cfg.CKPT_CACHE_MAX_BYTES > 0 else None
+        if not self._external_ipfs:
+            self._setup()
 
     def get_properties(self, config: Config) -> Dict[str, Scalar]:
         return {"cid": self.cid, "peer_name": self.peer_name}
@@ -68,72 +97,113 @@ class BFLClient(fl.client.NumPyClient):
         print(f"[CLIENT {self.cid}]: ", message)
 
     def fit(self, parameters, config):
+        server_round = config["server_round"]
+        fed_session = config["fed_session"]
+        with profiler.in_round(server_round):
+            parameters = self._resolve_parameters(parameters, config)
+            return self._fit(parameters, config, server_round, fed_session)
+
+    def _resolve_parameters(self, parameters, config):
+        """Load the global checkpoint the server sent by reference instead of its parameters, if any."""
+        if len(parameters) or "checkpoint_url" not in config:
+            return parameters
+        with profiler.span("load_checkpoint", cat="client", cid=self.cid):
+            return load_params(self._ipfs_client, config["checkpoint_url"], self.model,
+                               expected_hash=config["checkpoint_hash"], cache=self._checkpoint_cache)
+
+    def _fit(self, parameters, config, server_round: int, fed_session: int):
         self.model.set_weights(parameters)
         
         epoch = config.get('epoch') or 20
 
-        with tf.device('/device:gpu:0'):
-            self.model.fit(self.x_train, self.y_train, epochs=epoch, batch_size=batch_size, callbacks=[Callback(self.cid)], verbose=0)
+        with profiler.span("train", cat="client", cid=self.cid) as train_time:
+            with tf.device('/device:gpu:0'):
+                self.model.fit(self.train_ds, epochs=epoch, callbacks=[Callback(self.cid)], verbose=0)
 
-        loss, accuracy, _, _ = self.model.evaluate(self.x_test, self.y_test, callbacks=[Callback(self.cid)], verbose=0)
+        with profiler.span("evaluate_local", cat="client", cid=self.cid) as evaluate_time:
+            loss, accuracy, _, _ = self.model.evaluate(self.test_ds, callbacks=[Callback(self.cid)], verbose=0)
         
         # Post local model to IPFS
-        server_round = config["server_round"]
-        fed_session = config["fed_session"]
-
-        self._log(f"Uploading model for server round {server_round}")
         params = self.model.get_weights()
-        hash = hash_params(params)
+        checkpoint = cast_floats(params, cfg.CHECKPOINT_DTYPE)
+        # hash_params records the "hash" span itself, only its duration is reported here
+        hash_start = time.perf_counter()
+        hash = hash_params(checkpoint)
+        hash_duration = time.perf_counter() - hash_start
         id = f"model_fs{fed_session}_r{server_round}_c{self.cid}_{hash}"
+        self._publisher.submit(
+            lambda: self._upload_checkpoint(checkpoint, id, hash, server_round, fed_session, accuracy, loss),
+            description=id,
+            batch=post_checkpoints
+        )
 
-        filename = f"{self.env_vars['TEMP_SAVE_PATH']}/{id}.keras"
-        ipfs_cid = save_params(filename, self._ipfs_client, self.model)
-        resource_url = f"/ipfs/{ipfs_cid}"
-
-        peer_domain = self.env_vars["PEER_DOMAIN"]
-        owner = "User1@" + peer_domain
-        request_url = f"http://{self.env_vars['EXPRESS_HOST']}:{self.env_vars['EXPRESS_PORT']}/transactions/checkpoint/create"
-        resp = post_model(
-            req_url=request_url,
+        # Compress the update sent back to the server if it asked for it
+        with profiler.span("encode_update", cat="client", cid=self.cid) as encode_time:
+            if config.get("compression", "none") != "none" or config.get("delta"):
+                params = get_compressor(self.cid).encode(params, config, base=parameters)
+
+        # Reported metrics of the local model, used to publish global versions in asynchronous mode, and the time
+        # spent in each phase of the fit
+        return params, self.num_train, {
+            "accuracy": float(accuracy),
+            "loss": float(loss),
+            "time_train": train_time["duration"],
+            "time_evaluate": evaluate_time["duration"],
+            "time_hash": hash_duration,
+            "time_encode": encode_time["duration"],
+        }
+
+    def _upload_checkpoint(self, params, id: str, hash: str, server_round: int, fed_session: int, accuracy: float, loss: float) -> dict:
+        """Upload a local model to IPFS and return the arguments of its ledger record. Runs on the publisher thread."""
+        with profiler.in_round(server_round), profiler.span("publish_upload", cat="client", cid=self.cid):
+            self._log(f"Uploading model for server round {server_round}")
+            filename = f"{self.env_vars['TEMP_SAVE_PATH']}/{id}.npz" if cfg.KEEP_LOCAL_CHECKPOINTS else None
+            ipfs_cid = save_params(self._ipfs_client, params, filename)
+        return dict(
+            gateway_url=f"http://{self.env_vars['EXPRESS_HOST']}:{self.env_vars['EXPRESS_PORT']}",
+            owner="User1@" + self.env_vars["PEER_DOMAIN"],
             id=id,
             hash=hash,
-            url=resource_url,
-            fed_round=server_round,
-            algorithm="BiLSTM",
+            url=f"/ipfs/{ipfs_cid}",
             accuracy=accuracy,
             loss=loss,
+            fed_round=server_round,
             fed_session=fed_session,
-            channel_name=CHANNEL_NAME,
-            chaincode_name=CHAINCODE_NAME,
-            contract_name=CONTRACT_NAME,
-            client=owner
         )
 
-        self._log(resp)
-
-        return self.model.get_weights(), len(self.x_train), {}
+    def flush(self):
+        """Wait until every local model of this process has been uploaded and registered."""
+        self._publisher.flush()
 
     def evaluate(self, parameters, config):
         self.model.set_weights(parameters)
-        loss, accuracy, specificity, sensitivity = self.model.evaluate(self.x_test, self.y_test, batch_size=100, verbose=0)
+        with profiler.span("evaluate", cat="client", server_round=config['server_round'], cid=self.cid):
+            loss, accuracy, specificity, sensitivity = self.model.evaluate(self.test_ds, verbose=0)
 
         self._log(f"Round {config['server_round']} - Aggregated Evaluation - Loss: {loss:.6f} - Accuracy: {accuracy:.6f}")
 
-        return loss, len(self.x_test), {"accuracy": float(accuracy), "specificity": float(specificity), "sensitivity": float(sensitivity)}
+        return loss, self.num_test, {"accuracy": float(accuracy), "specificity": float(specificity), "sensitivity": float(sensitivity)}
     
     def terminate(self):
+        # Pending uploads still need the gateway and the IPFS client, which are closed even if they failed
+        try:
+            self.flush()
+        finally:
+            self._close()
+
+    def _close(self):
         if self._gateway_ps:
             self._gateway_ps.terminate()
             self._gateway_ps = None
         if self._ipfs_daemon:
             self._ipfs_daemon.terminate()
             self._ipfs_daemon = None
-        if self._ipfs_client:
+        if self._ipfs_client and not self._external_ipfs:
             self._ipfs_client.close()
             self._ipfs_client = None
 
     def _setup(self):
-        self.terminate()
+        self._close()
 
         self._setup_nodejs()
 
@@ -187,6 +257,53 @@ class BFLClient(fl.client.NumPyClient):
         
 DATA_ROOT = path.abspath("data/datasets/")
 
+def post_checkpoints(uploads: List[dict]):
+    """Register local models uploaded by ``BFLClient._upload_checkpoint`` on the ledger. Runs on the publisher thread.
+
+    The models of every client of the process waiting to be registered are posted together, one request per gateway
+    and owner.
+    """
+    groups: Dict[tuple, List[dict]] = {}
+    for upload in uploads:
+        groups.setdefault((upload["gateway_url"], upload["owner"]), []).append(upload)
+    for (gateway_url, owner), group in groups.items():
+        ledger = dict(channel_name=CHANNEL_NAME, chaincode_name=CHAINCODE_NAME, contract_name=CONTRACT_NAME,
+                      client=owner, query_url=f"{gateway_url}/query/checkpoint/")
+        with profiler.span("publish_post", cat="client", count=len(group)):
+            if len(group) == 1:
+                upload = group[0]
+                resp = post_model(req_url=f"{gateway_url}/transactions/checkpoint/create", id=upload["id"],
+                                  hash=upload["hash"], url=upload["url"], algorithm="BiLSTM",
+                                  accuracy=upload["accuracy"], loss=upload["loss"], fed_round=upload["fed_round"],
+                                  fed_session=upload["fed_session"], **ledger)
+            else:
+                checkpoints = [
+                    checkpoint_data(upload["id"], upload["hash"], upload["url"], "BiLSTM", upload["accuracy"],
+                                    upload["loss"], upload["fed_round"], upload["fed_session"])
+                    for upload in group
+                ]
+                resp = post_models(f"{gateway_url}/transactions/checkpoint/createBatch", checkpoints,
+                                   group[-1]["fed_session"], **ledger)
+        print(resp)
+
+def load_client_data(cid: str, shared: bool = False):
+    """Load a client's data as in-memory arrays, or as keras sequences over the shared memory-mapped dataset.
+
+    Args:
+        cid (str): Client id.
+        shared (bool): Read batches from the shared dataset matrix. Always the case when DATA_CHUNK_SIZE is set.
+
+    Returns:
+        Tuple: x_train, y_train, x_test, y_test. The labels are None for sequences.
+    """
+    with profiler.span("load_data", cat="client", cid=cid):
+        if shared or cfg.DATA_CHUNK_SIZE:
+            part = load_partition(DATA_ROOT, NUM_CLIENTS, int(cid), chunksize=cfg.DATA_CHUNK_SIZE or None)
+            return part.train_sequence(batch_size), None, part.test_sequence(eval_batch_size), None
+
+        x_train, x_test, y_train, y_test = load_data(DATA_ROOT, NUM_CLIENTS, cid)
+        return x_train, y_train, x_test, y_test
+
 def main() -> None:
     """Load data, start CifarClient."""
 
@@ -196,13 +313,17 @@ def main() -> None:
     print("Number of clients:", NUM_CLIENTS)
 
     print("Loading model and data for Client", CID)
-    x_train, x_test, y_train, y_test = load_data(DATA_ROOT, NUM_CLIENTS, CID)
-    model = net.get_model()
+    x_train, y_train, x_test, y_test = load_client_data(CID)
+    with profiler.span("build_model", cat="client", cid=CID):
+        model = net.get_model()
 
     # Start client
     print(f"Initializing client {CID}")
     client = BFLClient(CID, model, x_train, y_train, x_test, y_test)
     fl.client.start_numpy_client(server_address=S_ADDR, client=client)
+    client.terminate()
+    if cfg.PROFILE_DIR:
+        profiler.export_chrome_trace(path.join(cfg.PROFILE_DIR, f"client_{CID}.json"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
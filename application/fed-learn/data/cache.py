@@ -0,0 +1,108 @@
+"""On-disk store for the preprocessed dataset matrix.
+
+Entries are a raw ``.npy`` matrix plus a ``.json`` metadata sidecar, both named after a
+fingerprint of the source files and the preprocessing parameters.
+"""
+import hashlib as hl
+import json
+import os
+import os.path as path
+from typing import List, Tuple
+
+import numpy as np
+
+# Bump whenever the layout of the cached matrix changes
+CACHE_VERSION = 2
+
+
+def fingerprint(files: List[str], params: dict) -> str:
+    """Fingerprint the source files and the preprocessing parameters.
+
+    Files are identified by name, size and modification time so the (large) csv files do not have to be re-read.
+
+    Args:
+        files (List[str]): Paths of the source files.
+        params (dict): JSON serialisable preprocessing parameters.
+
+    Returns:
+        str: A short hex digest to key the cache entry with.
+    """
+    digest = hl.sha256(f"v{CACHE_VERSION}".encode())
+    for file in files:
+        stat = os.stat(file)
+        digest.update(f"{path.basename(file)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def entry_paths(cache_dir: str, key: str) -> Tuple[str, str]:
+    """Return the matrix and metadata paths of a cache entry."""
+    return path.join(cache_dir, f"{key}.npy"), path.join(cache_dir, f"{key}.json")
+
+
+def load(cache_dir: str, key: str, mmap_mode: str | None = None):
+    """Load a cache entry.
+
+    Args:
+        cache_dir (str): Cache directory.
+        key (str): Fingerprint of the entry.
+        mmap_mode (str | None): Memory-map the matrix instead of reading it, see ``np.load``. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, dict] | None: The cached matrix and its metadata, or None on a cache miss.
+    """
+    matrix_path, meta_path = entry_paths(cache_dir, key)
+    if not (path.isfile(matrix_path) and path.isfile(meta_path)):
+        return None
+
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+
+    matrix = np.load(matrix_path, mmap_mode=mmap_mode)
+    if list(matrix.shape) != list(meta["shape"]):
+        return None
+    return matrix, meta
+
+
+def save(cache_dir: str, key: str, matrix: np.ndarray, meta: dict):
+    """Save a cache entry and remove entries left behind by older inputs.
+
+    Files are written under a temporary name and renamed into place, so concurrent clients never read a partial entry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    matrix_path, _ = entry_paths(cache_dir, key)
+    tmp_path = matrix_path + _tmp_suffix()
+    with open(tmp_path, 'wb') as f:
+        np.save(f, matrix)
+    _commit(cache_dir, key, tmp_path, matrix, meta)
+
+
+def open_writer(cache_dir: str, key: str, shape: Tuple[int, int], dtype: str = 'float32') -> np.memmap:
+    """Create a memory-mapped matrix to fill incrementally, e.g. from a stream of chunks, and ``commit`` afterwards."""
+    os.makedirs(cache_dir, exist_ok=True)
+    matrix_path, _ = entry_paths(cache_dir, key)
+    return np.lib.format.open_memmap(matrix_path + _tmp_suffix(), mode='w+', dtype=dtype, shape=shape)
+
+
+def commit(cache_dir: str, key: str, matrix: np.memmap, meta: dict):
+    """Publish a matrix created with ``open_writer`` as a cache entry."""
+    matrix.flush()
+    _commit(cache_dir, key, matrix.filename, matrix, meta)
+
+
+def _tmp_suffix() -> str:
+    return f".{os.getpid()}.tmp"
+
+
+def _commit(cache_dir: str, key: str, tmp_path: str, matrix: np.ndarray, meta: dict):
+    matrix_path, meta_path = entry_paths(cache_dir, key)
+    meta = dict(meta, shape=list(matrix.shape), dtype=str(matrix.dtype))
+    with open(meta_path + _tmp_suffix(), 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, matrix_path)
+    os.replace(meta_path + _tmp_suffix(), meta_path)
+
+    for file in os.listdir(cache_dir):
+        name, ext = path.splitext(file)
+        if name != key and ext in ('.npy', '.json'):
+            os.remove(path.join(cache_dir, file))
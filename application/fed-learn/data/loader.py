@@ -1,10 +1,24 @@
-from typing import Tuple
+from typing import Iterator, List, Tuple
 import numpy as np
 import pandas as pd
 import os.path as path
 from sklearn.model_selection import train_test_split
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import OneHotEncoder
+from data import cache
+from data.preprocessing import Preprocessor, DROP_COLS, CATEGORICAL_COLS, LABEL_COL, OUTLIER_QUANTILE, RESERVOIR_SIZE
+
+# Everything that changes the preprocessed output, used to key the dataset cache
+PREPROCESS_PARAMS = {
+    "drop": DROP_COLS,
+    "categorical": CATEGORICAL_COLS,
+    "label": LABEL_COL,
+    "outlier_quantile": OUTLIER_QUANTILE,
+}
+
+
+# Fraction of the rows reserved for the held-out split, never part of a client partition
+HOLDOUT_FRACTION = 0.05
 
 
 def csvfile(root_dir, train):
@@ -12,51 +26,260 @@ def csvfile(root_dir, train):
     return path.join(root_dir, "UNSW_NB15_" + ("testing" if train else "training") + "-set.csv")
 
 
-def load_data(path: str, num_clients: int, cid: int) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    """Load UNSW-NB15 (training and test set)."""
-    train_set = pd.read_csv(csvfile(path, True))
-    test_set = pd.read_csv(csvfile(path, False))
+def load_preprocessed(root_dir: str, mmap_mode: str | None = None, chunksize: int | None = None,
+                      files: List[str] | None = None) -> Tuple[np.ndarray, dict]:
+    """Load the preprocessed UNSW-NB15 matrix, building and caching it on the first call.
+
+    The matrix holds the one-hot-encoded float32 features followed by the label as its last column.
+    The cache lives in ``<root_dir>/cache`` and is rebuilt whenever the csv files or the preprocessing parameters change.
+
+    Args:
+        root_dir (str): Directory containing the UNSW-NB15 csv files.
+        mmap_mode (str | None): Memory-map the cached matrix instead of reading it into memory. Defaults to None.
+        chunksize (int | None): Build the cache by streaming the csv files in chunks of this many rows, for datasets
+            larger than memory. The result is always memory-mapped. Defaults to None.
+        files (List[str] | None): csv files to use instead of the two UNSW-NB15 sets. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, dict]: The preprocessed matrix and its metadata (feature column names, label name and the
+            serialised ``Preprocessor`` the matrix was produced with).
+    """
+    files = files or [csvfile(root_dir, True), csvfile(root_dir, False)]
+    cache_dir = path.join(root_dir, 'cache')
+    params = PREPROCESS_PARAMS if chunksize is None else dict(PREPROCESS_PARAMS, reservoir_size=RESERVOIR_SIZE)
+    key = cache.fingerprint(files, params)
+    if chunksize is not None:
+        mmap_mode = mmap_mode or 'r'
+
+    cached = cache.load(cache_dir, key, mmap_mode)
+    if cached is not None:
+        print(f"Loaded preprocessed dataset from cache {key}")
+        return cached
+
+    if chunksize is not None:
+        _build_chunked(files, cache_dir, key, chunksize)
+        print(f"Saved preprocessed dataset to cache {key}")
+        return cache.load(cache_dir, key, mmap_mode)
 
     # Combine the train and test set into one
-    df = pd.concat([train_set, test_set])
-    df = preprocess(df)
+    df = pd.concat([pd.read_csv(file) for file in files], ignore_index=True)
+    preprocessor = Preprocessor()
+    preprocessor.fit_schema(df)
+
+    matrix = np.empty((len(df), preprocessor.num_features + 1), dtype='float32')
+    preprocessor.fit_transform(df, out=matrix[:, :-1])
+    matrix[:, -1] = df[LABEL_COL].to_numpy(dtype='float32')
+    meta = {"columns": preprocessor.feature_names, "label": LABEL_COL, "preprocessor": preprocessor.to_dict()}
+    del df
+
+    cache.save(cache_dir, key, matrix, meta)
+    print(f"Saved preprocessed dataset to cache {key}")
+    if mmap_mode is not None:
+        return cache.load(cache_dir, key, mmap_mode)
+    return matrix, meta
+
+
+def _read_chunks(files: List[str], chunksize: int) -> Iterator[pd.DataFrame]:
+    for file in files:
+        yield from pd.read_csv(file, chunksize=chunksize)
+
+
+def _build_chunked(files: List[str], cache_dir: str, key: str, chunksize: int):
+    """Build a cache entry in two streaming passes: fit the statistics, then transform into a memory-mapped matrix."""
+    preprocessor = Preprocessor()
+    n = 0
+    for chunk in _read_chunks(files, chunksize):
+        preprocessor.partial_fit(chunk)
+        n += len(chunk)
+    preprocessor.finalize()
+
+    matrix = cache.open_writer(cache_dir, key, (n, preprocessor.num_features + 1))
+    start = 0
+    for chunk in _read_chunks(files, chunksize):
+        end = start + len(chunk)
+        preprocessor.transform(chunk, out=matrix[start:end, :-1])
+        matrix[start:end, -1] = chunk[LABEL_COL].to_numpy(dtype='float32')
+        start = end
+
+    meta = {"columns": preprocessor.feature_names, "label": LABEL_COL, "preprocessor": preprocessor.to_dict()}
+    cache.commit(cache_dir, key, matrix, meta)
+
+
+def load_preprocessor(root_dir: str, chunksize: int | None = None) -> Preprocessor:
+    """Load the preprocessor fitted on the dataset in ``root_dir``, building the dataset cache if needed."""
+    _, meta = load_preprocessed(root_dir, mmap_mode='r', chunksize=chunksize)
+    return Preprocessor.from_dict(meta["preprocessor"])
+
+
+def load_holdout(root_dir: str, size: int, chunksize: int | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Load a fixed random sample of the held-out rows for centralized evaluation, cached next to the dataset.
+
+    Held-out rows (see ``holdout_mask``) are excluded from every client partition, so the sample gives an unbiased
+    test score of the global model.
+
+    Args:
+        root_dir (str): Directory containing the UNSW-NB15 csv files.
+        size (int): Number of rows, capped at the number of held-out rows.
+        chunksize (int | None): See ``load_preprocessed``. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Features reshaped to (rows, 1, features) and labels.
+    """
+    matrix, _ = load_preprocessed(root_dir, mmap_mode='r', chunksize=chunksize)
+    # Kept in its own directory, saving an entry removes the other entries of a cache directory
+    cache_dir = path.join(root_dir, 'cache', 'holdout')
+    key = cache.fingerprint([matrix.filename], {"size": size, "holdout_fraction": HOLDOUT_FRACTION})
+
+    cached = cache.load(cache_dir, key)
+    if cached is not None:
+        holdout, _ = cached
+    else:
+        holdout = np.asarray(matrix[sample_rows(len(matrix), size, holdout=True)])
+        cache.save(cache_dir, key, holdout, {})
+
+    x = holdout[:, :-1]
+    return x.reshape(x.shape[0], 1, x.shape[1]), holdout[:, -1]
+
+
+def load_train_sample(root_dir: str, size: int, chunksize: int | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Load a random sample of the rows available to the clients, e.g. to calibrate quantization.
+
+    Args:
+        root_dir (str): Directory containing the UNSW-NB15 csv files.
+        size (int): Number of rows.
+        chunksize (int | None): See ``load_preprocessed``. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Features reshaped to (rows, 1, features) and labels.
+    """
+    matrix, _ = load_preprocessed(root_dir, mmap_mode='r', chunksize=chunksize)
+    sample = np.asarray(matrix[sample_rows(len(matrix), size, holdout=False)])
+    x = sample[:, :-1]
+    return x.reshape(x.shape[0], 1, x.shape[1]), sample[:, -1]
+
+
+def holdout_mask(indices: np.ndarray) -> np.ndarray:
+    """Mark the rows reserved for the held-out split, ``HOLDOUT_FRACTION`` of them.
+
+    Uses the top bits of a Fibonacci hash of the row index, independent of the train/test assignment of
+    ``hash_split``, so that it needs no per-row state either.
+
+    Returns:
+        np.ndarray: Boolean mask, True for held-out rows.
+    """
+    hashed = (indices.astype('uint64') * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    return hashed < np.uint64(HOLDOUT_FRACTION * 2 ** 32)
+
+
+def sample_rows(n: int, size: int, holdout: bool, seed: int = 42, block_rows: int = 1 << 20) -> np.ndarray:
+    """Sorted random sample of at most ``size`` row indices among the held-out rows, or among the others.
+
+    Rows are scanned in blocks and thinned as they go, so memory stays bounded by the sample size.
+    """
+    rng = np.random.default_rng(seed)
+    fraction = HOLDOUT_FRACTION if holdout else 1 - HOLDOUT_FRACTION
+    keep = min(1.0, 1.2 * size / max(1.0, fraction * n))
+    picked = []
+    for start in range(0, n, block_rows):
+        indices = np.arange(start, min(start + block_rows, n))
+        indices = indices[holdout_mask(indices) == holdout]
+        if keep < 1.0:
+            indices = indices[rng.random(len(indices)) < keep]
+        picked.append(indices)
+    rows = np.concatenate(picked) if picked else np.empty(0, dtype=np.int64)
+    if len(rows) > size:
+        rows = np.sort(rng.choice(rows, size, replace=False))
+    return rows
+
+
+def load_data(path: str, num_clients: int, cid: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Load UNSW-NB15 (training and test set)."""
+    matrix, _ = load_preprocessed(path)
 
     # Partition data based on client id (Assume 5 clients => cid [0 ... 4])
-    X_train, X_test, y_train, y_test = partition(num_clients=num_clients, cid=cid, df=df)
-    X_train_array = np.array(X_train).astype('float32')
-    X_train_reshaped = X_train_array.reshape(X_train_array.shape[0], 1, 196)
-    X_test_array = np.array(X_test).astype('float32')
-    X_test_reshaped = X_test_array.reshape(X_test.shape[0], 1, 196)
+    X_train, X_test, y_train, y_test = partition(num_clients=num_clients, cid=int(cid), df=matrix)
+    X_train_reshaped = X_train.reshape(X_train.shape[0], 1, X_train.shape[1])
+    X_test_reshaped = X_test.reshape(X_test.shape[0], 1, X_test.shape[1])
     print("Done loading dataset")
     return X_train_reshaped, X_test_reshaped, y_train, y_test
 
 
-def get_part(num_clients: int, cid: int, df: pd.DataFrame | np.ndarray):
-    n = len(df)
+def part_bounds(num_clients: int, cid: int, n: int) -> Tuple[int, int]:
+    """Return the [start, end) row range of a client's part."""
     offset = int(n * 0.25)  # Data will have a 25% offset from start and
     start = (cid - 1) * offset
-    end = n - (offset * int(num_clients - cid))
-    return df.iloc[start:, :] if cid == num_clients else df.iloc[start:end, :]
+    end = n if cid == num_clients else n - (offset * int(num_clients - cid))
+    return start, end
 
 
-def partition(num_clients: int, cid: int, df: pd.DataFrame):
+def get_part(num_clients: int, cid: int, df: pd.DataFrame | np.ndarray):
+    start, end = part_bounds(num_clients, cid, len(df))
+    rows = df.iloc if isinstance(df, pd.DataFrame) else df
+    return rows[start:end, :]
+
+
+def partition(num_clients: int, cid: int, df: pd.DataFrame | np.ndarray):
+    """Split a client's part into train and test sets.
+
+    A preprocessed matrix (see ``load_preprocessed``) is expected to hold the label as its last column. Held-out rows
+    are left out.
+    """
     part = get_part(num_clients, cid, df)
-    y = part['label']
-    X = part.drop(['label'], axis=1)
+    start, end = part_bounds(num_clients, cid, len(df))
+    keep = ~holdout_mask(np.arange(start, end))
+    part = part.iloc[keep] if isinstance(part, pd.DataFrame) else part[keep]
+    if isinstance(part, pd.DataFrame):
+        y = part[LABEL_COL]
+        X = part.drop([LABEL_COL], axis=1)
+    else:
+        y = part[:, -1]
+        X = part[:, :-1]
     return train_test_split(X, y, random_state=42, test_size=0.3, stratify=y)
 
+
+def partition_indices(num_clients: int, cid: int, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Split a client's part into train and test row indices.
+
+    Yields the same split as ``partition`` without copying any feature rows. Held-out rows are left out.
+
+    Args:
+        num_clients (int): Number of clients.
+        cid (int): Client id starting from 1.
+        labels (np.ndarray): Label of every row of the full dataset.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Train and test row indices into the full dataset.
+    """
+    start, end = part_bounds(num_clients, cid, len(labels))
+    indices = np.arange(start, end)
+    indices = indices[~holdout_mask(indices)]
+    return train_test_split(indices, random_state=42, test_size=0.3, stratify=np.asarray(labels[indices]))
+
+
+def hash_split(indices: np.ndarray, test_size: float = 0.3) -> np.ndarray:
+    """Assign rows to the test set by a multiplicative hash of their index.
+
+    Unlike ``partition_indices`` this needs no per-row state, so it scales to datasets larger than memory.
+
+    Returns:
+        np.ndarray: Boolean mask, True for test rows.
+    """
+    hashed = (indices.astype('uint64') * np.uint64(2654435761)) % np.uint64(2 ** 32)
+    return hashed < np.uint64(test_size * 2 ** 32)
+
 # Select numeric categories
 
 
 def rm_outliers(df_in: pd.DataFrame):
     result = df_in.copy()
     df_numeric = df_in.select_dtypes(include=[np.number])
+    block = df_numeric.to_numpy(dtype='float64')
 
     # Remove outliers
-    for feature in df_numeric.columns:
-        if df_numeric[feature].max() > 10*df_numeric[feature].median() and df_numeric[feature].max() > 10:
-            result[feature] = np.where(df_in[feature] < df_in[feature].quantile(
-                0.95), df_in[feature], df_in[feature].quantile(0.95))
+    median, quantile = np.quantile(block, [0.5, OUTLIER_QUANTILE], axis=0)
+    max_value = block.max(axis=0)
+    capped = (max_value > 10 * median) & (max_value > 10)
+    result[df_numeric.columns[capped]] = np.minimum(block[:, capped], quantile[capped])
     return result
 
 
@@ -77,11 +300,7 @@ def one_hot(df, cols):
     @param cols a list of columns to encode
     @return a DataFrame with one-hot encoding
     """
-    for each in cols:
-        dummies = pd.get_dummies(df[each], prefix=each, drop_first=False)
-        df = pd.concat([df, dummies], axis=1)
-        df = df.drop(each, axis=1)
-    return df
+    return pd.get_dummies(df, columns=list(cols), prefix=list(cols), drop_first=False)
 
 # Normalise
 # Function to min-max normalize
@@ -92,26 +311,22 @@ def normalize(df_in: pd.DataFrame, cols):
     @return a DataFrame with normalized specified features
     """
     result = df_in.copy()  # do not touch the original df
-    for feature_name in cols:
-        max_value = df_in[feature_name].astype('float').max()
-        min_value = df_in[feature_name].astype('float').min()
-        if max_value > min_value:
-            result[feature_name] = (df_in[feature_name].astype(
-                'float') - min_value) / (max_value - min_value)
+    block = df_in[cols].to_numpy(dtype='float64')
+    max_value = block.max(axis=0)
+    min_value = block.min(axis=0)
+    scalable = max_value > min_value
+    result[np.asarray(cols)[scalable]] = (block[:, scalable] - min_value[scalable]) / (max_value - min_value)[scalable]
     return result
 
 
 def preprocess(df_in: pd.DataFrame):
-    df_in.drop(['id', 'attack_cat'], axis=1, inplace=True)
-    df_in = rm_outliers(df_in)
-    df_in = normalize(df_in, df_in.select_dtypes(include=[np.number]).columns)
-    return one_hot(df_in, ['proto', 'service', 'state'])
+    """Preprocess a frame with a freshly fitted ``Preprocessor``, keeping the label as the last column."""
+    preprocessor = Preprocessor()
+    result = pd.DataFrame(preprocessor.fit_transform(df_in), columns=preprocessor.feature_names, index=df_in.index)
+    result[LABEL_COL] = df_in[LABEL_COL].to_numpy()
+    return result
 
 if __name__ == '__main__':
     DATA_ROOT = path.abspath('./data/datasets')
-    train_df = pd.read_csv(csvfile(DATA_ROOT, True))
-    test_df = pd.read_csv(csvfile(DATA_ROOT, False))
-    df = pd.concat([train_df, test_df])
-    df.drop(['id', 'attack_cat'], axis=1, inplace=True)
-    preproc = preprocess(df)
-    print(len(partition(3, 1, preproc)))
+    matrix, _ = load_preprocessed(DATA_ROOT)
+    print(len(partition(3, 1, matrix)))
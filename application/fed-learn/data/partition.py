@@ -0,0 +1,170 @@
+"""Client partitions backed by a shared memory-mapped dataset matrix."""
+import math
+import numpy as np
+import tensorflow as tf
+
+from data.loader import load_preprocessed, partition_indices, part_bounds, hash_split, holdout_mask, HOLDOUT_FRACTION
+
+
+class PartitionSequence(tf.keras.utils.Sequence):
+    """Keras sequence gathering batches of rows from the shared matrix on demand."""
+
+    def __init__(self, matrix: np.ndarray, indices: np.ndarray, batch_size: int, shuffle: bool = False, seed: int = 42):
+        self.matrix = matrix
+        self.indices = np.array(indices)  # Own copy, shuffled in place every epoch
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_examples = len(indices)
+        self._rng = np.random.default_rng(seed)
+        if shuffle:
+            self._rng.shuffle(self.indices)
+
+    def __len__(self):
+        return math.ceil(self.num_examples / self.batch_size)
+
+    def __getitem__(self, i):
+        # Sorted indices keep the reads on the memory-mapped file sequential
+        batch_idx = np.sort(self.indices[i * self.batch_size:(i + 1) * self.batch_size])
+        rows = self.matrix[batch_idx]
+        x = rows[:, :-1]
+        return x.reshape(x.shape[0], 1, x.shape[1]), rows[:, -1]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._rng.shuffle(self.indices)
+
+
+class BlockSequence(tf.keras.utils.Sequence):
+    """Keras sequence reading contiguous blocks of a row range and keeping the rows of one side of a ``hash_split``.
+
+    Held-out rows (see ``holdout_mask``) are skipped.
+
+    Holds no per-row state, so memory stays bounded by the block size regardless of the size of the range. Blocks are
+    sized so that a batch holds about ``batch_size`` rows; shuffling permutes the block order and the rows in a block.
+    """
+
+    def __init__(self, matrix: np.ndarray, start: int, end: int, batch_size: int, test: bool, test_size: float = 0.3,
+                 shuffle: bool = False, seed: int = 42):
+        self.matrix = matrix
+        self.batch_size = batch_size
+        self.start = start
+        self.end = end
+        self.test = test
+        self.test_size = test_size
+        self.shuffle = shuffle
+        fraction = (test_size if test else 1 - test_size) * (1 - HOLDOUT_FRACTION)
+        self.block_rows = max(1, math.ceil(batch_size / fraction))
+        self.num_examples = self._count()
+        self._rng = np.random.default_rng(seed)
+        self._order = np.arange(len(self))
+        if shuffle:
+            self._rng.shuffle(self._order)
+
+    def _count(self, block_rows: int = 1 << 20) -> int:
+        count = 0
+        for block_start in range(self.start, self.end, block_rows):
+            indices = np.arange(block_start, min(block_start + block_rows, self.end))
+            count += int(np.count_nonzero(self._keep(indices)))
+        return count
+
+    def _keep(self, indices: np.ndarray) -> np.ndarray:
+        return (hash_split(indices, self.test_size) == self.test) & ~holdout_mask(indices)
+
+    def __len__(self):
+        return math.ceil((self.end - self.start) / self.block_rows)
+
+    def __getitem__(self, i):
+        block_start = self.start + int(self._order[i]) * self.block_rows
+        indices = np.arange(block_start, min(block_start + self.block_rows, self.end))
+        rows = self.matrix[block_start:block_start + len(indices)][self._keep(indices)]
+        if self.shuffle:
+            self._rng.shuffle(rows)
+        x = rows[:, :-1]
+        return x.reshape(x.shape[0], 1, x.shape[1]), rows[:, -1]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._rng.shuffle(self._order)
+
+
+class Partition:
+    """A client's train/test split held as row indices into the shared preprocessed matrix.
+
+    The matrix is memory-mapped, so every client in a process (and every process on a host) shares the same pages
+    and pickling a partition only ships the indices.
+    """
+
+    def __init__(self, matrix_path: str, train_idx: np.ndarray, test_idx: np.ndarray):
+        self.matrix_path = matrix_path
+        self.train_idx = train_idx
+        self.test_idx = test_idx
+        self.matrix = np.load(matrix_path, mmap_mode='r')
+
+    @property
+    def num_features(self) -> int:
+        return self.matrix.shape[1] - 1
+
+    def train_sequence(self, batch_size: int, shuffle: bool = True) -> PartitionSequence:
+        return PartitionSequence(self.matrix, self.train_idx, batch_size, shuffle=shuffle)
+
+    def test_sequence(self, batch_size: int) -> PartitionSequence:
+        return PartitionSequence(self.matrix, self.test_idx, batch_size)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["matrix"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.matrix = np.load(self.matrix_path, mmap_mode='r')
+
+
+class StreamingPartition:
+    """A client's row range of the shared matrix, split into train and test rows by ``hash_split``.
+
+    Used for datasets larger than memory: neither the partition nor its sequences hold per-row state.
+    """
+
+    def __init__(self, matrix_path: str, start: int, end: int, test_size: float = 0.3):
+        self.matrix_path = matrix_path
+        self.start = start
+        self.end = end
+        self.test_size = test_size
+        self.matrix = np.load(matrix_path, mmap_mode='r')
+
+    @property
+    def num_features(self) -> int:
+        return self.matrix.shape[1] - 1
+
+    def train_sequence(self, batch_size: int, shuffle: bool = True) -> BlockSequence:
+        return BlockSequence(self.matrix, self.start, self.end, batch_size, False, self.test_size, shuffle=shuffle)
+
+    def test_sequence(self, batch_size: int) -> BlockSequence:
+        return BlockSequence(self.matrix, self.start, self.end, batch_size, True, self.test_size)
+
+    __getstate__ = Partition.__getstate__
+    __setstate__ = Partition.__setstate__
+
+
+def load_partition(root_dir: str, num_clients: int, cid: int, chunksize: int | None = None) -> Partition | StreamingPartition:
+    """Load a client's partition as a view into the cached, memory-mapped dataset matrix.
+
+    Args:
+        root_dir (str): Directory containing the UNSW-NB15 csv files.
+        num_clients (int): Number of clients.
+        cid (int): Client id starting from 1.
+        chunksize (int | None): Ingest the dataset in chunks of this many rows and return a ``StreamingPartition``
+            whose memory use does not grow with the dataset. Defaults to None.
+
+    Returns:
+        Partition | StreamingPartition: The client's partition.
+    """
+    if chunksize is not None:
+        matrix, _ = load_preprocessed(root_dir, chunksize=chunksize)
+        start, end = part_bounds(num_clients, int(cid), len(matrix))
+        return StreamingPartition(matrix.filename, start, end)
+
+    matrix, _ = load_preprocessed(root_dir, mmap_mode='r')
+    train_idx, test_idx = partition_indices(num_clients, int(cid), matrix[:, -1])
+    return Partition(matrix.filename, train_idx, test_idx)
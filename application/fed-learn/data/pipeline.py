@@ -0,0 +1,99 @@
+"""tf.data input pipelines for client training and evaluation."""
+import numpy as np
+import tensorflow as tf
+
+from data.partition import PartitionSequence
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def make_dataset(x, y=None, batch_size: int = 1000, shuffle: bool = False, cache: bool = False,
+                 seed: int = 42) -> tf.data.Dataset:
+    """Build a batched and prefetched dataset, meant to be built once and reused every round.
+
+    Shuffling happens inside the pipeline on row indices before batching, so both the order and the composition of
+    the batches change every epoch. Keras never calls ``Sequence.on_epoch_end`` on a dataset.
+
+    Args:
+        x (np.ndarray | tf.keras.utils.Sequence): Features, or a keras sequence yielding (x, y) batches.
+        y (np.ndarray | None): Labels, None for sequences. Defaults to None.
+        batch_size (int): Batch size for arrays, sequences use their own. Defaults to 1000.
+        shuffle (bool): Reshuffle every epoch. Defaults to False.
+        cache (bool): Keep the rows read from a sequence in memory after the first epoch. Arrays are always in
+            memory. Defaults to False.
+        seed (int): Shuffle seed. Defaults to 42.
+
+    Returns:
+        tf.data.Dataset: Dataset of (x, y) batches.
+    """
+    if isinstance(x, PartitionSequence):
+        return _partition_dataset(x, shuffle, cache, seed)
+    if isinstance(x, tf.keras.utils.Sequence):
+        return _sequence_dataset(x, shuffle, cache, seed)
+    return _array_dataset(x, y, batch_size, shuffle, seed)
+
+
+def _array_dataset(x: np.ndarray, y: np.ndarray, batch_size: int, shuffle: bool, seed: int):
+    # The arrays are converted to tensors once, batches are gathered from them by index so that shuffling only
+    # buffers row indices instead of copies of the rows
+    x_tensor = tf.constant(x)
+    y_tensor = tf.constant(np.asarray(y))
+    ds = tf.data.Dataset.range(len(x))
+    if shuffle:
+        ds = ds.shuffle(len(x), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size).map(lambda idx: (tf.gather(x_tensor, idx), tf.gather(y_tensor, idx)),
+                                  num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+
+def _reader(read, x_shape: tuple):
+    """Wrap a numpy function returning an (x, y) batch into a dataset map function."""
+    def read_batch(arg):
+        x, y = tf.numpy_function(read, [arg], (tf.float32, tf.float32))
+        x.set_shape((None,) + x_shape)
+        y.set_shape((None,))
+        return x, y
+    return read_batch
+
+
+def _shuffle_cached(ds: tf.data.Dataset, num_examples: int, batch_size: int, seed: int) -> tf.data.Dataset:
+    # The rows are cached before shuffling, then regrouped into new batches every epoch
+    return (ds.cache().unbatch()
+            .shuffle(num_examples, seed=seed, reshuffle_each_iteration=True)
+            .batch(batch_size))
+
+
+def _partition_dataset(sequence: PartitionSequence, shuffle: bool, cache: bool, seed: int):
+    x_first, _ = sequence[0]
+
+    def read(idx):
+        # Sorted indices keep the reads on the memory-mapped file sequential
+        rows = sequence.matrix[np.sort(idx)]
+        x = rows[:, :-1].astype('float32')
+        return x.reshape(x.shape[0], 1, x.shape[1]), rows[:, -1].astype('float32')
+
+    ds = tf.data.Dataset.from_tensor_slices(np.asarray(sequence.indices, dtype=np.int64))
+    if shuffle and not cache:
+        ds = ds.shuffle(sequence.num_examples, seed=seed, reshuffle_each_iteration=True)
+    # Batches are read from the memory-mapped matrix in parallel
+    ds = ds.batch(sequence.batch_size).map(_reader(read, tuple(x_first.shape[1:])), num_parallel_calls=AUTOTUNE)
+    if cache:
+        ds = _shuffle_cached(ds, sequence.num_examples, sequence.batch_size, seed) if shuffle else ds.cache()
+    return ds.prefetch(AUTOTUNE)
+
+
+def _sequence_dataset(sequence: tf.keras.utils.Sequence, shuffle: bool, cache: bool, seed: int):
+    x_first, _ = sequence[0]
+
+    def read(i):
+        x, y = sequence[int(i)]
+        return x.astype('float32'), y.astype('float32')
+
+    # Sequences without per-row state, such as ``BlockSequence``, shuffle the rows of a batch themselves
+    ds = tf.data.Dataset.range(len(sequence))
+    if shuffle and not cache:
+        ds = ds.shuffle(len(sequence), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(_reader(read, tuple(x_first.shape[1:])), num_parallel_calls=AUTOTUNE)
+    if cache:
+        ds = _shuffle_cached(ds, sequence.num_examples, sequence.batch_size, seed) if shuffle else ds.cache()
+    return ds.prefetch(AUTOTUNE)
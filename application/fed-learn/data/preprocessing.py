@@ -0,0 +1,254 @@
+"""Vectorized preprocessing of UNSW-NB15 flow records."""
+from typing import Dict, Iterable, Iterator, List, Mapping
+import hashlib as hl
+import json
+import numpy as np
+import pandas as pd
+
+DROP_COLS = ['id', 'attack_cat']
+CATEGORICAL_COLS = ['proto', 'service', 'state']
+LABEL_COL = 'label'
+OUTLIER_QUANTILE = 0.95
+# Width of the feature matrix, the input of ``models.net``: the numeric columns and the one-hot vocabulary
+NUM_FEATURES = 196
+RESERVOIR_SIZE = 200_000
+
+
+class _StreamingStats:
+    """Exact min/max and a uniform reservoir sample of the numeric block, updated chunk by chunk."""
+
+    def __init__(self, num_cols: int, reservoir_size: int, seed: int = 42):
+        self.min = np.full(num_cols, np.inf)
+        self.max = np.full(num_cols, -np.inf)
+        self.sample = np.empty((reservoir_size, num_cols), dtype='float64')
+        self.seen = 0
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, block: np.ndarray):
+        np.minimum(self.min, block.min(axis=0), out=self.min)
+        np.maximum(self.max, block.max(axis=0), out=self.max)
+
+        # Algorithm R: fill the reservoir, then replace a random slot with decreasing probability
+        size = len(self.sample)
+        fill = max(0, min(size - self.seen, len(block)))
+        self.sample[self.seen:self.seen + fill] = block[:fill]
+        positions = np.arange(self.seen + fill, self.seen + len(block))
+        if len(positions):
+            slots = self._rng.integers(0, positions + 1)
+            kept = slots < size
+            self.sample[slots[kept]] = block[fill:][kept]
+        self.seen += len(block)
+
+    def quantiles(self, q: List[float]) -> np.ndarray:
+        return np.quantile(self.sample[:min(self.seen, len(self.sample))], q, axis=0)
+
+
+class Preprocessor:
+    """Outlier capping, min-max normalisation and one-hot encoding fitted in one pass.
+
+    Equivalent to chaining ``rm_outliers``, ``normalize`` and ``one_hot`` from ``data.loader``, but all statistics are
+    computed on a single NumPy block and the float32 feature matrix is written directly, without intermediate frames.
+
+    Statistics can also be fitted on a stream of chunks with ``partial_fit`` and ``finalize``. Minimum, maximum and the
+    vocabulary stay exact, while the median and outlier quantile are estimated from a uniform sample of
+    ``reservoir_size`` rows, which is exact for datasets no larger than the sample.
+
+    A fitted preprocessor is serialisable (``to_dict``/``save``/``load``) so that the statistics are fitted once and
+    reapplied to new traffic with ``transform``, ``transform_batches`` or ``transform_records``.
+    """
+
+    # Bump whenever the meaning of the serialised statistics changes
+    VERSION = 1
+
+    def __init__(self, categorical: List[str] = CATEGORICAL_COLS, drop: List[str] = DROP_COLS, label: str = LABEL_COL,
+                 outlier_quantile: float = OUTLIER_QUANTILE, reservoir_size: int = RESERVOIR_SIZE):
+        self.categorical = list(categorical)
+        self.drop = list(drop)
+        self.label = label
+        self.outlier_quantile = outlier_quantile
+        self.reservoir_size = reservoir_size
+
+        self.numeric: List[str] = []
+        self.caps: np.ndarray = None
+        self.offset: np.ndarray = None
+        self.scale: np.ndarray = None
+        self.vocab: Dict[str, List[str]] = {}
+
+        self._stream: _StreamingStats = None
+        self._vocab_sets: Dict[str, set] = {}
+
+    @property
+    def feature_names(self) -> List[str]:
+        return self.numeric + [f"{col}_{value}" for col in self.categorical for value in self.vocab[col]]
+
+    @property
+    def num_features(self) -> int:
+        return len(self.numeric) + sum(len(values) for values in self.vocab.values())
+
+    def fit(self, df: pd.DataFrame) -> 'Preprocessor':
+        """Compute outlier caps, scaling factors and the one-hot vocabulary of a frame."""
+        self.fit_schema(df)
+        self._fit_numeric(self._numeric_block(df))
+        return self
+
+    def fit_schema(self, df: pd.DataFrame):
+        """Resolve the numeric columns and the one-hot vocabulary, which is enough to size the output."""
+        excluded = set(self.drop + self.categorical + [self.label])
+        self.numeric = [col for col in df.select_dtypes(include=[np.number]).columns if col not in excluded]
+        self.vocab = {col: sorted(str(value) for value in df[col].dropna().unique()) for col in self.categorical}
+
+    def partial_fit(self, df: pd.DataFrame) -> 'Preprocessor':
+        """Update the streaming statistics with a chunk of a larger dataset, call ``finalize`` after the last one."""
+        if self._stream is None:
+            self.fit_schema(df)
+            self._stream = _StreamingStats(len(self.numeric), self.reservoir_size)
+            self._vocab_sets = {col: set(values) for col, values in self.vocab.items()}
+        else:
+            for col in self.categorical:
+                self._vocab_sets[col].update(str(value) for value in df[col].dropna().unique())
+        self._stream.update(self._numeric_block(df))
+        return self
+
+    def finalize(self) -> 'Preprocessor':
+        """Derive the fitted statistics from the chunks seen by ``partial_fit``."""
+        median, quantile = self._stream.quantiles([0.5, self.outlier_quantile])
+        self._fit_stats(median, quantile, self._stream.min, self._stream.max)
+        self.vocab = {col: sorted(values) for col, values in self._vocab_sets.items()}
+        self._stream = None
+        self._vocab_sets = {}
+        return self
+
+    def _fit_numeric(self, block: np.ndarray):
+        median, quantile = np.quantile(block, [0.5, self.outlier_quantile], axis=0)
+        self._fit_stats(median, quantile, block.min(axis=0), block.max(axis=0))
+
+    def _fit_stats(self, median: np.ndarray, quantile: np.ndarray, min_value: np.ndarray, max_value: np.ndarray):
+        # Features with a long tail are capped at their quantile before scaling
+        capped = (max_value > 10 * median) & (max_value > 10)
+        self.caps = np.where(capped, quantile, np.inf)
+
+        # Bounds of the capped values, constant features are left untouched
+        low = np.minimum(min_value, self.caps)
+        high = np.minimum(max_value, self.caps)
+        scalable = high > low
+        self.offset = np.where(scalable, low, 0.0)
+        self.scale = np.where(scalable, high - low, 1.0)
+
+    def _numeric_block(self, df: pd.DataFrame) -> np.ndarray:
+        return df[self.numeric].to_numpy(dtype='float64')
+
+    def _category_codes(self, col: str, values) -> np.ndarray:
+        return pd.Categorical(pd.Series(values).astype(str), categories=self.vocab[col]).codes
+
+    def transform(self, df: pd.DataFrame, out: np.ndarray | None = None) -> np.ndarray:
+        """Transform a frame into the float32 feature matrix.
+
+        Args:
+            df (pd.DataFrame): Flow records with at least the fitted numeric and categorical columns.
+            out (np.ndarray | None): Preallocated (rows, num_features) array to write into. Defaults to None.
+
+        Raises:
+            ValueError: If the fitted schema does not yield ``NUM_FEATURES`` features.
+
+        Returns:
+            np.ndarray: The feature matrix. Categories unseen during fitting are encoded as all zeros.
+        """
+        self._check_schema()
+        codes = {col: self._category_codes(col, df[col]) for col in self.categorical}
+        return self._transform(self._numeric_block(df), codes, out)
+
+    def transform_batches(self, batches: Iterable[pd.DataFrame]) -> Iterator[np.ndarray]:
+        """Lazily transform a stream of frames, e.g. ``pd.read_csv(..., chunksize=...)``."""
+        for batch in batches:
+            yield self.transform(batch)
+
+    def transform_records(self, records: List[Mapping], out: np.ndarray | None = None) -> np.ndarray:
+        """Transform flow records given as mappings of column name to value, without building a frame.
+
+        Missing numeric values are treated as 0 and missing categories as unseen.
+        """
+        self._check_schema()
+        block = np.array([[record.get(col, 0) for col in self.numeric] for record in records], dtype='float64')
+        block = block.reshape(len(records), len(self.numeric))
+        codes = {}
+        for col in self.categorical:
+            index = {value: i for i, value in enumerate(self.vocab[col])}
+            codes[col] = np.array([index.get(str(record.get(col)), -1) for record in records], dtype='int64')
+        return self._transform(block, codes, out)
+
+    def fit_transform(self, df: pd.DataFrame, out: np.ndarray | None = None) -> np.ndarray:
+        """Fit on a frame and transform it, converting the numeric block only once."""
+        self.fit_schema(df)
+        block = self._numeric_block(df)
+        self._fit_numeric(block)
+        codes = {col: self._category_codes(col, df[col]) for col in self.categorical}
+        return self._transform(block, codes, out)
+
+    def _check_schema(self):
+        # Fitting any frame is allowed, but only the full schema can be fed to the model
+        if self.num_features != NUM_FEATURES:
+            raise ValueError(f"The preprocessor yields {self.num_features} features, expected {NUM_FEATURES} "
+                             f"({len(self.numeric)} numeric and {self.num_features - len(self.numeric)} one-hot)")
+
+    def _transform(self, block: np.ndarray, codes: Dict[str, np.ndarray], out: np.ndarray | None) -> np.ndarray:
+        n = len(block)
+        if out is None:
+            out = np.empty((n, self.num_features), dtype='float32')
+
+        np.minimum(block, self.caps, out=block)
+        block -= self.offset
+        block /= self.scale
+        num_numeric = len(self.numeric)
+        out[:, :num_numeric] = block
+
+        out[:, num_numeric:] = 0
+        rows = np.arange(n)
+        base = num_numeric
+        for col in self.categorical:
+            col_codes = codes[col]
+            known = col_codes >= 0
+            out[rows[known], base + col_codes[known]] = 1
+            base += len(self.vocab[col])
+        return out
+
+    def to_dict(self) -> dict:
+        """Serialise the fitted statistics to a JSON compatible dict."""
+        return {
+            "version": self.VERSION,
+            "categorical": self.categorical,
+            "drop": self.drop,
+            "label": self.label,
+            "outlier_quantile": self.outlier_quantile,
+            "numeric": self.numeric,
+            # Uncapped features have an infinite cap which JSON cannot represent
+            "caps": [None if np.isinf(cap) else float(cap) for cap in self.caps],
+            "offset": self.offset.tolist(),
+            "scale": self.scale.tolist(),
+            "vocab": self.vocab,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'Preprocessor':
+        """Restore a preprocessor serialised with ``to_dict``."""
+        if state["version"] != cls.VERSION:
+            raise ValueError(f"Unsupported preprocessor version {state['version']}, expected {cls.VERSION}")
+        preprocessor = cls(state["categorical"], state["drop"], state["label"], state["outlier_quantile"])
+        preprocessor.numeric = list(state["numeric"])
+        preprocessor.caps = np.array([np.inf if cap is None else cap for cap in state["caps"]], dtype='float64')
+        preprocessor.offset = np.array(state["offset"], dtype='float64')
+        preprocessor.scale = np.array(state["scale"], dtype='float64')
+        preprocessor.vocab = {col: list(values) for col, values in state["vocab"].items()}
+        return preprocessor
+
+    def digest(self) -> str:
+        """Hash of the serialised statistics, identifying the preprocessing a model was trained with."""
+        return hl.sha256(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()
+
+    def save(self, filepath: str):
+        with open(filepath, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, filepath: str) -> 'Preprocessor':
+        with open(filepath, 'r') as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,167 @@
+"""Export published global models to TFLite for CPU inference at the sensors.
+
+The Keras model is converted with a fixed batch size so that the BiLSTM lowers to the fused TFLite LSTM kernels,
+optionally with post-training float16 or int8 quantization, and the artifact is checked for accuracy parity with
+the Keras model on the held-out split before it is written. int8 calibration uses training rows only. Run from the
+fed-learn directory:
+
+    python -m models.export --quantization int8 --output model_ckpt/global.tflite
+
+The exported model is run with ``models.lite.LiteModel``.
+"""
+import argparse
+import json
+import os
+from typing import Dict, Iterator
+
+import ipfshttpclient2 as ipfshttpclient
+import numpy as np
+import tensorflow as tf
+from flwr.common.typing import NDArrays
+
+import models.net as net
+from models.lite import LiteModel
+
+QUANTIZATIONS = ('none', 'fp16', 'int8')
+
+
+def to_tflite(parameters: NDArrays, quantization: str = 'none', batch_size: int = 64,
+              representative: np.ndarray | None = None) -> bytes:
+    """Convert model weights to a TFLite model.
+
+    Args:
+        parameters (NDArrays): The weights of a model built by ``net.get_model``.
+        quantization (str): One of ``QUANTIZATIONS``. 'fp16' stores the weights as float16, 'int8' quantizes weights
+            and activations using ``representative``. Inputs and outputs stay float32. Defaults to 'none'.
+        batch_size (int): Rows per invocation of the exported model. Defaults to 64.
+        representative (np.ndarray | None): Preprocessed rows of shape (rows, 1, features) calibrating the int8
+            activation ranges, required for 'int8'. Defaults to None.
+
+    Raises:
+        ValueError: If the quantization is not supported or 'int8' is missing its representative rows.
+
+    Returns:
+        bytes: The TFLite flatbuffer.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unsupported quantization {quantization}, expected one of {QUANTIZATIONS}")
+    if quantization == 'int8' and (representative is None or len(representative) < batch_size):
+        raise ValueError(f"int8 quantization needs at least {batch_size} representative rows")
+
+    model = net.get_model()
+    model.set_weights(parameters)
+    num_features = model.input_shape[-1]
+
+    # Only the forward pass is exported, without the training metrics of the Keras model
+    @tf.function(input_signature=[tf.TensorSpec((batch_size, 1, num_features), tf.float32)])
+    def score(x):
+        return model(x, training=False)
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([score.get_concrete_function()], model)
+    if quantization == 'fp16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: _representative_batches(representative, batch_size)
+    return converter.convert()
+
+
+def _representative_batches(x: np.ndarray, batch_size: int, max_batches: int = 100) -> Iterator[list]:
+    for start in range(0, min(len(x), batch_size * max_batches) - batch_size + 1, batch_size):
+        yield [np.asarray(x[start:start + batch_size], dtype=np.float32)]
+
+
+def check_parity(parameters: NDArrays, lite_model: LiteModel, x: np.ndarray, y: np.ndarray,
+                 threshold: float = 0.5) -> Dict[str, float]:
+    """Compare an exported model with the Keras model it was exported from.
+
+    Args:
+        parameters (NDArrays): The weights of the Keras model.
+        lite_model (LiteModel): The exported model.
+        x (np.ndarray): Preprocessed rows of shape (rows, 1, features).
+        y (np.ndarray): Their labels.
+        threshold (float): Score from which a flow is classified as an attack. Defaults to 0.5.
+
+    Returns:
+        Dict[str, float]: Accuracy of both models, the fraction of flows they classify alike and the largest score
+            difference.
+    """
+    model = net.get_model()
+    model.set_weights(parameters)
+    keras_scores = model.predict(x, batch_size=lite_model.batch_size, verbose=0).reshape(-1)
+    lite_scores = lite_model.predict(x)
+
+    keras_labels = keras_scores >= threshold
+    lite_labels = lite_scores >= threshold
+    labels = np.asarray(y).reshape(-1) >= 0.5
+    return {
+        "keras_accuracy": float(np.mean(keras_labels == labels)),
+        "lite_accuracy": float(np.mean(lite_labels == labels)),
+        "agreement": float(np.mean(keras_labels == lite_labels)),
+        "max_score_diff": float(np.max(np.abs(keras_scores - lite_scores))),
+    }
+
+
+def main():
+    import utils.config as cfg
+    from data.loader import load_holdout, load_train_sample
+    from utils.ckptcache import CheckpointCache
+    from utils.requestor import query_model
+    from utils.saver import load_params
+    from serve import CHAINCODE_NAME, CHANNEL_NAME, CONTRACT_NAME, DATA_ROOT
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--checkpoint", default="latestcheckpoint",
+                        help="ID of the global checkpoint on the ledger. Defaults to the latest one")
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default='none', help="Post-training quantization")
+    parser.add_argument("--batch-size", type=int, default=64, help="Rows per invocation of the exported model")
+    parser.add_argument("--calibration-size", type=int, default=6400, help="Training rows calibrating int8 quantization")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01,
+                        help="Largest accuracy loss on the held-out sample accepted from the exported model")
+    parser.add_argument("--client-id", default="1", help="Client whose IPFS daemon and gateway are used")
+    parser.add_argument("--output", required=True, help="Path of the .tflite file, its metadata is saved next to it")
+    args = parser.parse_args()
+
+    env = cfg.get_env_for_client(args.client_id)
+    checkpoint = query_model(f"{cfg.CHECKPOINTS_QUERY_URL}{args.checkpoint}", CHANNEL_NAME, CHAINCODE_NAME,
+                             CONTRACT_NAME, "User1@" + env["PEER_DOMAIN"])
+    if not checkpoint:
+        print(f"Global checkpoint {args.checkpoint} cannot be found on the ledger!")
+        exit(1)
+
+    ipfs_client = ipfshttpclient.Client(f"/ip4/{env['IPFS_HOST']}/tcp/{int(env['IPFS_API_PORT'])}/http")
+    cache = CheckpointCache(cfg.CKPT_CACHE_DIR, cfg.CKPT_CACHE_MAX_BYTES) if cfg.CKPT_CACHE_MAX_BYTES > 0 else None
+    parameters = load_params(ipfs_client, checkpoint["URL"], net.get_model(), expected_hash=checkpoint["Hash"], cache=cache)
+    ipfs_client.close()
+
+    chunksize = cfg.DATA_CHUNK_SIZE or None
+    representative = None
+    if args.quantization == 'int8':
+        representative, _ = load_train_sample(DATA_ROOT, args.calibration_size, chunksize=chunksize)
+    content = to_tflite(parameters, args.quantization, args.batch_size, representative=representative)
+
+    x, y = load_holdout(DATA_ROOT, cfg.EVAL_HOLDOUT_SIZE, chunksize=chunksize)
+    parity = check_parity(parameters, LiteModel(model_content=content), x, y)
+    print(f"Exported {checkpoint['ID']} ({len(content) / 1024:.1f} KB, {args.quantization}): {parity}")
+    if parity["keras_accuracy"] - parity["lite_accuracy"] > args.max_accuracy_drop:
+        print(f"The exported model loses more than {args.max_accuracy_drop:.2%} accuracy, not saving it!")
+        exit(1)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'wb') as f:
+        f.write(content)
+    with open(f"{os.path.splitext(args.output)[0]}.json", 'w') as f:
+        json.dump({
+            "checkpoint": checkpoint["ID"],
+            "hash": checkpoint["Hash"],
+            "round": checkpoint["Round"],
+            "fed_session": checkpoint["FedSession"],
+            "quantization": args.quantization,
+            "batch_size": args.batch_size,
+            "parity": parity,
+        }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
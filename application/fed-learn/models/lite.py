@@ -0,0 +1,53 @@
+"""Run exported TFLite models, see ``models.export``, without importing TensorFlow when possible.
+
+The interpreter comes from the standalone ``tflite_runtime`` package, a few MB installed with
+``pip install tflite-runtime``, and falls back to the one bundled with TensorFlow if it is missing.
+"""
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    from tensorflow.lite import Interpreter
+
+
+class LiteModel:
+    """Score flows with an exported model.
+
+    Exported models take batches of a fixed size, so inputs are scored in chunks of that size, the last one zero
+    padded.
+    """
+
+    def __init__(self, model_path: str | None = None, model_content: bytes | None = None, num_threads: int | None = None):
+        """
+        Args:
+            model_path (str | None): Path of the .tflite file. Defaults to None.
+            model_content (bytes | None): The model itself, instead of ``model_path``. Defaults to None.
+            num_threads (int | None): Interpreter threads, None for the runtime's default. Defaults to None.
+        """
+        self.interpreter = Interpreter(model_path=model_path, model_content=model_content, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.batch_size, _, self.num_features = self._input["shape"]
+        self._batch = np.zeros(self._input["shape"], dtype=self._input["dtype"])
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """Attack scores of flows.
+
+        Args:
+            x (np.ndarray): Preprocessed flows of shape (rows, features) or (rows, 1, features).
+
+        Returns:
+            np.ndarray: The score of every flow, of shape (rows,).
+        """
+        x = np.asarray(x, dtype=self._input["dtype"]).reshape(-1, 1, self.num_features)
+        scores = np.empty(len(x), dtype=np.float32)
+        for start in range(0, len(x), self.batch_size):
+            chunk = x[start:start + self.batch_size]
+            self._batch[:len(chunk)] = chunk
+            self._batch[len(chunk):] = 0
+            self.interpreter.set_tensor(self._input["index"], self._batch)
+            self.interpreter.invoke()
+            scores[start:start + len(chunk)] = self.interpreter.get_tensor(self._output["index"]).reshape(-1)[:len(chunk)]
+        return scores
@@ -3,10 +3,10 @@ from keras.layers import Dense, Dropout, Activation
 from keras.layers import Bidirectional, LSTM
 from keras.metrics import SpecificityAtSensitivity, SensitivityAtSpecificity
 
-def get_model():
+def get_model(units: int = 30):
     model = Sequential()
-    model.add(Bidirectional(LSTM(30, return_sequences=True), input_shape=(1, 196)))
-    model.add(Bidirectional(LSTM(30, return_sequences=False)))
+    model.add(Bidirectional(LSTM(units, return_sequences=True), input_shape=(1, 196)))
+    model.add(Bidirectional(LSTM(units, return_sequences=False)))
     model.add(Dropout(0.3))
     model.add(Dense(1))
     model.add(Activation('sigmoid'))
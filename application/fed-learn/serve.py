@@ -0,0 +1,420 @@
+"""Inference service scoring flow records with the latest global model.
+
+The global model is loaded from the checkpoint ledger and IPFS, and records are preprocessed with the statistics the
+model was trained with, referenced by the metadata of its checkpoint. Concurrent requests are coalesced into batches
+of at most SERVE_MAX_BATCH rows, waiting at most SERVE_MAX_WAIT_MS for a batch to fill, and scored by a
+``tf.function`` traced once for that fixed batch shape.
+A watcher polls the ledger and swaps in newer global models once they are loaded and warmed up, so that requests
+keep being served by the previous model meanwhile.
+
+Endpoints:
+    POST /classify  {"records": [{"proto": "tcp", "dur": 0.1, ...}, ...]} -> scores, labels and model id
+    GET  /metrics   throughput and latency counters
+    GET  /health    id of the model being served
+"""
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import INFO, WARNING
+from typing import Dict, List, Mapping, Tuple
+
+import ipfshttpclient2 as ipfshttpclient
+import numpy as np
+import tensorflow as tf
+from flwr.common.logger import log
+
+import models.net as net
+import utils.config as cfg
+from data.preprocessing import Preprocessor
+from utils.ckptcache import CheckpointCache
+from utils.requestor import query_model
+from utils.saver import load_checkpoint
+
+DATA_ROOT = os.path.abspath('./data/datasets')
+CHANNEL_NAME="fedlearn"
+CHAINCODE_NAME="checkpoints"
+CONTRACT_NAME="GlobalLearningContract"
+
+
+class InferenceModel:
+    """A global model with a scoring function traced for a fixed batch shape."""
+
+    def __init__(self, checkpoint: dict, parameters, batch_size: int, num_features: int):
+        """
+        Args:
+            checkpoint (dict): Ledger record of the checkpoint, whose "ID" identifies the model.
+            parameters (NDArrays): The model weights.
+            batch_size (int): Rows of every batch, shorter batches are padded.
+            num_features (int): Features per row.
+        """
+        self.checkpoint = checkpoint
+        self.id = checkpoint["ID"]
+        self.batch_size = batch_size
+        self._model = net.get_model()
+        if self._model.input_shape[-1] != num_features:
+            raise ValueError(f"The preprocessor yields {num_features} features, the model expects {self._model.input_shape[-1]}")
+        self._model.set_weights(parameters)
+
+        model = self._model
+
+        @tf.function(input_signature=[tf.TensorSpec((batch_size, 1, num_features), tf.float32)])
+        def score(x):
+            return tf.reshape(model(x, training=False), (-1,))
+
+        self._score = score
+        # Traced here rather than on the first request
+        self._score(tf.zeros((batch_size, 1, num_features), tf.float32))
+
+    def score(self, batch: np.ndarray) -> np.ndarray:
+        """Score a padded (batch_size, 1, num_features) batch."""
+        return self._score(batch).numpy()
+
+
+class Counters:
+    """Throughput and latency counters of the service."""
+
+    def __init__(self, window: int = 10_000):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.records = 0
+        self.batches = 0
+        self.errors = 0
+        self.model_swaps = 0
+        # Latencies in seconds of the most recent requests and sizes of the most recent batches
+        self._latencies: deque = deque(maxlen=window)
+        self._batch_sizes: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add_request(self, records: int, latency: float):
+        with self._lock:
+            self.requests += 1
+            self.records += records
+            self._latencies.append(latency)
+
+    def add_batch(self, rows: int):
+        with self._lock:
+            self.batches += 1
+            self._batch_sizes.append(rows)
+
+    def add_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def add_swap(self):
+        with self._lock:
+            self.model_swaps += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            latencies = np.array(self._latencies) * 1000
+            snapshot = {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "records": self.records,
+                "batches": self.batches,
+                "errors": self.errors,
+                "model_swaps": self.model_swaps,
+                "records_per_sec": self.records / uptime if uptime > 0 else 0.0,
+                "mean_batch_size": float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.0,
+            }
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            snapshot.update(latency_p50_ms=float(p50), latency_p95_ms=float(p95), latency_p99_ms=float(p99))
+        return snapshot
+
+
+class _Request:
+    __slots__ = ("rows", "future")
+
+    def __init__(self, rows: np.ndarray):
+        self.rows = rows
+        self.future: Future = Future()
+
+
+class MicroBatcher:
+    """Coalesce concurrent scoring requests into batches run on a single background thread."""
+
+    def __init__(self, model: InferenceModel, num_features: int, max_batch: int, max_wait: float, counters: Counters):
+        """
+        Args:
+            model (InferenceModel): The model to start serving with, traced for ``max_batch`` rows.
+            num_features (int): Features per row.
+            max_batch (int): Maximum number of rows per batch.
+            max_wait (float): Maximum seconds the first request of a batch waits for others to join.
+            counters (Counters): Counters to update.
+        """
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.counters = counters
+        self._queue: queue.Queue = queue.Queue()
+        # Batches are copied into one preallocated buffer, zero padded past their rows
+        self._buffer = np.zeros((max_batch, 1, num_features), dtype=np.float32)
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def swap(self, model: InferenceModel):
+        """Serve the following batches with another model, the batch in progress finishes with the current one."""
+        self.model = model
+
+    def score(self, rows: np.ndarray) -> Tuple[np.ndarray, str]:
+        """Score (rows, 1, num_features) features, blocking until every chunk of at most ``max_batch`` rows is done.
+
+        Returns:
+            Tuple[np.ndarray, str]: The scores and the id of the model that produced the last of them.
+        """
+        requests = [_Request(rows[i:i + self.max_batch]) for i in range(0, len(rows), self.max_batch)]
+        if not requests:
+            return np.empty(0, dtype=np.float32), self.model.id
+        for request in requests:
+            self._queue.put(request)
+        results = [request.future.result() for request in requests]
+        return np.concatenate([scores for scores, _ in results]), results[-1][1]
+
+    def _collect(self, first: _Request) -> tuple:
+        """Gather requests after ``first`` until the batch is full or ``max_wait`` passed.
+
+        Returns:
+            tuple: The requests of the batch and the request that did not fit in it, if any.
+        """
+        batch = [first]
+        rows = len(first.rows)
+        deadline = time.monotonic() + self.max_wait
+        while rows < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if rows + len(request.rows) > self.max_batch:
+                return batch, request
+            batch.append(request)
+            rows += len(request.rows)
+        return batch, None
+
+    def _run(self):
+        carry = None
+        while True:
+            first = carry or self._queue.get()
+            batch, carry = self._collect(first)
+
+            rows = 0
+            for request in batch:
+                self._buffer[rows:rows + len(request.rows)] = request.rows
+                rows += len(request.rows)
+            self._buffer[rows:] = 0
+
+            model = self.model
+            try:
+                scores = model.score(self._buffer)
+            except Exception as err:
+                log(WARNING, f"Scoring a batch of {rows} rows failed: {err}")
+                for request in batch:
+                    request.future.set_exception(err)
+                continue
+            self.counters.add_batch(rows)
+
+            start = 0
+            for request in batch:
+                request.future.set_result((scores[start:start + len(request.rows)], model.id))
+                start += len(request.rows)
+
+
+class InferenceService:
+    """Preprocess records, score them with the micro-batcher and keep the served model up to date."""
+
+    def __init__(self, preprocessor: Preprocessor | None, ipfs_client: ipfshttpclient.Client, client_name: str,
+                 max_batch: int = 64, max_wait: float = 0.005, threshold: float = 0.5,
+                 cache: CheckpointCache | None = None):
+        """
+        Args:
+            preprocessor (Preprocessor | None): Preprocessing the global models were trained with, None to load the
+                one referenced by the first global checkpoint.
+            ipfs_client (ipfshttpclient.Client): IPFS client to download checkpoints with.
+            client_name (str): Identity used to query the ledger, e.g. "User1@org1.example.com".
+            max_batch (int): Maximum number of rows per batch. Defaults to 64.
+            max_wait (float): Maximum seconds a request waits for a batch to fill. Defaults to 0.005.
+            threshold (float): Score from which a record is classified as an attack. Defaults to 0.5.
+            cache (CheckpointCache | None): Local checkpoint cache. Defaults to None.
+
+        Raises:
+            RuntimeError: If no global model has been published yet.
+            ValueError: If the global model was trained with another preprocessor, or references none while
+                ``preprocessor`` is None.
+        """
+        self.preprocessor = preprocessor
+        self._preprocessor_digest = preprocessor.digest() if preprocessor is not None else None
+        self.ipfs_client = ipfs_client
+        self.client_name = client_name
+        self.max_batch = max_batch
+        self.threshold = threshold
+        self.cache = cache
+        self.counters = Counters()
+        self._stop = threading.Event()
+        self._watcher: threading.Thread | None = None
+
+        model = self._load_latest(current_id=None)
+        if model is None:
+            raise RuntimeError("No global model has been published to the ledger yet")
+        self.batcher = MicroBatcher(model, self.preprocessor.num_features, max_batch, max_wait, self.counters)
+
+    @property
+    def model(self) -> InferenceModel:
+        return self.batcher.model
+
+    def _load_latest(self, current_id: str | None) -> InferenceModel | None:
+        """Load the latest global model if it is not the one with ``current_id``."""
+        checkpoint = query_model(f"{cfg.CHECKPOINTS_QUERY_URL}latestcheckpoint", CHANNEL_NAME, CHAINCODE_NAME,
+                                 CONTRACT_NAME, self.client_name)
+        if not checkpoint or checkpoint["ID"] == current_id:
+            return None
+        log(INFO, f"Loading global model {checkpoint['ID']}")
+        parameters, metadata = load_checkpoint(self.ipfs_client, checkpoint["URL"], expected_hash=checkpoint["Hash"],
+                                               cache=self.cache)
+        self._check_preprocessor(checkpoint, metadata)
+        return InferenceModel(checkpoint, parameters, self.max_batch, self.preprocessor.num_features)
+
+    def _check_preprocessor(self, checkpoint: dict, metadata: dict):
+        """Load the preprocessor a checkpoint was trained with, or check that it is the one being served."""
+        digest = metadata.get("preprocessor_digest")
+        if self.preprocessor is None:
+            if "preprocessor" not in metadata:
+                raise ValueError(f"Global model {checkpoint['ID']} does not reference its preprocessor, set SERVE_PREPROCESSOR")
+            preprocessor = Preprocessor.from_dict(json.loads(self.ipfs_client.cat(metadata["preprocessor"])))
+            if preprocessor.digest() != digest:
+                raise ValueError(f"Preprocessor {metadata['preprocessor']} does not match digest {digest}")
+            log(INFO, f"Loaded preprocessor {digest} from {metadata['preprocessor']}")
+            self.preprocessor, self._preprocessor_digest = preprocessor, digest
+        elif digest is not None and digest != self._preprocessor_digest:
+            raise ValueError(f"Global model {checkpoint['ID']} was trained with preprocessor {digest}, "
+                             f"serving {self._preprocessor_digest}")
+
+    def watch(self, interval: float):
+        """Poll the ledger every ``interval`` seconds on a background thread and swap in newer global models."""
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    model = self._load_latest(current_id=self.model.id)
+                except Exception as err:
+                    log(WARNING, f"Could not load the latest global model: {err}")
+                    continue
+                if model is not None:
+                    self.batcher.swap(model)
+                    self.counters.add_swap()
+                    log(INFO, f"Now serving global model {model.id}")
+
+        self._watcher = threading.Thread(target=run, name="model-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def classify(self, records: List[Mapping]) -> dict:
+        """Score flow records given as mappings of column name to value."""
+        start = time.perf_counter()
+        try:
+            features = self.preprocessor.transform_records(records)
+            scores, model_id = self.batcher.score(features.reshape(len(records), 1, features.shape[1]))
+        except Exception:
+            self.counters.add_error()
+            raise
+        self.counters.add_request(len(records), time.perf_counter() - start)
+        return {
+            "model": model_id,
+            "scores": scores.tolist(),
+            "labels": (scores >= self.threshold).astype(int).tolist(),
+        }
+
+
+def make_handler(service: InferenceService):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive connections spare clients a TCP handshake per request
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, code: int, content: dict):
+            payload = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._reply(200, {"model": service.model.id, "round": service.model.checkpoint.get("Round")})
+            elif self.path == "/metrics":
+                self._reply(200, dict(service.counters.snapshot(), model=service.model.id))
+            else:
+                self._reply(404, {"reason": f"No route {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/classify":
+                self._reply(404, {"reason": f"No route {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                records = body["records"]
+            except (ValueError, KeyError, TypeError) as err:
+                self._reply(400, {"reason": f"Expected a JSON body with a list of records: {err}"})
+                return
+            try:
+                self._reply(200, service.classify(records))
+            except Exception as err:
+                self._reply(500, {"reason": str(err)})
+
+    return Handler
+
+
+def load_serving_preprocessor() -> Preprocessor | None:
+    """Load the preprocessor of SERVE_PREPROCESSOR, a file or an IPFS path, None to use the one of the checkpoints."""
+    if not cfg.SERVE_PREPROCESSOR:
+        return None
+    if cfg.SERVE_PREPROCESSOR.startswith("/ipfs/"):
+        return Preprocessor.from_dict(json.loads(connect_ipfs().cat(cfg.SERVE_PREPROCESSOR)))
+    return Preprocessor.load(cfg.SERVE_PREPROCESSOR)
+
+
+def connect_ipfs() -> ipfshttpclient.Client:
+    env = cfg.get_env_for_client(cfg.SERVE_CLIENT_ID)
+    return ipfshttpclient.Client(f"/ip4/{env['IPFS_HOST']}/tcp/{int(env['IPFS_API_PORT'])}/http")
+
+
+def main():
+    env = cfg.get_env_for_client(cfg.SERVE_CLIENT_ID)
+    cache = CheckpointCache(cfg.CKPT_CACHE_DIR, cfg.CKPT_CACHE_MAX_BYTES) if cfg.CKPT_CACHE_MAX_BYTES > 0 else None
+    service = InferenceService(
+        load_serving_preprocessor(),
+        connect_ipfs(),
+        "User1@" + env["PEER_DOMAIN"],
+        max_batch=cfg.SERVE_MAX_BATCH,
+        max_wait=cfg.SERVE_MAX_WAIT_MS / 1000,
+        threshold=cfg.SERVE_THRESHOLD,
+        cache=cache,
+    )
+    service.watch(cfg.SERVE_POLL_INTERVAL)
+
+    httpd = ThreadingHTTPServer((cfg.SERVE_HOST, cfg.SERVE_PORT), make_handler(service))
+    httpd.daemon_threads = True
+    log(INFO, f"Serving global model {service.model.id} at http://{cfg.SERVE_HOST}:{cfg.SERVE_PORT}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
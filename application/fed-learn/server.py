@@ -1,13 +1,17 @@
-from data.loader import load_data
-from utils.saver import hash_params, save_params
+from data.loader import load_holdout, load_preprocessor, csvfile
+from data.pipeline import make_dataset
+from utils.saver import hash_params, save_params, load_params
 import os
 import models.net as net
 import numpy as np
 from strategy.BFedAvg import BFedAvg
+from strategy.BFedBuff import BFedBuff
+from strategy.metrics import MetricsAggregator
 
-from client import BFLClient
+from client import BFLClient, load_client_data, DATA_ROOT, eval_batch_size
 from bflcm import BFLClientManager
 from bflhistory import BFLHistory
+from simulation import run_simulation
 from plotter.plot import plot_time, plot_all
 import pickle
 from subprocess import Popen
@@ -15,21 +19,31 @@ from subprocess import Popen
 
 import flwr as fl
 from flwr.server import Server, History
+from flwr.server.server import fit_client
 from flwr.server.client_proxy import ClientProxy
-from flwr.common import GetParametersIns, ndarrays_to_parameters, parameters_to_ndarrays
+from flwr.common import Code, FitIns, GetParametersIns, ndarrays_to_parameters, parameters_to_ndarrays
 from flwr.common.logger import log
-from flwr.common.typing import Metrics, Parameters
+from flwr.common.typing import Parameters, NDArrays, Scalar
 import ipfshttpclient2 as ipfshttpclient
 
 import utils.config as cfg
-from utils.requestor import post_model, query_model, response_handler
-
-from typing import List, Tuple
-
-from logging import INFO, ERROR
+from utils.requestor import checkpoint_data, post_model, post_models, query_model, response_handler
+from utils.publisher import Publisher
+from utils.ckptcache import CheckpointCache
+from utils.compression import cast_floats, fit_config as compression_config
+from utils.profiler import profiler
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from logging import DEBUG, INFO, ERROR, WARNING
+import concurrent.futures
+import math
+import threading
 import timeit
 import time
 
+profiler.enabled = cfg.PROFILE
+
 SAVE_DIR = os.path.abspath('./model_ckpt/tmp/') if cfg.WORK_ENV == 'TEST' else os.path.abspath('./model_ckpt/')
 DATA_ROOT = os.path.abspath('./data/datasets')
 CHANNEL_NAME="fedlearn"
@@ -38,16 +52,32 @@ CONTRACT_NAME="GlobalLearningContract"
 ALGORITHM="BiLSTM"
 
 class BFLServer(Server):
-    def __init__(self, associated_client_id: str, algorithm_name: str, temp_model_file_path: str = SAVE_DIR, **kwargs):
+    def __init__(self, associated_client_id: str, algorithm_name: str, temp_model_file_path: str = SAVE_DIR,
+                 ipfs_client: ipfshttpclient.Client | None = None, **kwargs):
+        """
+        Args:
+            ipfs_client (ipfshttpclient.Client | None): IPFS client to use instead of starting and connecting to the
+                IPFS daemon of the associated client, e.g. a stand-in for benchmarks. Defaults to None.
+        """
         Server.__init__(self, **kwargs)
         self.associated_client_id: str = associated_client_id
         self.algorithm = algorithm_name
-        self.ipfs_client = None
+        self.ipfs_client = ipfs_client
         self.temp_model_file_path = temp_model_file_path
         self.model = net.get_model()
 
         self.associated_client: ClientProxy = None
         self.fed_session = 0
+        self._fit_executor: concurrent.futures.ThreadPoolExecutor | None = None
+        # Fits still running for a closed round, and whether the session ended and no longer takes late results
+        self._stragglers: set = set()
+        self._session_closed = False
+        self._late_lock = threading.Lock()
+        self.checkpoint_cache = CheckpointCache(cfg.CKPT_CACHE_DIR, cfg.CKPT_CACHE_MAX_BYTES) if cfg.CKPT_CACHE_MAX_BYTES > 0 else None
+        # Saved with every global checkpoint of the session, the IPFS path and digest of its preprocessor
+        self.checkpoint_metadata: Dict[str, str] = {}
+        # Parameters restored from the latest global checkpoint, with its IPFS path and hash
+        self._restored: Tuple[Parameters, str, str] | None = None
 
     def fit(self, num_rounds: int, timeout: float | None) -> History:
         """Run federated averaging for a number of rounds."""
@@ -62,96 +92,360 @@ class BFLServer(Server):
             log(ERROR, f"Timeout waiting for associated client's connection!")
             exit(1)
 
-        if not self._is_port_in_use(associated_client_config['IPFS_GATEWAY_PORT']):
-
-            log(INFO, f"Starting IPFS daemon")
-            self._ipfs_daemon = Popen(
-                ['./ipfs.sh', 'setup'],
-                env=associated_client_config,
-            )
-
-            time.sleep(5)
-
-        ipfs_client = ipfshttpclient.Client(f"/ip4/{associated_client_config['IPFS_HOST']}/tcp/{int(associated_client_config['IPFS_API_PORT'])}/http")
-        ipfs_id = dict(ipfs_client.id())
-        
-        s_target = associated_client_config["IPFS_SWARM_TARGET"]
-        if ipfs_id['Addresses'][0] != s_target:
-            log(f"Connecting to {s_target}")
-            ipfs_client.swarm.connect(s_target)
+        ipfs_client = self.ipfs_client or self._connect_ipfs(associated_client_config)
 
         # Get the latest checkpoint from the global checkpoint ledger
         client_name = "User1@" + associated_client_config["PEER_DOMAIN"]
         latest_cps = query_model(f"{cfg.CHECKPOINTS_QUERY_URL}latestcheckpoint", CHANNEL_NAME, CHAINCODE_NAME, CONTRACT_NAME, client_name)
         self.latest_checkpoint = latest_cps if len(latest_cps) > 0 else None
         history = BFLHistory()
+        self._session_closed = False
 
         self.fed_session = self.latest_checkpoint["FedSession"] + 1 if self.latest_checkpoint != None else 1
         self.strategy.set_fed_session(self.fed_session)
+        self._save_preprocessor(ipfs_client)
 
         # Initialize parameters
         log(INFO, "Initializing global parameters")
-        self.parameters = self._get_initial_parameters(timeout, ipfs_client)
+        with profiler.span("initial_parameters", cat="server"):
+            self.parameters = self._get_initial_parameters(timeout, ipfs_client)
         log(INFO, f"Waiting for enough cients to join ({self.strategy.min_available_clients})")
 
         self.client_manager().wait_for(self.strategy.min_available_clients)
         log(INFO, "FL starting")
         start_time = timeit.default_timer()
 
-        for current_round in range(1, num_rounds + 1):
-            # Train model and replace previous global model
-            res_fit = self.fit_round(
-                server_round=current_round,
-                timeout=timeout,
+        # Global models are saved and registered in the background while the next round trains. At most
+        # PUBLISH_MAX_ROUNDS rounds, counting the one being published, wait before the training loop blocks.
+        publisher = Publisher("server-publisher", max_pending=cfg.PUBLISH_MAX_ROUNDS, retries=cfg.PUBLISH_RETRIES)
+        eval_executor = None
+        if self.strategy.evaluate_fn is not None:
+            eval_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="central-eval")
+
+        def publish(server_round: int, parameters: Parameters, metrics: Callable[[], Optional[Tuple[float, float]]]):
+            # The upload and the ledger transaction are retried separately, metrics() returns the accuracy and loss
+            # posted with the model, None to skip it. Models waiting to be posted share one ledger request.
+            prefix = f"gmodel_fs{self.fed_session}_r{server_round}"
+            publisher.submit(
+                lambda: self._upload_global_model(ipfs_client, server_round, parameters, prefix, client_name, metrics),
+                description=prefix,
+                batch=self._post_global_models
             )
-            if res_fit is not None:
-                parameters_prime, _, _ = res_fit  # fit_metrics_aggregated
-                if parameters_prime:
-                    self.parameters = parameters_prime
-
-            # Evaluate model on a sample of available clients
-            res_fed = self.evaluate_round(server_round=current_round, timeout=timeout)
-            if res_fed is not None:
-                loss_fed, evaluate_metrics_fed, _ = res_fed
-                if loss_fed is not None:
-                    history.add_loss_distributed(
-                        server_round=current_round, loss=loss_fed
-                    )
-                    history.add_metrics_distributed(
-                        server_round=current_round, metrics=evaluate_metrics_fed
+
+        def evaluated(evaluation: concurrent.futures.Future) -> Optional[Tuple[float, float]]:
+            res = evaluation.result()
+            if res is None:
+                return None
+            loss, metrics = res
+            return metrics["accuracy"], loss
+
+        if isinstance(self.strategy, BFedBuff):
+            # Rounds are global model versions, published every ASYNC_PUBLISH_EVERY versions with the metrics the
+            # clients reported for their updates
+            def on_version(version: int, metrics: Dict[str, Scalar]):
+                if "loss" not in metrics:
+                    return
+                history.add_loss_distributed(server_round=version, loss=metrics["loss"])
+                history.add_metrics_distributed(server_round=version, metrics=metrics)
+                if version % cfg.ASYNC_PUBLISH_EVERY == 0 or version == num_rounds:
+                    publish(version, self.parameters, lambda: (metrics["accuracy"], metrics["loss"]))
+
+            self.fit_async(num_rounds, timeout, on_version)
+        else:
+            for current_round in range(1, num_rounds + 1):
+                # Train model and replace previous global model
+                with profiler.in_round(current_round), profiler.span("fit_round", cat="server"):
+                    res_fit = self.fit_round(
+                        server_round=current_round,
+                        timeout=timeout,
                     )
+                if res_fit is not None:
+                    parameters_prime, fit_metrics, _ = res_fit
+                    if parameters_prime:
+                        self.parameters = parameters_prime
+                    history.add_metrics_distributed_fit(server_round=current_round, metrics=fit_metrics)
+
+                # Evaluate the global model on the held-out split while the next round trains, its metrics are the
+                # ones posted to the blockchain
+                if eval_executor is not None:
+                    evaluation = eval_executor.submit(self._evaluate_centralized, current_round, self.parameters, history)
+                    publish(current_round, self.parameters, lambda evaluation=evaluation: evaluated(evaluation))
+
+                # Evaluate model on a sample of available clients, every DIST_EVAL_EVERY rounds and after the last one
+                if not cfg.DIST_EVAL_EVERY or (current_round % cfg.DIST_EVAL_EVERY != 0 and current_round != num_rounds):
+                    continue
+                with profiler.span("evaluate_round", cat="server", server_round=current_round):
+                    res_fed = self.evaluate_round(server_round=current_round, timeout=timeout)
+                if res_fed is not None:
+                    loss_fed, evaluate_metrics_fed, _ = res_fed
+                    if loss_fed is not None:
+                        history.add_loss_distributed(
+                            server_round=current_round, loss=loss_fed
+                        )
+                        history.add_metrics_distributed(
+                            server_round=current_round, metrics=evaluate_metrics_fed
+                        )
             
-                    # Post global model to blockchain
-                    self.model.set_weights(parameters_to_ndarrays(self.parameters))
-                    prefix = f"gmodel_fs{self.fed_session}_r{current_round}"
-                    file_name = f"{prefix}.keras"
-                    cid = save_params(os.path.join(self.temp_model_file_path, file_name), ipfs_client, self.model)
-                    self._post_global_round_model(server_round=current_round, parameters=self.parameters, ipfs_url=f"/ipfs/{cid}", model_prefix=prefix, client_name=client_name, accuracy=evaluate_metrics_fed["accuracy"], loss=loss_fed)
+                        # Post global model to blockchain
+                        if eval_executor is None:
+                            publish(current_round, self.parameters,
+                                    lambda accuracy=evaluate_metrics_fed["accuracy"], loss=loss_fed: (accuracy, loss))
+
+        if eval_executor is not None:
+            eval_executor.shutdown(wait=True)
 
         # Round finished, clear parameters from memory
         self.parameters = None
 
-        # Close the client after use
-        ipfs_client.close()
+        # Wait for the remaining global models to be published, then close the client after use
+        log(INFO, f"Waiting for {publisher.pending} global models to be published")
+        publisher.close()
+        if self.ipfs_client is None:
+            ipfs_client.close()
+
+        # Results which missed their round, with the round they were folded into, if any
+        self._drain_stragglers()
+        history.late_arrivals = list(self.strategy.late_arrivals)
+        if self._fit_executor is not None:
+            self._fit_executor.shutdown(wait=False)
+            self._fit_executor = None
 
         # Bookkeeping
         end_time = timeit.default_timer()
         elapsed = end_time - start_time
         history.set_elapsed(elapsed)
+        history.add_spans(profiler.spans())
         log(INFO, "FL finished in %s", elapsed)
         return history
     
+    def _connect_ipfs(self, associated_client_config: dict) -> ipfshttpclient.Client:
+        """Connect to the IPFS daemon of the associated client, starting it if needed."""
+        if not self._is_port_in_use(associated_client_config['IPFS_GATEWAY_PORT']):
+
+            log(INFO, f"Starting IPFS daemon")
+            self._ipfs_daemon = Popen(
+                ['./ipfs.sh', 'setup'],
+                env=associated_client_config,
+            )
+
+            time.sleep(5)
+
+        ipfs_client = ipfshttpclient.Client(f"/ip4/{associated_client_config['IPFS_HOST']}/tcp/{int(associated_client_config['IPFS_API_PORT'])}/http")
+        ipfs_id = dict(ipfs_client.id())
+        
+        s_target = associated_client_config["IPFS_SWARM_TARGET"]
+        if ipfs_id['Addresses'][0] != s_target:
+            log(f"Connecting to {s_target}")
+            ipfs_client.swarm.connect(s_target)
+        return ipfs_client
+
+    def fit_round(self, server_round: int, timeout: float | None):
+        """Perform a single round of federated averaging, folding each result into the aggregate as it arrives."""
+
+        client_instructions = self.strategy.configure_fit(
+            server_round=server_round,
+            parameters=self.parameters,
+            client_manager=self._client_manager,
+        )
+        client_instructions = [(client, self._by_reference(ins)) for client, ins in client_instructions]
+        if not client_instructions:
+            log(INFO, "fit_round %s: no clients selected, cancel", server_round)
+            return None
+        log(DEBUG, "fit_round %s: strategy sampled %s clients (out of %s)", server_round, len(client_instructions), self._client_manager.num_available())
+
+        # Aggregation overlaps with stragglers and each client's tensors are released once folded in. The executor
+        # outlives the round so that stragglers of a round closed early keep running and report late.
+        if self._fit_executor is None:
+            self._fit_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {}
+        for client, ins in client_instructions:
+            self.strategy.busy[client.cid] = server_round
+            futures[self._fit_executor.submit(fit_client, client, ins, timeout)] = client
+
+        # The round closes once every client reported, once the quorum reported, or at the deadline if at least one
+        # client reported
+        quorum = max(1, math.ceil(self.strategy.quorum * len(futures)))
+        deadline = None
+        if self.strategy.round_deadline is not None:
+            deadline = timeit.default_timer() + self.strategy.round_deadline
+
+        results, failures = [], []
+        pending = set(futures)
+        while pending:
+            # Past the deadline without any result, the round waits for the first one
+            now = timeit.default_timer()
+            wait_timeout = None if deadline is None or now >= deadline else deadline - now
+            done, pending = concurrent.futures.wait(pending, timeout=wait_timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                self.strategy.release(futures[future].cid)
+                if future.exception() is not None:
+                    failures.append(future.exception())
+                    continue
+                client, fit_res = future.result()
+                if fit_res.status.code != Code.OK:
+                    failures.append((client, fit_res))
+                    continue
+                with profiler.span("aggregate", cat="server", cid=client.cid):
+                    self.strategy.accumulate_fit(server_round, client, fit_res)
+                results.append((client, fit_res))
+
+            if len(results) >= quorum or (deadline is not None and timeit.default_timer() >= deadline and results):
+                break
+
+        if pending:
+            log(INFO, "fit_round %s closed with %s of %s clients", server_round, len(results), len(futures))
+            with self._late_lock:
+                self._stragglers.update(pending)
+            for future in pending:
+                future.add_done_callback(
+                    lambda future, client=futures[future]: self._on_late_fit(server_round, client, future)
+                )
+
+        log(DEBUG, "fit_round %s received %s results and %s failures", server_round, len(results), len(failures))
+
+        with profiler.span("aggregate", cat="server"):
+            parameters_aggregated, metrics_aggregated = self.strategy.finish_fit(server_round, results, failures)
+        return parameters_aggregated, metrics_aggregated, (results, failures)
+
+    def fit_async(self, num_versions: int, timeout: float | None, on_version: Callable[[int, Dict[str, Scalar]], None]):
+        """Train asynchronously until ``num_versions`` global versions were produced.
+
+        Every client is dispatched with the current global version and redispatched as soon as its update is
+        buffered, so fast clients never wait for slow ones. The strategy turns every ``buffer_size`` updates into a new
+        version, after which ``on_version`` is called with the version and the aggregated fit metrics. A client whose
+        fit fails is redispatched after an exponential backoff, and dropped after ASYNC_MAX_RETRIES failures in a row
+        or once it disconnected.
+        """
+        clients = self._client_manager.sample(
+            num_clients=self._client_manager.num_available(), min_num_clients=self.strategy.min_available_clients
+        )
+        version = 0
+        current = parameters_to_ndarrays(self.parameters)
+        # Parameters of the versions clients are training on, released once no client uses them anymore
+        bases: Dict[int, NDArrays] = {version: current}
+        in_flight: Dict[concurrent.futures.Future, Tuple[ClientProxy, int]] = {}
+
+        # Consecutive failures per client, and the clients waiting to be redispatched by the time they are due
+        failures: Dict[str, int] = {}
+        retries: List[Tuple[float, ClientProxy]] = []
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+        def dispatch(client: ClientProxy):
+            ins = self._by_reference(self.strategy.configure_client(version, self.parameters))
+            in_flight[executor.submit(fit_client, client, ins, timeout)] = (client, version)
+
+        def retry(client: ClientProxy, reason):
+            failures[client.cid] = failures.get(client.cid, 0) + 1
+            if failures[client.cid] > cfg.ASYNC_MAX_RETRIES:
+                log(ERROR, f"Client {client.cid} failed {failures[client.cid]} times in a row, no longer dispatched: {reason}")
+                return
+            delay = cfg.ASYNC_RETRY_BACKOFF * 2 ** (failures[client.cid] - 1)
+            log(WARNING, f"Client {client.cid} failed ({reason}), redispatched in {delay}s")
+            retries.append((timeit.default_timer() + delay, client))
+
+        for client in clients:
+            dispatch(client)
+
+        while (in_flight or retries) and version < num_versions:
+            if retries:
+                retries.sort(key=lambda retry: retry[0])
+                wait_timeout = max(0.0, retries[0][0] - timeit.default_timer())
+            else:
+                wait_timeout = None
+            if in_flight:
+                done, _ = concurrent.futures.wait(in_flight, timeout=wait_timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            else:
+                # Only clients waiting for their retry are left
+                done = set()
+                time.sleep(wait_timeout)
+            now = timeit.default_timer()
+            while retries and retries[0][0] <= now:
+                _, client = retries.pop(0)
+                if client.cid in self._client_manager.all():
+                    dispatch(client)
+                else:
+                    log(INFO, f"Client {client.cid} disconnected, no longer dispatched")
+
+            for future in done:
+                client, base_version = in_flight.pop(future)
+                if future.exception() is not None:
+                    retry(client, future.exception())
+                    continue
+                _, fit_res = future.result()
+                if fit_res.status.code != Code.OK:
+                    retry(client, fit_res.status.message)
+                    continue
+                failures.pop(client.cid, None)
+                if version < num_versions:
+                    with profiler.span("aggregate", cat="server", server_round=version + 1, cid=client.cid):
+                        full = self.strategy.add_update(version, base_version, bases[base_version], client, fit_res)
+                    if full:
+                        with profiler.span("aggregate", cat="server", server_round=version + 1):
+                            current, metrics = self.strategy.apply_updates(current)
+                        version += 1
+                        self.parameters = ndarrays_to_parameters(current)
+                        bases[version] = current
+                        log(INFO, f"Global version {version} built from client updates")
+                        on_version(version, metrics)
+                if version < num_versions:
+                    dispatch(client)
+
+            in_use = {base_version for _, base_version in in_flight.values()}
+            bases = {v: params for v, params in bases.items() if v in in_use or v == version}
+
+        if version < num_versions:
+            log(ERROR, f"No clients left to train, stopped at global version {version}")
+
+        # Updates still in flight were trained on outdated versions and are discarded, the session does not wait for
+        # them and fits not started yet are cancelled
+        log(DEBUG, f"Discarding the updates of {len(in_flight)} clients still training")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_late_fit(self, server_round: int, client: ClientProxy, future: concurrent.futures.Future):
+        with self._late_lock:
+            self._stragglers.discard(future)
+            if self._session_closed:
+                return
+            if future.exception() is None:
+                _, fit_res = future.result()
+                if fit_res.status.code == Code.OK:
+                    self.strategy.add_late_result(server_round, client, fit_res)
+            self.strategy.release(client.cid)
+
+    def _drain_stragglers(self):
+        """Wait for the clients still training for a closed round, at most ``round_deadline`` seconds, then record
+        their results and the late results no round folded in as dropped."""
+        with self._late_lock:
+            stragglers = set(self._stragglers)
+        if stragglers:
+            log(INFO, f"Waiting for {len(stragglers)} clients still training for a closed round")
+            concurrent.futures.wait(stragglers, timeout=self.strategy.round_deadline)
+        with self._late_lock:
+            self._session_closed = True
+            self.strategy.drop_late_results(list(self.strategy.busy.items()))
+
+    def _by_reference(self, ins: FitIns) -> FitIns:
+        """Send the global checkpoint the session resumed from by its IPFS path and hash instead of its parameters.
+
+        Clients load it from their local checkpoint cache, or from IPFS on a miss, and verify it against the hash.
+        """
+        if self._restored is None or ins.parameters is not self._restored[0]:
+            return ins
+        _, url, hash = self._restored
+        return FitIns(Parameters(tensors=[], tensor_type=ins.parameters.tensor_type),
+                      dict(ins.config, checkpoint_url=url, checkpoint_hash=hash))
+
     def _get_initial_parameters(self, timeout: float | None, ipfs_client: ipfshttpclient.Client = None) -> Parameters:
         """Get initial parameters from one of the available clients."""
 
-        if self.latest_checkpoint and self.ipfs_client:
+        if self.latest_checkpoint and ipfs_client:
             log(INFO, "Retrieving parameters from the latest checkpoint")
-            with open(self.temp_model_file_path, 'wb+') as f:
-                f.write(ipfs_client.cat(self.latest_checkpoint["URL"]))
-                f.flush()
-                f.close()
-                self.model.load_weights(self.temp_model_file_path)
-                return ndarrays_to_parameters(self.model.get_weights())
+            parameters = ndarrays_to_parameters(load_params(ipfs_client, self.latest_checkpoint["URL"], self.model,
+                                                            expected_hash=self.latest_checkpoint["Hash"], cache=self.checkpoint_cache))
+            if cfg.FIT_BY_REFERENCE:
+                self._restored = (parameters, self.latest_checkpoint["URL"], self.latest_checkpoint["Hash"])
+            return parameters
 
         # Server-side parameter initialization
         parameters: Parameters | None = self.strategy.initialize_parameters(
@@ -169,36 +463,91 @@ class BFLServer(Server):
         return get_parameters_res.parameters
 
 
-    def _post_global_round_model(
-            self, server_round: int, parameters: Parameters, ipfs_url: str, model_prefix: str, client_name: str, accuracy: float, loss: float
-    ) -> str:
-        """Post a global model to the hyperledger fabric ledger via a smart contract"""
-        hash = hash_params(parameters)
-        model_id = f"{model_prefix}_{hash}"
-        resp = post_model(req_url=f"{cfg.CHECKPOINTS_INVOKE_URL}create",
-                   id=model_id,
-                   hash=hash,
-                   url=ipfs_url,
-                   accuracy=accuracy,
-                   algorithm=self.algorithm,
-                   loss=loss,
-                   fed_round=server_round,
-                   fed_session=self.fed_session,
-                   channel_name=CHANNEL_NAME,
-                   chaincode_name=CHAINCODE_NAME,
-                   contract_name=CONTRACT_NAME,
-                   client=client_name
-        )
-
+    def _save_preprocessor(self, ipfs_client: ipfshttpclient.Client):
+        """Version the preprocessing statistics of this session alongside its global model checkpoints.
+
+        The IPFS path and digest of the statistics are added to the metadata of every global checkpoint, where
+        consumers of the models such as ``serve`` find them.
+        """
+        self.checkpoint_metadata = {}
+        if not os.path.isfile(csvfile(DATA_ROOT, True)):
+            log(INFO, "No dataset found, skipping preprocessor export")
+            return
+
+        preprocessor = load_preprocessor(DATA_ROOT, cfg.DATA_CHUNK_SIZE or None)
+        os.makedirs(self.temp_model_file_path, exist_ok=True)
+        filepath = os.path.join(self.temp_model_file_path, f"preprocessor_fs{self.fed_session}.json")
+        preprocessor.save(filepath)
+        cid = ipfs_client.add(filepath)['Hash']
+        self.checkpoint_metadata = {"preprocessor": f"/ipfs/{cid}", "preprocessor_digest": preprocessor.digest()}
+        log(INFO, f"Preprocessor {preprocessor.digest()} of session {self.fed_session} saved to /ipfs/{cid}")
+
+    def _upload_global_model(
+            self, ipfs_client: ipfshttpclient.Client, server_round: int, parameters: Parameters, model_prefix: str,
+            client_name: str, metrics: Callable[[], Optional[Tuple[float, float]]]
+    ) -> Optional[dict]:
+        """Save a global model to IPFS once its metrics are known. Runs on the publisher thread.
+
+        Returns:
+            Optional[dict]: The arguments of ``post_model`` registering the model, None if the model has no metrics to
+                be published with.
+        """
+        res = metrics()
+        if res is None:
+            return None
+        accuracy, loss = res
+        with profiler.in_round(server_round), profiler.span("publish_upload", cat="server"):
+            ndarrays = cast_floats(parameters_to_ndarrays(parameters), cfg.CHECKPOINT_DTYPE)
+            file_path = os.path.join(self.temp_model_file_path, f"{model_prefix}.npz") if cfg.KEEP_LOCAL_CHECKPOINTS else None
+            hash = hash_params(ndarrays)
+            cid = save_params(ipfs_client, ndarrays, file_path, cache=self.checkpoint_cache, metadata=self.checkpoint_metadata,
+                              hash=hash)
+        return dict(id=f"{model_prefix}_{hash}", hash=hash, url=f"/ipfs/{cid}", accuracy=accuracy, loss=loss,
+                    fed_round=server_round, client=client_name)
+
+    def _post_global_models(self, uploads: List[Optional[dict]]):
+        """Post global models saved by ``_upload_global_model`` to the ledger, in one request when several are
+        waiting. Runs on the publisher thread."""
+        uploads = [upload for upload in uploads if upload is not None]
+        if not uploads:
+            return
+        ledger = dict(channel_name=CHANNEL_NAME, chaincode_name=CHAINCODE_NAME, contract_name=CONTRACT_NAME,
+                      client=uploads[0]["client"], query_url=cfg.CHECKPOINTS_QUERY_URL)
+        with profiler.span("publish_post", cat="server", count=len(uploads)):
+            if len(uploads) == 1:
+                upload = uploads[0]
+                resp = post_model(req_url=f"{cfg.CHECKPOINTS_INVOKE_URL}create", id=upload["id"], hash=upload["hash"],
+                                  url=upload["url"], algorithm=self.algorithm, accuracy=upload["accuracy"],
+                                  loss=upload["loss"], fed_round=upload["fed_round"], fed_session=self.fed_session,
+                                  **ledger)
+            else:
+                checkpoints = [
+                    checkpoint_data(upload["id"], upload["hash"], upload["url"], self.algorithm, upload["accuracy"],
+                                    upload["loss"], upload["fed_round"], self.fed_session)
+                    for upload in uploads
+                ]
+                resp = post_models(f"{cfg.CHECKPOINTS_INVOKE_URL}createBatch", checkpoints, self.fed_session, **ledger)
         log(INFO, str(resp))
 
+    def _evaluate_centralized(self, server_round: int, parameters: Parameters, history: History):
+        """Evaluate a global model with the strategy's centralized evaluation. Runs on the evaluation thread."""
+        with profiler.span("central_eval", cat="server", server_round=server_round):
+            res = self.strategy.evaluate(server_round, parameters=parameters)
+        if res is None:
+            return None
+        loss, metrics = res
+        history.add_loss_centralized(server_round=server_round, loss=loss)
+        history.add_metrics_centralized(server_round=server_round, metrics=metrics)
+        log(INFO, f"Round {server_round} - Centralized Evaluation - Loss: {loss:.6f} - Accuracy: {metrics['accuracy']:.6f}")
+        return loss, metrics
+
     def _is_port_in_use(self, port):
         import socket
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             return s.connect_ex(('localhost', int(port))) == 0
 
 def client_fn(cid: str):
-    X_train, X_test, y_train, y_test = load_data(DATA_ROOT, cfg.NUM_CLIENTS, int(cid))
+    X_train, y_train, X_test, y_test = load_client_data(cid)
     model = net.get_model()
 
     # Start client
@@ -206,6 +555,22 @@ def client_fn(cid: str):
     client = BFLClient(cid, model, x_train=X_train, x_test=X_test, y_train=y_train, y_test=y_test)
     return client
 
+def get_evaluate_fn():
+    """Return the centralized evaluation function, loading the held-out split and a model on its first call."""
+    state = {}
+
+    def evaluate(server_round: int, parameters: NDArrays, config: Dict[str, Scalar]):
+        if not state:
+            x, y = load_holdout(DATA_ROOT, cfg.EVAL_HOLDOUT_SIZE, chunksize=cfg.DATA_CHUNK_SIZE or None)
+            state["model"] = net.get_model()
+            state["dataset"] = make_dataset(x, y, eval_batch_size, cache=True)
+        model = state["model"]
+        model.set_weights(parameters)
+        loss, accuracy, specificity, sensitivity = model.evaluate(state["dataset"], verbose=0)
+        return loss, {"accuracy": float(accuracy), "specificity": float(specificity), "sensitivity": float(sensitivity)}
+
+    return evaluate
+
 def fit_config_fn(server_round: int, fed_session: int):
     config = {
         'server_round': server_round,
@@ -219,32 +584,47 @@ def evaluate_config_fn(server_round: int):
     }
     return config
 
-def eval_metrics_aggregation_fn(results: List[Tuple[int, Metrics]]):
-    # Weigh accuracy of each client by number of examples used
-    metrics_sum = {}
-    for num, metrics in results:
-        for metric in metrics:
-            metrics_sum[metric] = (metrics_sum.get(metric) or 0) + metrics[metric] * num
-    examples = [num for num, _ in results]
-
-    # Aggregate and print custom metric
-    res = {key: metric/sum(examples) for key, metric in metrics_sum.items()}
-    return res
-
-strategy = BFedAvg(
+strategy_kwargs = dict(
     min_fit_clients=cfg.NUM_CLIENTS,
     min_evaluate_clients=cfg.NUM_CLIENTS,
     min_available_clients=cfg.NUM_CLIENTS,
     on_fit_config_fn=fit_config_fn,
     on_evaluate_config_fn=evaluate_config_fn,
-    evaluate_metrics_aggregation_fn=eval_metrics_aggregation_fn
+    evaluate_fn=get_evaluate_fn() if cfg.CENTRAL_EVAL else None,
+    evaluate_metrics_aggregation_fn=MetricsAggregator(cfg.METRICS_EXTRA),
+    fit_metrics_aggregation_fn=MetricsAggregator(cfg.METRICS_EXTRA),
+    quorum=cfg.ROUND_QUORUM,
+    round_deadline=cfg.ROUND_DEADLINE or None,
+    staleness_alpha=cfg.STALENESS_ALPHA,
+    compression=compression_config(cfg.UPDATE_COMPRESSION, cfg.UPDATE_DELTA, cfg.TOPK_RATIO)
 )
 
+if cfg.FL_MODE == "ASYNC":
+    strategy = BFedBuff(
+        buffer_size=cfg.ASYNC_BUFFER_SIZE,
+        server_lr=cfg.ASYNC_SERVER_LR,
+        staleness_exponent=cfg.ASYNC_STALENESS_EXPONENT,
+        max_staleness=cfg.ASYNC_MAX_STALENESS,
+        **strategy_kwargs
+    )
+else:
+    strategy = BFedAvg(**strategy_kwargs)
+
 if __name__ == "__main__":
     print(f"Starting server at {cfg.S_ADDR}")
-    if cfg.WORK_ENV == "TEST" or cfg.WORK_ENV == "SIM":
+    history = None
+    if cfg.WORK_ENV == "SIM":
+        # Build the dataset cache once, before the workers memory-map it
+        load_preprocessor(DATA_ROOT, chunksize=cfg.DATA_CHUNK_SIZE or None)
+        history = run_simulation(
+            BFLServer('1', "BiLSTM", SAVE_DIR, strategy=strategy, client_manager=BFLClientManager()),
+            num_clients=cfg.NUM_CLIENTS,
+            num_rounds=cfg.NUM_ROUNDS,
+            num_workers=cfg.SIM_WORKERS
+        )
+    elif cfg.WORK_ENV == "TEST":
         histories = []
-        histories.append(fl.simulation.start_simulation(
+        history = fl.simulation.start_simulation(
             client_fn = client_fn,
             clients_ids= [str(i) for i in range(1, cfg.NUM_CLIENTS + 1)],
             strategy = strategy,
@@ -252,7 +632,8 @@ if __name__ == "__main__":
             server = BFLServer('1', "BiLSTM", SAVE_DIR, strategy=strategy, client_manager=BFLClientManager()),
             config = fl.server.ServerConfig(num_rounds=cfg.NUM_ROUNDS),
             client_resources=None,
-        ))
+        )
+        histories.append(history)
         
         # with open(f"./plotter/histories/hist_2", 'wb') as f:
         #     pickle.dump(histories, f)
@@ -261,7 +642,7 @@ if __name__ == "__main__":
         # times = np.array([history.elapsed for history in histories])
         # plot_time(times, cfg.NUM_RUNS)
     elif cfg.WORK_ENV == "PROD":
-        fl.server.start_server(
+        history = fl.server.start_server(
             server_address=cfg.S_ADDR,
             server=BFLServer('1', "BiLSTM", strategy=strategy, client_manager=BFLClientManager()),
             strategy=strategy, 
@@ -270,3 +651,6 @@ if __name__ == "__main__":
     else:
         print(f"Invalid working value ${cfg.WORK_ENV}!")
         exit(1)
+
+    if cfg.PROFILE_DIR and isinstance(history, BFLHistory):
+        profiler.export_chrome_trace(os.path.join(cfg.PROFILE_DIR, "server.json"), spans=history.spans)
@@ -0,0 +1,230 @@
+"""Multi-process simulation engine.
+
+Virtual clients are hosted by a fixed pool of worker processes. Each worker loads the partitions of its clients and
+builds their model once, then serves fit and evaluate jobs for the whole run, so the cost of a simulated round is
+training rather than setup. Every client is registered with the server as a ``ProcessClientProxy`` forwarding calls
+to its worker.
+"""
+import multiprocessing as mp
+import os
+import threading
+from logging import ERROR, INFO
+from typing import Dict, List, Optional
+
+from flwr.common import (
+    DisconnectRes, EvaluateIns, EvaluateRes, FitIns, FitRes, GetParametersIns, GetParametersRes, GetPropertiesIns,
+    GetPropertiesRes, ReconnectIns,
+)
+from flwr.common.logger import log
+from flwr.server import History, Server
+from flwr.server.client_proxy import ClientProxy
+
+
+def _worker_main(conn, cids: List[str], intra_op_threads: int):
+    """Entry point of a worker process: build the clients of ``cids`` once, then serve jobs until told to stop."""
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+
+    from flwr.client.app import to_client
+    import models.net as net
+    from client import BFLClient, load_client_data
+    from utils.profiler import profiler
+
+    numpy_clients = {}
+    for cid in cids:
+        x_train, y_train, x_test, y_test = load_client_data(cid, shared=True)
+        with profiler.span("build_model", cat="client", cid=cid):
+            model = net.get_model()
+        numpy_clients[cid] = BFLClient(cid, model, x_train, y_train, x_test, y_test)
+    clients = {cid: to_client(client) for cid, client in numpy_clients.items()}
+    conn.send(True)
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        cid, method, ins = job
+        try:
+            conn.send((True, getattr(clients[cid], method)(ins)))
+        except Exception as err:
+            conn.send((False, f"{type(err).__name__}: {err}"))
+
+    # Pending uploads are flushed before the gateways and IPFS daemons are stopped. A failure of one client does not
+    # keep the others running, and is reported to the parent with the spans.
+    errors = []
+    for cid, client in numpy_clients.items():
+        try:
+            client.terminate()
+        except BaseException as err:
+            errors.append(f"Client {cid} failed to terminate: {type(err).__name__}: {err}")
+    conn.send((profiler.spans(), errors))
+
+
+class _Worker:
+    def __init__(self, context, cids: List[str], intra_op_threads: int):
+        self.cids = cids
+        self.conn, self._child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(self._child_conn, cids, intra_op_threads), name=f"sim-worker-{cids[0]}",
+            daemon=True
+        )
+        # A worker runs one job at a time, calls for its clients queue up here
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process.start()
+        # Only the worker holds its end from now on, so that reads get EOFError once it died
+        self._child_conn.close()
+
+    def wait_ready(self):
+        """Wait until the worker built its clients.
+
+        Raises:
+            RuntimeError: If the worker died while starting, e.g. failing to load the data of a client.
+        """
+        try:
+            self.conn.recv()
+        except EOFError:
+            self.process.join()
+            raise RuntimeError(f"Worker {self.process.name} failed to start (exit code {self.process.exitcode})") from None
+
+    def call(self, cid: str, method: str, ins):
+        # Timeouts are not enforced, a late answer would be read as the answer to the next job
+        with self.lock:
+            self.conn.send((cid, method, ins))
+            ok, res = self.conn.recv()
+        if not ok:
+            raise RuntimeError(f"Client {cid} failed to {method}: {res}")
+        return res
+
+
+class ProcessClientProxy(ClientProxy):
+    """Proxy of a virtual client hosted by a worker process of the ``SimulationEngine``."""
+
+    def __init__(self, cid: str, worker: _Worker):
+        super().__init__(cid)
+        self.worker = worker
+
+    def get_properties(self, ins: GetPropertiesIns, timeout: Optional[float]) -> GetPropertiesRes:
+        return self.worker.call(self.cid, "get_properties", ins)
+
+    def get_parameters(self, ins: GetParametersIns, timeout: Optional[float]) -> GetParametersRes:
+        return self.worker.call(self.cid, "get_parameters", ins)
+
+    def fit(self, ins: FitIns, timeout: Optional[float]) -> FitRes:
+        return self.worker.call(self.cid, "fit", ins)
+
+    def evaluate(self, ins: EvaluateIns, timeout: Optional[float]) -> EvaluateRes:
+        return self.worker.call(self.cid, "evaluate", ins)
+
+    def reconnect(self, ins: ReconnectIns, timeout: Optional[float]) -> DisconnectRes:
+        return DisconnectRes(reason="")
+
+
+class SimulationEngine:
+    """Pool of worker processes hosting ``num_clients`` virtual clients with ids "1" to ``num_clients``."""
+
+    def __init__(self, num_clients: int, num_workers: int = 0):
+        """
+        Args:
+            num_clients (int): Number of virtual clients.
+            num_workers (int): Number of worker processes, 0 for one per CPU. Never more than ``num_clients``.
+                Defaults to 0.
+        """
+        self.num_clients = num_clients
+        self.num_workers = max(1, min(num_workers or os.cpu_count() or 1, num_clients))
+        self._workers: List[_Worker] = []
+        # Errors reported by the workers on shutdown
+        self.errors: List[str] = []
+
+    def start(self) -> Dict[str, ProcessClientProxy]:
+        """Spawn the workers, wait until their clients are built and return the proxies of the clients by id."""
+        # Spawned rather than forked, TensorFlow does not survive a fork
+        context = mp.get_context("spawn")
+        intra_op_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+        cids = [str(i) for i in range(1, self.num_clients + 1)]
+        self._workers = [
+            _Worker(context, cids[i::self.num_workers], intra_op_threads) for i in range(self.num_workers)
+        ]
+        try:
+            for worker in self._workers:
+                worker.start()
+            for worker in self._workers:
+                worker.wait_ready()
+        except BaseException:
+            # Workers still building their clients cannot be told to stop yet
+            for worker in self._workers:
+                if worker.process.is_alive():
+                    worker.process.kill()
+                    worker.process.join()
+            self._workers = []
+            raise
+        log(INFO, f"Simulation engine started {self.num_clients} clients on {self.num_workers} workers")
+        return {cid: ProcessClientProxy(cid, worker) for worker in self._workers for cid in worker.cids}
+
+    def shutdown(self, timeout: float = 60.0) -> List[dict]:
+        """Stop the workers once their clients flushed their pending uploads.
+
+        Failures of the workers and of their clients are logged and kept in ``errors`` rather than raised, so that
+        they never hide an error of the server.
+
+        Args:
+            timeout (float): Seconds to wait for a worker to exit after it reported, before killing it.
+                Defaults to 60.0.
+
+        Returns:
+            List[dict]: The timing spans recorded by the clients, see ``utils.profiler``.
+        """
+        spans = []
+        for worker in self._workers:
+            if not worker.process.is_alive():
+                continue
+            try:
+                with worker.lock:
+                    worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            try:
+                worker_spans, errors = worker.conn.recv()
+                spans.extend(worker_spans)
+                self.errors.extend(errors)
+            except (EOFError, OSError):
+                self.errors.append(f"Worker {worker.process.name} exited with code {worker.process.exitcode} before reporting")
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+            worker.conn.close()
+        for error in self.errors:
+            log(ERROR, error)
+        self._workers = []
+        return spans
+
+
+def run_simulation(server: Server, num_clients: int, num_rounds: int, num_workers: int = 0) -> History:
+    """Run a federated learning session of ``server`` with virtual clients hosted by a ``SimulationEngine``.
+
+    Args:
+        server (Server): The server, whose client manager the virtual clients are registered with.
+        num_clients (int): Number of virtual clients.
+        num_rounds (int): Number of rounds.
+        num_workers (int): Number of worker processes, 0 for one per CPU. Defaults to 0.
+
+    Returns:
+        History: The history of the session.
+    """
+    engine = SimulationEngine(num_clients, num_workers)
+    proxies = engine.start()
+    try:
+        for proxy in proxies.values():
+            server.client_manager().register(proxy)
+        history = server.fit(num_rounds=num_rounds, timeout=None)
+        server.disconnect_all_clients(timeout=None)
+    finally:
+        client_spans = engine.shutdown()
+    if engine.errors:
+        raise RuntimeError(f"{len(engine.errors)} simulated clients failed to terminate: {engine.errors[0]}")
+    if hasattr(history, "add_spans"):
+        history.add_spans(client_spans)
+    return history
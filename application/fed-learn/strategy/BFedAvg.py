@@ -1,13 +1,102 @@
-from typing import List, Tuple 
-from flwr.common import Parameters, FitIns
+from typing import Dict, List, Optional, Set, Tuple, Union 
+from logging import INFO, WARNING
+import math
+import threading
+from flwr.common import Parameters, EvaluateIns, FitIns, FitRes, Scalar, ndarrays_to_parameters, parameters_to_ndarrays
+from flwr.common.logger import log
+from flwr.common.typing import Config, NDArrays
 from flwr.server import ClientManager
 from flwr.server.client_proxy import ClientProxy
+from flwr.server.criterion import Criterion
 from flwr.server.strategy import FedAvg
+from strategy.aggregate import StreamingAggregator
+from utils.compression import decode_tensors
+
+# Seconds to wait for enough clients to be idle before sampling anyway, as long as Flower's ClientManager.wait_for
+IDLE_TIMEOUT = 86400
+
+class IdleCriterion(Criterion):
+    """Select clients which are not still training for an earlier round."""
+
+    def __init__(self, busy: Set[str]) -> None:
+        self.busy = busy
+
+    def select(self, client: ClientProxy) -> bool:
+        return client.cid not in self.busy
 
 class BFedAvg(FedAvg):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, quorum: float = 1.0, round_deadline: float | None = None, staleness_alpha: float = 0.0,
+                 compression: Config | None = None, **kwargs):
+        """
+        Args:
+            quorum (float): Fraction of the sampled clients whose results close a round. Defaults to 1.0.
+            round_deadline (float | None): Seconds after which a round closes with the results received so far.
+                Defaults to None.
+            staleness_alpha (float): Results arriving after their round closed are folded into the next aggregation
+                with their weight multiplied by ``staleness_alpha ** staleness``, 0 drops them. Defaults to 0.0.
+            compression (Config | None): Update compression requested from the clients, see
+                ``utils.compression.fit_config``. Defaults to None.
+        """
         super().__init__(*args, **kwargs)
         self.fed_session = 0
+        self.quorum = quorum
+        self.round_deadline = round_deadline
+        self.staleness_alpha = staleness_alpha
+        self.compression = compression or {}
+        self._aggregator: StreamingAggregator | None = None
+
+        # Global weights of the rounds clients may still send delta encoded updates for
+        self._bases: Dict[int, NDArrays] = {}
+
+        # Round of the clients still training and results which missed their round, updated from the server's worker
+        # threads
+        self.busy: Dict[str, int] = {}
+        self._idle = threading.Condition()
+        self.late_arrivals: List[Tuple[int, str, int | None]] = []
+        self._late_results: List[Tuple[int, str, NDArrays, int]] = []
+        self._late_lock = threading.Lock()
+
+    @property
+    def partial_rounds(self) -> bool:
+        return self.quorum < 1.0 or self.round_deadline is not None
+
+    def _sample(self, client_manager: ClientManager, sample_size: int, min_num_clients: int,
+                wait: bool = True) -> List[ClientProxy]:
+        """Sample clients, only among the idle ones when rounds may close before every client reported.
+
+        Args:
+            client_manager (ClientManager): The pool of clients.
+            sample_size (int): Clients wanted.
+            min_num_clients (int): Clients that must be available, as for ``ClientManager.sample``.
+            wait (bool): Wait until enough clients are idle to reach the quorum of a round of ``sample_size`` clients,
+                otherwise sample among the clients idle right now. Defaults to True.
+        """
+        if not self.partial_rounds:
+            return client_manager.sample(num_clients=sample_size, min_num_clients=min_num_clients)
+
+        def num_idle() -> int:
+            return sum(1 for cid in client_manager.all() if cid not in self.busy)
+
+        # Clients still busy with a closed round would only stall this one. A round needs no more idle clients than
+        # its quorum, waiting for all of them would bring back the wait for the slowest client.
+        required = min(max(1, math.ceil(self.quorum * sample_size)), client_manager.num_available())
+        with self._idle:
+            if wait:
+                self._idle.wait_for(lambda: num_idle() >= required, timeout=IDLE_TIMEOUT)
+            busy = set(self.busy)
+            idle = num_idle()
+        if idle == 0:
+            return []
+        return client_manager.sample(
+            num_clients=min(sample_size, idle), min_num_clients=min(min_num_clients, client_manager.num_available()),
+            criterion=IdleCriterion(busy)
+        )
+
+    def release(self, cid: str):
+        """Mark a client as idle once its result, on time or late, has been handled."""
+        with self._idle:
+            self.busy.pop(cid, None)
+            self._idle.notify_all()
 
     def configure_fit(
         self, server_round: int, parameters: Parameters, client_manager: ClientManager
@@ -17,18 +106,135 @@ class BFedAvg(FedAvg):
         if self.on_fit_config_fn is not None:
             # Custom fit config function provided
             config = self.on_fit_config_fn(server_round, self.get_fed_session())
+        config.update(self.compression)
         fit_ins = FitIns(parameters, config)
 
+        if self.compression.get("delta"):
+            in_use = set(self.busy.values())
+            self._bases = {r: base for r, base in self._bases.items() if r in in_use}
+            self._bases[server_round] = parameters_to_ndarrays(parameters)
+
         # Sample clients
         sample_size, min_num_clients = self.num_fit_clients(
             client_manager.num_available()
         )
-        clients = client_manager.sample(
-            num_clients=sample_size, min_num_clients=min_num_clients
-        )
+        clients = self._sample(client_manager, sample_size, min_num_clients)
 
         # Return client/config pairs
         return [(client, fit_ins) for client in clients]
+
+    def configure_evaluate(
+        self, server_round: int, parameters: Parameters, client_manager: ClientManager
+    ) -> List[Tuple[ClientProxy, EvaluateIns]]:
+        """Configure the next round of evaluation, skipping clients still training for a closed round."""
+        if self.fraction_evaluate == 0.0:
+            return []
+        config = {}
+        if self.on_evaluate_config_fn is not None:
+            config = self.on_evaluate_config_fn(server_round)
+        evaluate_ins = EvaluateIns(parameters, config)
+
+        sample_size, min_num_clients = self.num_evaluation_clients(
+            client_manager.num_available()
+        )
+        clients = self._sample(client_manager, sample_size, min_num_clients, wait=False)
+        return [(client, evaluate_ins) for client in clients]
+
+    def add_late_result(self, server_round: int, client: ClientProxy, fit_res: FitRes):
+        """Record a result which arrived after its round closed, to be folded into the next aggregation.
+
+        Must be called before the client is released, the global weights of its round are kept until then.
+        """
+        log(INFO, f"Client {client.cid} returned its round {server_round} result late")
+        parameters = None
+        if self.staleness_alpha > 0:
+            try:
+                parameters = list(decode_tensors(fit_res.parameters.tensors, self._bases.get(server_round)))
+            except ValueError as err:
+                log(WARNING, f"Dropping late result of client {client.cid}: {err}")
+        with self._late_lock:
+            if parameters is not None:
+                self._late_results.append((server_round, client.cid, parameters, fit_res.num_examples))
+            else:
+                self.late_arrivals.append((server_round, client.cid, None))
+
+    def _fold_late_results(self, server_round: int):
+        with self._late_lock:
+            late_results, self._late_results = self._late_results, []
+        for result_round, cid, parameters, num_examples in late_results:
+            weight = num_examples * self.staleness_alpha ** (server_round - result_round)
+            if self._aggregator is None:
+                self._aggregator = StreamingAggregator()
+            self._aggregator.add(parameters, weight)
+            self.late_arrivals.append((result_round, cid, server_round))
+
+    def drop_late_results(self, stragglers: List[Tuple[str, int]]):
+        """Record the results no round will fold in anymore, at the end of a session.
+
+        Args:
+            stragglers (List[Tuple[str, int]]): (client id, round) of the clients still training for a closed round.
+        """
+        with self._late_lock:
+            late_results, self._late_results = self._late_results, []
+            for result_round, cid, _, _ in late_results:
+                self.late_arrivals.append((result_round, cid, None))
+            for cid, result_round in stragglers:
+                self.late_arrivals.append((result_round, cid, None))
+
+    def accumulate_fit(self, server_round: int, client: ClientProxy, fit_res: FitRes):
+        """Fold a client's result into the running average as soon as it arrives and release its tensors.
+
+        Compressed updates are decoded one tensor at a time, against the global weights of the round for deltas.
+        """
+        if self._aggregator is None:
+            self._aggregator = StreamingAggregator()
+        self._aggregator.add(
+            decode_tensors(fit_res.parameters.tensors, self._bases.get(server_round)), fit_res.num_examples
+        )
+        fit_res.parameters = Parameters(tensors=[], tensor_type=fit_res.parameters.tensor_type)
+
+    def finish_fit(
+        self,
+        server_round: int,
+        results: List[Tuple[ClientProxy, FitRes]],
+        failures: List[Union[Tuple[ClientProxy, FitRes], BaseException]],
+    ) -> Tuple[Optional[Parameters], Dict[str, Scalar]]:
+        """Return the average of the results folded with ``accumulate_fit`` and their aggregated metrics.
+
+        Late results of earlier rounds are folded in here with staleness weighting, see ``staleness_alpha``.
+        """
+        if results:
+            self._fold_late_results(server_round)
+        aggregator, self._aggregator = self._aggregator, None
+        if not results or aggregator is None:
+            return None, {}
+        # Do not aggregate if there are failures and failures are not accepted
+        if not self.accept_failures and failures:
+            return None, {}
+
+        parameters_aggregated = ndarrays_to_parameters(aggregator.result())
+
+        metrics_aggregated = {}
+        if self.fit_metrics_aggregation_fn:
+            fit_metrics = [(res.num_examples, res.metrics) for _, res in results]
+            metrics_aggregated = self.fit_metrics_aggregation_fn(fit_metrics)
+        elif server_round == 1:
+            log(WARNING, "No fit_metrics_aggregation_fn provided")
+
+        return parameters_aggregated, metrics_aggregated
+
+    def aggregate_fit(
+        self,
+        server_round: int,
+        results: List[Tuple[ClientProxy, FitRes]],
+        failures: List[Union[Tuple[ClientProxy, FitRes], BaseException]],
+    ) -> Tuple[Optional[Parameters], Dict[str, Scalar]]:
+        """Aggregate fit results using weighted average, one client at a time."""
+        for client, fit_res in results:
+            if fit_res.parameters.tensors:
+                self.accumulate_fit(server_round, client, fit_res)
+        return self.finish_fit(server_round, results, failures)
+
     def set_fed_session(self, fed_session: int):
         self.fed_session = fed_session
 
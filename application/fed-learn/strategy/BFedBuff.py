@@ -0,0 +1,97 @@
+"""Buffered asynchronous federated averaging (FedBuff)."""
+from typing import Dict, List, Tuple
+from logging import INFO
+from flwr.common import FitIns, FitRes, Parameters, Scalar
+from flwr.common.logger import log
+from flwr.common.typing import NDArrays
+from flwr.server.client_proxy import ClientProxy
+from strategy.BFedAvg import BFedAvg
+from strategy.aggregate import StreamingAggregator
+from utils.compression import decode_tensors
+
+class BFedBuff(BFedAvg):
+    """Asynchronous strategy where clients train on whichever global version is current when they are dispatched.
+
+    Client updates are buffered as deltas against the version they were trained on. Once ``buffer_size`` updates
+    accumulated, their weighted average is applied to the current global model with ``server_lr``, producing the next
+    version. Each update is weighted by its number of examples times ``(1 + staleness) ** -staleness_exponent``, where
+    staleness is the number of versions published since the client was dispatched.
+    """
+
+    def __init__(self, *args, buffer_size: int = 2, server_lr: float = 1.0, staleness_exponent: float = 0.5,
+                 max_staleness: int = 0, **kwargs):
+        """
+        Args:
+            buffer_size (int): Updates applied at once to produce a new global version. Defaults to 2.
+            server_lr (float): Step size applied to the averaged delta. Defaults to 1.0.
+            staleness_exponent (float): Exponent of the polynomial staleness discount. Defaults to 0.5.
+            max_staleness (int): Updates staler than this are dropped, 0 for no limit. Defaults to 0.
+        """
+        super().__init__(*args, **kwargs)
+        self.buffer_size = buffer_size
+        self.server_lr = server_lr
+        self.staleness_exponent = staleness_exponent
+        self.max_staleness = max_staleness
+        self._buffer = StreamingAggregator()
+        self._buffer_metrics: List[Tuple[int, Dict[str, Scalar]]] = []
+
+    def configure_client(self, version: int, parameters: Parameters) -> FitIns:
+        """Instructions to train on a given global version.
+
+        The round of the fit config is the version the update is meant for, ``version + 1``, so that rounds start at 1
+        as in synchronous training, version 0 being the initial model.
+        """
+        config = {}
+        if self.on_fit_config_fn is not None:
+            config = self.on_fit_config_fn(version + 1, self.get_fed_session())
+        config.update(self.compression)
+        return FitIns(parameters, config)
+
+    def staleness_weight(self, staleness: int) -> float:
+        return (1 + staleness) ** -self.staleness_exponent
+
+    def add_update(self, version: int, base_version: int, base: NDArrays, client: ClientProxy, fit_res: FitRes) -> bool:
+        """Buffer a client's update as a delta against the version it was trained on.
+
+        Args:
+            version (int): Current global version.
+            base_version (int): Version the client was dispatched with.
+            base (NDArrays): Parameters of ``base_version``.
+            client (ClientProxy): The client.
+            fit_res (FitRes): Its result, whose tensors are released once buffered.
+
+        Returns:
+            bool: Whether the buffer is full and ``apply_updates`` should be called.
+        """
+        staleness = version - base_version
+        if self.max_staleness and staleness > self.max_staleness:
+            log(INFO, f"Dropping update of client {client.cid} with staleness {staleness}")
+            return False
+
+        weight = fit_res.num_examples * self.staleness_weight(staleness)
+        self._buffer.add(
+            (array - base_array for array, base_array in zip(decode_tensors(fit_res.parameters.tensors, base), base)),
+            weight
+        )
+        fit_res.parameters = Parameters(tensors=[], tensor_type=fit_res.parameters.tensor_type)
+        self._buffer_metrics.append((fit_res.num_examples, fit_res.metrics))
+        return self._buffer.count >= self.buffer_size
+
+    def apply_updates(self, current: NDArrays) -> Tuple[NDArrays, Dict[str, Scalar]]:
+        """Apply the buffered updates to the current global model and empty the buffer.
+
+        Returns:
+            Tuple[NDArrays, Dict[str, Scalar]]: The next global version and the aggregated fit metrics of its updates.
+        """
+        buffer, self._buffer = self._buffer, StreamingAggregator()
+        fit_metrics, self._buffer_metrics = self._buffer_metrics, []
+        if buffer.count == 0:
+            return current, {}
+
+        delta = buffer.result()
+        parameters = [(array + self.server_lr * step).astype(array.dtype) for array, step in zip(current, delta)]
+
+        metrics_aggregated = {}
+        if self.fit_metrics_aggregation_fn:
+            metrics_aggregated = self.fit_metrics_aggregation_fn(fit_metrics)
+        return parameters, metrics_aggregated
@@ -0,0 +1,38 @@
+"""Incremental aggregation of client updates."""
+from typing import Iterable, List
+import numpy as np
+from flwr.common.typing import NDArrays
+
+
+class StreamingAggregator:
+    """Running weighted average of model parameters, folded in one client (and one tensor) at a time.
+
+    Only the float64 running sum is kept, so memory stays at the size of one model whatever the number of clients.
+    """
+
+    def __init__(self) -> None:
+        self._sum: List[np.ndarray] = []
+        self._dtypes: List[np.dtype] = []
+        self.total_weight = 0.0
+        self.count = 0
+
+    def add(self, ndarrays: Iterable[np.ndarray], weight: float):
+        """Fold a client's parameters into the running sum.
+
+        Args:
+            ndarrays (Iterable[np.ndarray]): The parameters, may be a generator decoding one tensor at a time.
+            weight (float): Weight of the client, e.g. its number of examples.
+        """
+        first = self.count == 0
+        for i, array in enumerate(ndarrays):
+            if first:
+                self._sum.append(np.multiply(array, weight, dtype=np.float64))
+                self._dtypes.append(array.dtype)
+            else:
+                self._sum[i] += np.multiply(array, weight, dtype=np.float64)
+        self.total_weight += weight
+        self.count += 1
+
+    def result(self) -> NDArrays:
+        """Return the weighted average, in the dtype of the folded parameters."""
+        return [(total / self.total_weight).astype(dtype) for total, dtype in zip(self._sum, self._dtypes)]
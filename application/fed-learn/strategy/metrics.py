@@ -0,0 +1,79 @@
+"""Aggregation of the metrics reported by clients."""
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+from flwr.common.typing import Metrics
+
+# Statistics across clients that can be reported next to the weighted mean, "p<q>" is the q-th percentile
+STATS = ('min', 'max')
+
+
+class MetricsAggregator:
+    """Weighted mean of client metrics, optionally with their spread across clients.
+
+    The numeric metrics of every client are packed into one (clients, metrics) matrix whose column layout is kept
+    across calls, and averaged with a single dot product with the clients' numbers of examples. Clients missing a
+    metric are left out of that metric only. Each statistic of ``extra`` adds a ``<metric>_<stat>`` entry, e.g.
+    ``accuracy_min`` or ``loss_p90``.
+    """
+
+    def __init__(self, extra: Sequence[str] = ()):
+        """
+        Args:
+            extra (Sequence[str]): Statistics to report next to the mean, among ``STATS`` and "p<q>" percentiles.
+                Defaults to ().
+        """
+        for stat in extra:
+            if stat not in STATS and not (stat.startswith('p') and stat[1:].isdigit() and int(stat[1:]) <= 100):
+                raise ValueError(f"Unsupported metric statistic {stat}")
+        self.extra = list(extra)
+        self._percentiles = [int(stat[1:]) for stat in self.extra if stat not in STATS]
+        self._layout: Dict[str, int] = {}
+        self._matrix = np.empty((0, 0))
+
+    def __call__(self, results: List[Tuple[int, Metrics]]) -> Metrics:
+        """Aggregate (number of examples, metrics) pairs, the signature of flwr's metrics aggregation functions."""
+        if not results:
+            return {}
+        for _, metrics in results:
+            for key, value in metrics.items():
+                if key not in self._layout and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._layout[key] = len(self._layout)
+
+        # The matrix is only reallocated when the number of clients or metrics grows
+        shape = (len(results), len(self._layout))
+        if self._matrix.shape[0] < shape[0] or self._matrix.shape[1] < shape[1]:
+            self._matrix = np.empty((max(shape[0], self._matrix.shape[0]), max(shape[1], self._matrix.shape[1])))
+        matrix = self._matrix[:shape[0], :shape[1]]
+        matrix.fill(np.nan)
+        for row, (_, metrics) in enumerate(results):
+            for key, value in metrics.items():
+                col = self._layout.get(key)
+                if col is not None:
+                    matrix[row, col] = value
+
+        weights = np.array([num for num, _ in results], dtype=np.float64)
+        reported = ~np.isnan(matrix)
+        totals = weights @ reported
+        means = (weights @ np.where(reported, matrix, 0.0)) / np.where(totals > 0, totals, np.nan)
+
+        aggregated: Metrics = {}
+        present = reported.any(axis=0)
+        for key, col in self._layout.items():
+            if present[col]:
+                aggregated[key] = float(means[col])
+        if not self.extra:
+            return aggregated
+
+        stats = {}
+        if 'min' in self.extra:
+            stats['min'] = np.nanmin(matrix[:, present], axis=0)
+        if 'max' in self.extra:
+            stats['max'] = np.nanmax(matrix[:, present], axis=0)
+        if self._percentiles:
+            for q, values in zip(self._percentiles, np.nanpercentile(matrix[:, present], self._percentiles, axis=0)):
+                stats[f"p{q}"] = values
+        keys = [key for key, col in self._layout.items() if present[col]]
+        for stat in self.extra:
+            for key, value in zip(keys, stats[stat]):
+                aggregated[f"{key}_{stat}"] = float(value)
+        return aggregated
@@ -0,0 +1,88 @@
+"""Local content-addressed cache of checkpoints downloaded from or uploaded to IPFS."""
+import os
+import os.path as path
+import threading
+
+
+class CheckpointCache:
+    """Size-bounded cache of checkpoint blobs keyed by their IPFS CID and the hash of their parameters on the ledger.
+
+    Entries are plain files named after the CID and the hash. Their modification time is refreshed on every hit, so
+    eviction drops the least recently used entries first and the order survives restarts. A blob is only returned for
+    the hash it was cached with, and is verified against that hash when it is read, see
+    ``utils.saver.load_checkpoint``, which discards entries failing verification. Several processes may share the
+    directory.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        """
+        Args:
+            root (str): Directory holding the cached checkpoints.
+            max_bytes (int): Maximum total size of the cached checkpoints.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, cid: str, hash: str) -> str:
+        # Accept both bare CIDs and /ipfs/<cid> urls, versioned hashes such as "v2:<hex>" are kept as "v2-<hex>"
+        return path.join(self.root, f"{cid.rstrip('/').split('/')[-1]}.{hash.replace(':', '-')}")
+
+    def get(self, cid: str, hash: str) -> bytes | None:
+        """Return the blob cached for a CID and hash, or None on a miss."""
+        filepath = self._path(cid, hash)
+        with self._lock:
+            try:
+                with open(filepath, 'rb') as f:
+                    blob = f.read()
+            except FileNotFoundError:
+                return None
+            try:
+                os.utime(filepath)
+            except FileNotFoundError:
+                pass
+            return blob
+
+    def put(self, cid: str, hash: str, blob: bytes):
+        """Cache a blob whose parameters were verified against ``hash``, evicting the least recently used entries
+        beyond ``max_bytes``."""
+        if len(blob) > self.max_bytes:
+            return
+        filepath = self._path(cid, hash)
+        with self._lock:
+            tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp_path, filepath)
+            self._evict()
+
+    def discard(self, cid: str, hash: str):
+        """Remove an entry, e.g. one that failed verification."""
+        with self._lock:
+            try:
+                os.remove(self._path(cid, hash))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        # Other processes sharing the directory may remove entries between the listing and the removal
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,171 @@
+"""Compression of model updates sent by clients and of checkpoints stored on IPFS."""
+import json
+import math
+import threading
+from typing import Dict, Iterator, List
+import numpy as np
+from flwr.common.parameter import bytes_to_ndarray
+from flwr.common.typing import Config, NDArrays
+
+# Update compression schemes, negotiated through the "compression" key of the fit config
+SCHEMES = ('none', 'fp16', 'int8', 'topk')
+
+# Marks the header array leading an encoded update, model weights are never stored as uint8
+MAGIC = b'BFLC'
+FORMAT_VERSION = 1
+
+
+def fit_config(scheme: str = 'none', delta: bool = False, topk_ratio: float = 0.01) -> Config:
+    """Fit config entries asking clients to compress their update.
+
+    Args:
+        scheme (str): One of ``SCHEMES``. Defaults to 'none'.
+        delta (bool): Send the difference to the global model received for the round. Always the case for 'topk'.
+            Defaults to False.
+        topk_ratio (float): Fraction of the entries of each tensor kept by 'topk'. Defaults to 0.01.
+    """
+    if scheme not in SCHEMES:
+        raise ValueError(f"Unsupported compression scheme {scheme}, expected one of {SCHEMES}")
+    return {"compression": scheme, "delta": delta or scheme == 'topk', "topk_ratio": topk_ratio}
+
+
+class Compressor:
+    """Client-side encoder of model updates.
+
+    Lossy schemes applied to deltas keep the part of the update they did not send, and add it to the next update
+    (error feedback), so that no part of the update is lost over the rounds, only delayed.
+    """
+
+    def __init__(self) -> None:
+        self._residual: List[np.ndarray] = []
+
+    def encode(self, parameters: NDArrays, config: Config, base: NDArrays | None = None) -> NDArrays:
+        """Encode an update as requested by the fit config, see ``fit_config``.
+
+        Args:
+            parameters (NDArrays): The locally trained weights.
+            config (Config): The fit config.
+            base (NDArrays | None): The global weights received for the round, required for delta encoding.
+
+        Returns:
+            NDArrays: The header array followed by the encoded tensors.
+        """
+        scheme = config.get("compression", "none")
+        delta = bool(config.get("delta", False))
+        ratio = float(config.get("topk_ratio", 0.01))
+
+        header = {
+            "version": FORMAT_VERSION,
+            "scheme": scheme,
+            "delta": delta,
+            "dtypes": [array.dtype.str for array in parameters],
+        }
+        encoded = [np.frombuffer(MAGIC + json.dumps(header).encode(), dtype=np.uint8)]
+
+        feedback = delta and scheme != 'none'
+        if feedback and [r.shape for r in self._residual] != [p.shape for p in parameters]:
+            self._residual = [np.zeros(p.shape, dtype=np.float32) for p in parameters]
+
+        for i, array in enumerate(parameters):
+            x = np.subtract(array, base[i], dtype=np.float32) if delta else array
+            if feedback:
+                x = x + self._residual[i]
+            tensors = _encode_tensor(x, scheme, ratio)
+            if feedback:
+                self._residual[i] = x - _decode_tensor(tensors, scheme, x.shape)
+            encoded.extend(tensors)
+        return encoded
+
+
+def _encode_tensor(x: np.ndarray, scheme: str, ratio: float) -> NDArrays:
+    if scheme == 'none':
+        return [x]
+    if scheme == 'fp16':
+        return [x.astype(np.float16)]
+    if scheme == 'int8':
+        # Symmetric per-tensor quantization
+        scale = float(np.abs(x).max(initial=0.0)) / 127 or 1.0
+        return [np.array([scale], dtype=np.float32), np.clip(np.rint(x / scale), -127, 127).astype(np.int8)]
+    if scheme == 'topk':
+        flat = x.ravel()
+        k = max(1, math.ceil(ratio * flat.size))
+        indices = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:]
+        return [indices.astype(np.int32), flat[indices].astype(np.float32)]
+    raise ValueError(f"Unsupported compression scheme {scheme}")
+
+
+def _decode_tensor(tensors: NDArrays, scheme: str, shape: tuple) -> np.ndarray:
+    if scheme in ('none', 'fp16'):
+        return tensors[0].astype(np.float32)
+    if scheme == 'int8':
+        scale, values = tensors
+        return values.astype(np.float32) * scale[0]
+    if scheme == 'topk':
+        indices, values = tensors
+        x = np.zeros(math.prod(shape), dtype=np.float32)
+        x[indices] = values
+        return x.reshape(shape)
+    raise ValueError(f"Unsupported compression scheme {scheme}")
+
+
+_TENSORS_PER_ARRAY = {'none': 1, 'fp16': 1, 'int8': 2, 'topk': 2}
+
+
+def is_encoded(tensors: List[bytes]) -> bool:
+    """Whether serialised parameters start with the header of an encoded update."""
+    if not tensors:
+        return False
+    first = bytes_to_ndarray(tensors[0])
+    return first.dtype == np.uint8 and first.ndim == 1 and first[:len(MAGIC)].tobytes() == MAGIC
+
+
+def decode_tensors(tensors: List[bytes], base: NDArrays | None = None) -> Iterator[np.ndarray]:
+    """Lazily decode serialised parameters into full model weights, one tensor at a time.
+
+    Parameters that were not encoded are deserialised as they are.
+
+    Args:
+        tensors (List[bytes]): The serialised parameters, e.g. ``FitRes.parameters.tensors``.
+        base (NDArrays | None): The global weights the update was computed against, required for delta encoding.
+
+    Raises:
+        ValueError: If the update is a delta and no base is given, or its format is not supported.
+    """
+    if not is_encoded(tensors):
+        yield from (bytes_to_ndarray(tensor) for tensor in tensors)
+        return
+
+    header = json.loads(bytes_to_ndarray(tensors[0])[len(MAGIC):].tobytes())
+    if header["version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported update format version {header['version']}, expected {FORMAT_VERSION}")
+    scheme = header["scheme"]
+    if header["delta"] and base is None:
+        raise ValueError("Delta encoded update received without the global weights it is based on")
+
+    step = _TENSORS_PER_ARRAY[scheme]
+    for i, dtype in enumerate(header["dtypes"]):
+        start = 1 + i * step
+        group = [bytes_to_ndarray(tensor) for tensor in tensors[start:start + step]]
+        shape = base[i].shape if base is not None else group[-1].shape
+        x = _decode_tensor(group, scheme, shape)
+        if header["delta"]:
+            x += base[i]
+        yield x.astype(dtype, copy=False)
+
+
+def cast_floats(parameters: NDArrays, dtype: str) -> NDArrays:
+    """Cast the floating point tensors of a checkpoint, e.g. to float16 to halve its size on IPFS."""
+    return [array.astype(dtype, copy=False) if np.issubdtype(array.dtype, np.floating) else array for array in parameters]
+
+
+_compressors: Dict[str, Compressor] = {}
+_compressors_lock = threading.Lock()
+
+
+def get_compressor(cid: str) -> Compressor:
+    """Return the compressor of a client, kept for the whole process so that its error feedback survives clients
+    being recreated every round in simulation."""
+    with _compressors_lock:
+        if cid not in _compressors:
+            _compressors[cid] = Compressor()
+        return _compressors[cid]
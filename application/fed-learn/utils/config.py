@@ -4,7 +4,8 @@ from dotenv import load_dotenv, find_dotenv
 dotenv_path = find_dotenv('.env')
 found = load_dotenv(dotenv_path)
 
-if not found:
+# The settings may also come from the environment alone, e.g. when running the benchmarks
+if not found and 'NUM_CLIENTS' not in os.environ:
     print("Dotenv file cannot be found or loaded!")
     exit(1)
 
@@ -31,6 +32,85 @@ S_ADDR = f'{S_HOST}:{S_PORT}'
 NUM_CLIENTS = int(os.environ['NUM_CLIENTS'])
 NUM_ROUNDS = int(env_def('NUM_ROUNDS', 1))
 NUM_RUNS = int(env_def('NUM_RUNS', 10))
+# Worker processes hosting the virtual clients when WORK_ENV is SIM, 0 for one per CPU
+SIM_WORKERS = int(env_def('SIM_WORKERS', 0))
+
+# Partial rounds: fraction of the sampled clients that closes a round and seconds before a round closes with the
+# results received so far (0 = wait for every client)
+ROUND_QUORUM = float(env_def('ROUND_QUORUM', 1.0))
+ROUND_DEADLINE = float(env_def('ROUND_DEADLINE', 0))
+# Weight multiplier per round of staleness for results folded in after their round closed, 0 drops them
+STALENESS_ALPHA = float(env_def('STALENESS_ALPHA', 0.5))
+
+# SYNC runs lockstep rounds, ASYNC buffers client updates into new global versions (FedBuff)
+FL_MODE = env_def('FL_MODE', 'SYNC').upper()
+# Client updates per global version, step size of the averaged update and exponent of the staleness discount
+ASYNC_BUFFER_SIZE = int(env_def('ASYNC_BUFFER_SIZE', 2))
+ASYNC_SERVER_LR = float(env_def('ASYNC_SERVER_LR', 1.0))
+ASYNC_STALENESS_EXPONENT = float(env_def('ASYNC_STALENESS_EXPONENT', 0.5))
+# Updates staler than this many versions are dropped, 0 keeps every update
+ASYNC_MAX_STALENESS = int(env_def('ASYNC_MAX_STALENESS', 0))
+# Publish every n-th global version to IPFS and the ledger
+ASYNC_PUBLISH_EVERY = int(env_def('ASYNC_PUBLISH_EVERY', 1))
+# Clients whose fit failed are redispatched after this many seconds, doubled on every failure in a row, and dropped
+# after ASYNC_MAX_RETRIES failures in a row
+ASYNC_RETRY_BACKOFF = float(env_def('ASYNC_RETRY_BACKOFF', 1.0))
+ASYNC_MAX_RETRIES = int(env_def('ASYNC_MAX_RETRIES', 5))
+
+# Client update compression (none, fp16, int8 or topk), sent as the difference to the global model when UPDATE_DELTA
+# is set, which topk implies
+UPDATE_COMPRESSION = env_def('UPDATE_COMPRESSION', 'none').lower()
+UPDATE_DELTA = env_def('UPDATE_DELTA', 'false').lower() == 'true'
+TOPK_RATIO = float(env_def('TOPK_RATIO', 0.01))
+# Floating point precision of the checkpoints stored on IPFS, float16 halves their size
+CHECKPOINT_DTYPE = env_def('CHECKPOINT_DTYPE', 'float32')
+
+# Statistics of the client metrics reported next to their weighted mean, e.g. "min,max,p50"
+METRICS_EXTRA = [stat.strip() for stat in env_def('METRICS_EXTRA', '').split(',') if stat.strip()]
+
+# Evaluate global models on the server with a cached held-out sample of EVAL_HOLDOUT_SIZE rows, in the background
+# while the next round trains. Its metrics are then the ones posted to the ledger.
+CENTRAL_EVAL = env_def('CENTRAL_EVAL', 'false').lower() == 'true'
+EVAL_HOLDOUT_SIZE = int(env_def('EVAL_HOLDOUT_SIZE', 20_000))
+# Evaluate on the clients every n rounds and after the last one, 0 never does. Without CENTRAL_EVAL only these rounds
+# are posted to the ledger.
+DIST_EVAL_EVERY = int(env_def('DIST_EVAL_EVERY', 1))
+
+# Record timing spans of every phase, and export them as Chrome traces to PROFILE_DIR at the end if set
+PROFILE = env_def('PROFILE', 'true').lower() == 'true'
+PROFILE_DIR = env_def('PROFILE_DIR', '')
+
+# Rows per chunk when streaming datasets larger than memory, 0 loads the dataset in memory
+DATA_CHUNK_SIZE = int(env_def('DATA_CHUNK_SIZE', 0))
+# Keep the rows read from memory-mapped partitions in memory across rounds
+TF_DATA_CACHE = env_def('TF_DATA_CACHE', 'false').lower() == 'true'
+
+# Background checkpoint publishing: queued or running jobs before fit blocks (0 = unbounded) and attempts per job
+PUBLISH_MAX_PENDING = int(env_def('PUBLISH_MAX_PENDING', 0))
+PUBLISH_RETRIES = int(env_def('PUBLISH_RETRIES', 3))
+# Global rounds allowed in flight, including the one being published, before the server blocks the next round
+PUBLISH_MAX_ROUNDS = int(env_def('PUBLISH_MAX_ROUNDS', 2))
+# Also keep a compressed local copy of every published checkpoint
+KEEP_LOCAL_CHECKPOINTS = env_def('KEEP_LOCAL_CHECKPOINTS', 'false').lower() == 'true'
+
+# Local cache of checkpoints by IPFS CID and ledger hash, a size of 0 disables it
+CKPT_CACHE_DIR = env_def('CKPT_CACHE_DIR', os.path.abspath('model_ckpt/cache'))
+CKPT_CACHE_MAX_BYTES = int(env_def('CKPT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Send the global checkpoint a session resumes from to clients by CID and hash, read from their checkpoint cache
+FIT_BY_REFERENCE = env_def('FIT_BY_REFERENCE', 'true').lower() == 'true'
+
+# Inference service: address, batches of at most SERVE_MAX_BATCH rows waiting at most SERVE_MAX_WAIT_MS to fill,
+# seconds between polls of the ledger for a newer global model and score from which a flow is an attack
+SERVE_HOST = env_def('SERVE_HOST', '0.0.0.0')
+SERVE_PORT = int(env_def('SERVE_PORT', 8500))
+SERVE_MAX_BATCH = int(env_def('SERVE_MAX_BATCH', 64))
+SERVE_MAX_WAIT_MS = float(env_def('SERVE_MAX_WAIT_MS', 5))
+SERVE_POLL_INTERVAL = float(env_def('SERVE_POLL_INTERVAL', 30))
+SERVE_THRESHOLD = float(env_def('SERVE_THRESHOLD', 0.5))
+# Preprocessor file or /ipfs/<cid> path saved by the server, defaults to the one referenced by the global checkpoints
+SERVE_PREPROCESSOR = env_def('SERVE_PREPROCESSOR', '')
+# Client whose IPFS daemon and gateway the service uses
+SERVE_CLIENT_ID = env_def('SERVE_CLIENT_ID', '1')
 
 EXPRESS_HOST = env_def("EXPRESS_HOST", "0.0.0.0")
 EXPRESS_PORT = env_def("EXPRESS_PORT", 30027)
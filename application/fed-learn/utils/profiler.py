@@ -0,0 +1,105 @@
+"""Lightweight timing spans for the phases of a federated round."""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+class Profiler:
+    """Record named, timed spans from any thread of the process.
+
+    Spans are plain dicts with a name, a category, the wall-clock start in seconds, the duration in seconds, the
+    round if known and free-form arguments. Spans recorded without a round take the one set for the current thread
+    with ``in_round``, so that low-level phases such as hashing are attributed without threading the round through.
+    They can be exported in the Chrome trace format (chrome://tracing or Perfetto), where the spans of a process line
+    up by thread.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._spans: List[dict] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def in_round(self, server_round: int):
+        """Attribute the spans recorded by the current thread inside the block to a round."""
+        previous = getattr(self._local, "round", None)
+        self._local.round = server_round
+        try:
+            yield
+        finally:
+            self._local.round = previous
+
+    @contextmanager
+    def span(self, name: str, cat: str = "fl", server_round: int | None = None, **args):
+        """Time the enclosed block.
+
+        Args:
+            name (str): Phase name, e.g. "train" or "ipfs_add".
+            cat (str): Category, e.g. "client" or "server". Defaults to "fl".
+            server_round (int | None): Round the phase belongs to. Defaults to None.
+            **args: Extra values stored with the span, e.g. a client id or a number of bytes.
+
+        Yields:
+            dict: Holds the "duration" of the block in seconds once it exits, measured even when disabled.
+        """
+        timing = {}
+        start = time.time()
+        counter = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            timing["duration"] = time.perf_counter() - counter
+            self.add(name, start, timing["duration"], cat, server_round, **args)
+
+    def add(self, name: str, start: float, duration: float, cat: str = "fl", server_round: int | None = None, **args):
+        """Record a span timed by the caller."""
+        if not self.enabled:
+            return
+        if server_round is None:
+            server_round = getattr(self._local, "round", None)
+        span = {
+            "name": name, "cat": cat, "start": start, "duration": duration, "round": server_round,
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args,
+        }
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self) -> List[dict]:
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+    def summary(self, server_round: int | None = None) -> Dict[str, float]:
+        """Total duration in seconds of every phase, optionally restricted to one round."""
+        totals: Dict[str, float] = {}
+        for span in self.spans():
+            if server_round is None or span["round"] == server_round:
+                totals[span["name"]] = totals.get(span["name"], 0.0) + span["duration"]
+        return totals
+
+    def export_chrome_trace(self, filepath: str, spans: List[dict] | None = None):
+        """Write spans, by default the ones of this profiler, as a Chrome trace JSON file."""
+        events = []
+        for span in self.spans() if spans is None else spans:
+            args = dict(span["args"])
+            if span["round"] is not None:
+                args["round"] = span["round"]
+            events.append({
+                "name": span["name"], "cat": span["cat"], "ph": "X",
+                "ts": span["start"] * 1e6, "dur": span["duration"] * 1e6,
+                "pid": span["pid"], "tid": span["tid"], "args": args,
+            })
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        with open(filepath, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# Shared by every module of the process, enabled according to PROFILE by the client and server entry points
+profiler = Profiler()
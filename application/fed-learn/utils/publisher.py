@@ -0,0 +1,170 @@
+"""Background publishing of checkpoints to IPFS and the ledger."""
+import atexit
+import queue
+import threading
+import time
+from logging import ERROR, INFO, WARNING
+from typing import Any, Callable, List, Tuple
+
+from flwr.common.logger import log
+
+
+class Publisher:
+    """Run publishing jobs, e.g. an IPFS upload followed by a ledger transaction, in order on a background thread.
+
+    A job is made of one or more steps. A step failing with an exception is retried with exponential backoff, without
+    running the steps before it again, so a failed ledger transaction does not upload its checkpoint again. Jobs
+    submitted with the same ``batch`` function that are queued together share a single call of it, e.g. one ledger
+    request for a backlog of checkpoints. Failures that are not retried (such as the gateway error handler aborting
+    the session) or that exhaust their retries are raised again by ``flush``, which is the point where the caller
+    gets durability.
+    """
+
+    def __init__(self, name: str = "publisher", max_pending: int = 0, retries: int = 3, backoff: float = 1.0,
+                 max_batch: int = 32):
+        """
+        Args:
+            name (str): Name of the worker thread. Defaults to "publisher".
+            max_pending (int): Maximum number of jobs queued or running before ``submit`` blocks, 0 for unbounded.
+                Defaults to 0.
+            retries (int): Attempts per step. Defaults to 3.
+            backoff (float): Delay in seconds before the first retry, doubled on every retry. Defaults to 1.0.
+            max_batch (int): Maximum number of jobs sharing a call of their batch function. Defaults to 32.
+        """
+        self.retries = max(1, retries)
+        self.backoff = backoff
+        self.max_batch = max(1, max_batch)
+        self._queue: queue.Queue = queue.Queue()
+        # The job being run still holds its slot, a bounded queue alone would allow max_pending + 1 jobs in flight
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        # A job taken from the queue while collecting a batch it does not belong to, run next
+        self._next = None
+        self._errors: List[Tuple[str, BaseException]] = []
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, *steps: Callable[..., Any], description: str = "job",
+               batch: Callable[[List[Any]], Any] | None = None):
+        """Queue a job, blocking while ``max_pending`` jobs are already queued or running.
+
+        Args:
+            steps (Callable[..., Any]): Run in order, every step but the first with the result of the previous one.
+            description (str): Name of the job in logs and errors. Defaults to "job".
+            batch (Callable[[List[Any]], Any] | None): Final step called with the results of the last step of this
+                job and of the following queued jobs submitted with the same function. Defaults to None.
+        """
+        if self._slots is not None:
+            self._slots.acquire()
+        self._queue.put((steps, description, batch))
+
+    @property
+    def pending(self) -> int:
+        return self._queue.unfinished_tasks
+
+    def flush(self):
+        """Wait until every queued job has finished and raise the first failure, if any."""
+        self._queue.join()
+        if not self._errors:
+            return
+        description, err = self._errors[0]
+        self._errors.clear()
+        if isinstance(err, Exception):
+            raise RuntimeError(f"Publishing {description} failed") from err
+        raise err
+
+    def close(self):
+        """Flush and stop the worker thread."""
+        try:
+            self.flush()
+        finally:
+            self._queue.put((None, None, None))
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self._next or self._queue.get()
+            self._next = None
+            if job[0] is None:
+                self._queue.task_done()
+                return
+            jobs = self._collect(job)
+            try:
+                results = []
+                for steps, description, _ in jobs:
+                    ok, result = self._run_steps(steps, description)
+                    if ok:
+                        results.append(result)
+                batch = job[2]
+                if batch is not None and results:
+                    self._attempt(batch, (results,), ", ".join(description for _, description, _ in jobs))
+            finally:
+                for _ in jobs:
+                    self._queue.task_done()
+                    if self._slots is not None:
+                        self._slots.release()
+
+    def _collect(self, job: tuple) -> List[tuple]:
+        """Take the queued jobs sharing the batch function of ``job``, in order."""
+        jobs = [job]
+        if job[2] is None:
+            return jobs
+        while len(jobs) < self.max_batch:
+            try:
+                other = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if other[2] != job[2]:
+                self._next = other
+                break
+            jobs.append(other)
+        return jobs
+
+    def _run_steps(self, steps: Tuple[Callable[..., Any], ...], description: str) -> Tuple[bool, Any]:
+        result = None
+        args = ()
+        for step in steps:
+            ok, result = self._attempt(step, args, description)
+            if not ok:
+                return False, None
+            args = (result,)
+        return True, result
+
+    def _attempt(self, step: Callable[..., Any], args: tuple, description: str) -> Tuple[bool, Any]:
+        for attempt in range(1, self.retries + 1):
+            try:
+                return True, step(*args)
+            except Exception as err:
+                if attempt == self.retries:
+                    log(ERROR, f"Publishing {description} failed after {attempt} attempts: {err}")
+                    self._errors.append((description, err))
+                    return False, None
+                delay = self.backoff * 2 ** (attempt - 1)
+                log(WARNING, f"Publishing {description} failed ({err}), retrying in {delay}s")
+                time.sleep(delay)
+            except BaseException as err:
+                # Raised on purpose, e.g. exit() from the gateway error handler, never retried
+                self._errors.append((description, err))
+                return False, None
+
+
+_publisher: Publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher(max_pending: int = 0, retries: int = 3) -> Publisher:
+    """Return the publisher shared by every client of this process, flushed when the process exits."""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher("client-publisher", max_pending=max_pending, retries=retries)
+            atexit.register(_flush_at_exit)
+        return _publisher
+
+
+def _flush_at_exit():
+    if _publisher.pending:
+        log(INFO, f"Waiting for {_publisher.pending} pending publishing jobs")
+    try:
+        _publisher.flush()
+    except BaseException as err:
+        log(ERROR, f"Publishing failed on exit: {err}")
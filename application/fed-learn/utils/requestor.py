@@ -1,39 +1,138 @@
 import requests
 import math
+import threading
+from typing import List
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.profiler import profiler
 
-def post_model(req_url: str, id: str, hash: str, url: str, algorithm: str, accuracy: float, loss: float, fed_round: int, fed_session: int, channel_name: str, chaincode_name: str, contract_name: str, client: str):
-    
+# (connect, read) timeouts in seconds, a ledger transaction only returns once it is committed
+TIMEOUT = (5, 120)
+
+_local = threading.local()
+
+def get_session() -> requests.Session:
+    """Return this thread's keep-alive session to the gateway.
+
+    Connection failures are retried with exponential backoff for every request. Gateway errors (502-504) are only
+    retried for queries, since retrying a transaction could create the same checkpoint twice.
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET']))
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_maxsize=4, max_retries=retry))
+        session.headers.update({'content-type': 'application/json'})
+        _local.session = session
+    return session
+
+def checkpoint_data(id: str, hash: str, url: str, algorithm: str, accuracy: float, loss: float, fed_round: int, fed_session: int):
+    """Build the checkpoint record expected by the gateway."""
+    return {
+        "id": id,
+        "hash": hash,
+        "url": url,
+        "algorithm": algorithm,
+        "cAccuracy": round(accuracy, 6) * 100,
+        "loss": round(loss, 6),
+        "round": fed_round,
+        "fedSession": fed_session,
+    }
+
+def post_model(req_url: str, id: str, hash: str, url: str, algorithm: str, accuracy: float, loss: float, fed_round: int, fed_session: int, channel_name: str, chaincode_name: str, contract_name: str, client: str, query_url: str = None):
+    """Post a checkpoint record to the ledger.
+
+    A retried transaction whose first response was lost is rejected because its checkpoint already exists. When
+    ``query_url`` is given, such a rejection counts as success if the existing checkpoint has the same hash.
+    """
     data = {
         "channelName": channel_name,
         "chaincodeName": chaincode_name,
         "contractName": contract_name,
         "clientName": client,
-        "checkpointData": {
-            "id": id,
-            "hash": hash,
-            "url": url,
-            "algorithm": algorithm,
-            "cAccuracy": round(accuracy, 6) * 100,
-            "loss": round(loss, 6),
-            "round": fed_round,
-            "fedSession": fed_session,
-        },
+        "checkpointData": checkpoint_data(id, hash, url, algorithm, accuracy, loss, fed_round, fed_session),
     }
 
     print(f"Posting model: {data}")
 
-    resp = requests.post(
-        url=req_url,
-        headers={'content-type': 'application/json'},
-        json=data
-    )
+    with profiler.span("ledger_post", cat="ledger", id=id):
+        resp = get_session().post(url=req_url, json=data, timeout=TIMEOUT)
+
+    content = resp.json()
+    if query_url and is_conflict(resp.status_code, content) and is_created(query_url, id, hash, channel_name, chaincode_name, contract_name, client):
+        print(f"Model {id} already exists with the same hash")
+        return f"Model {id} already created at {contract_name}"
+    return response_handler(dict(status_code=resp.status_code, content=content), fed_session)
+
+def is_conflict(status_code: int, content: dict) -> bool:
+    """Whether the gateway rejected a transaction because its checkpoint already exists."""
+    if status_code == 409:
+        return True
+    if 200 <= status_code <= 210:
+        return False
+    return "CP409" in f"{content.get('reason', '')} {content.get('details', '')}"
+
+def is_created(query_url: str, id: str, hash: str, channel_name: str, chaincode_name: str, contract_name: str, client: str) -> bool:
+    """Whether the checkpoint ``id`` is on the ledger with the given hash."""
+    checkpoint = query_model(f"{query_url}{id}", channel_name, chaincode_name, contract_name, client)
+    return bool(checkpoint) and checkpoint.get("Hash") == hash
+
+def post_models(req_url: str, checkpoints: List[dict], fed_session: int, channel_name: str, chaincode_name: str, contract_name: str, client: str, query_url: str = None):
+    """Post several checkpoint records in one request, e.g. a backlog built up while the gateway was unreachable.
+
+    The gateway (``/transactions/checkpoint/createBatch``) submits them in order over a single ledger connection
+    and stops at the first rejected checkpoint. When ``query_url`` is given and a checkpoint already exists, the
+    ones found on the ledger with the same hash are dropped and the rest posted again, as for ``post_model``.
+
+    Args:
+        req_url (str): URL of the batch endpoint.
+        checkpoints (List[dict]): Records built with ``checkpoint_data``.
+        fed_session (int): The current federated learning session number.
+        channel_name (str): Channel of the checkpoints chaincode.
+        chaincode_name (str): Name of the checkpoints chaincode.
+        contract_name (str): Contract to submit to.
+        client (str): Identity submitting the transactions.
+        query_url (str): URL prefix of checkpoint queries. Defaults to None.
+
+    Returns:
+        Result (json): One result message per created checkpoint.
+    """
+    existing = []
+    while True:
+        data = {
+            "channelName": channel_name,
+            "chaincodeName": chaincode_name,
+            "contractName": contract_name,
+            "clientName": client,
+            "checkpoints": checkpoints,
+        }
+
+        print(f"Posting {len(checkpoints)} models: {[checkpoint['id'] for checkpoint in checkpoints]}")
+
+        with profiler.span("ledger_post", cat="ledger", count=len(checkpoints)):
+            resp = get_session().post(url=req_url, json=data, timeout=(TIMEOUT[0], TIMEOUT[1] * max(1, len(checkpoints))))
 
-    return response_handler(dict(status_code=resp.status_code, content=resp.json()), fed_session)
+        content = resp.json()
+        if not (query_url and is_conflict(resp.status_code, content)):
+            return existing + response_handler(dict(status_code=resp.status_code, content=content), fed_session)
+        remaining = []
+        for checkpoint in checkpoints:
+            if is_created(query_url, checkpoint["id"], checkpoint["hash"], channel_name, chaincode_name, contract_name, client):
+                existing.append(f"Model {checkpoint['id']} already created at {contract_name}")
+            else:
+                remaining.append(checkpoint)
+        if len(remaining) == len(checkpoints):
+            # Conflicting with a checkpoint of another hash
+            return response_handler(dict(status_code=resp.status_code, content=content), fed_session)
+        if not remaining:
+            return existing
+        checkpoints = remaining
 
 def query_model(req_url, channelName, chaincodeName, contractName, client):
     try:
-        resp = requests.get(
+        resp = get_session().get(
             url=req_url,
+            timeout=TIMEOUT,
             params={
                 'chn': channelName,
                 'ccn': chaincodeName,
@@ -70,7 +169,7 @@ def error_handler(err, fed_session=None):
     exit(1)
 
 def is_node_running(req_url):
-    return (requests.get(req_url)).status_code == requests.codes.ok
+    return (get_session().get(req_url, timeout=TIMEOUT)).status_code == requests.codes.ok
 
 def response_handler(response, fed_session=None):
     """Handle response sent from NodeJS gateway
@@ -1,30 +1,203 @@
 import hashlib as hl
+import json
+import os
+import tempfile
+from io import BytesIO
+import numpy as np
 import ipfshttpclient2 as ipfshttpclient
-from flwr.common.typing import Parameters
-from flwr.common.parameter import ndarrays_to_parameters, ndarray_to_bytes
+from flwr.common.typing import Parameters, NDArrays
+from typing import List, Tuple
+from flwr.common.parameter import ndarrays_to_parameters, ndarray_to_bytes, parameters_to_ndarrays
 from keras import Sequential
+from flwr.common.logger import log
+from logging import WARNING
+from utils.ckptcache import CheckpointCache
+from utils.profiler import profiler
+
+# Local zip header, the npz checkpoint format
+NPZ_MAGIC = b'PK\x03\x04'
+# Entry of the npz blob holding the JSON metadata of a checkpoint, e.g. the preprocessor it was trained with
+METADATA_KEY = 'metadata'
+
+# Version of the hashes posted to the ledger. Version 1 hashes are plain hex digests of the concatenated
+# np.save serialisation, later versions are prefixed with "v<version>:".
+HASH_VERSION = 2
 
 def to_param_bytes(parameters) -> Parameters:
     parameters = ndarrays_to_parameters(parameters)
     return b''.join(parameters.tensors)
 
-def hash_params(parameters):
-    if isinstance(parameters, list):
-        parameters = ndarrays_to_parameters(parameters)
-    return hl.sha256(b''.join(parameters.tensors)).hexdigest()
+def hash_params(parameters: NDArrays | Parameters, version: int = HASH_VERSION) -> str:
+    """Hash model parameters in a single pass over the tensors.
+
+    Args:
+        parameters (NDArrays | Parameters): The model weights.
+        version (int): Hash format version, see ``HASH_VERSION``. Defaults to HASH_VERSION.
+
+    Returns:
+        str: The versioned hash.
+    """
+    with profiler.span("hash", cat="checkpoint", version=version):
+        return _hash_params(parameters, version)
+
+
+def _hash_params(parameters: NDArrays | Parameters, version: int) -> str:
+    if version == 1:
+        digest = hl.sha256()
+        tensors = parameters.tensors if isinstance(parameters, Parameters) else map(ndarray_to_bytes, parameters)
+        for tensor in tensors:
+            digest.update(tensor)
+        return digest.hexdigest()
+    if version == 2:
+        return hash_tree(parameters)[0]
+    raise ValueError(f"Unsupported hash version {version}")
 
-def save_params(filepath: str, ipfs_client: ipfshttpclient.client.Client, model: Sequential) -> str:
-    """Save a model parameters to ipfs and return corresponding CID hash value.
+
+def hash_tree(parameters: NDArrays | Parameters) -> Tuple[str, List[str]]:
+    """Hash model parameters as a Merkle tree with one leaf per tensor (hash version 2).
+
+    Each leaf hashes the dtype and shape of a tensor followed by its raw buffer, fed to the digest without copying.
+    The root hashes the concatenated leaf digests, so single layers can be verified or deduplicated by their leaf.
+
+    Returns:
+        Tuple[str, List[str]]: The versioned root hash and the hex digest of every tensor.
+    """
+    if isinstance(parameters, Parameters):
+        parameters = parameters_to_ndarrays(parameters)
+
+    root = hl.sha256(b'v2')
+    leaves = []
+    for array in parameters:
+        array = np.ascontiguousarray(array)
+        leaf = hl.sha256(f"{array.dtype.str}{array.shape}".encode())
+        leaf.update(array)
+        root.update(leaf.digest())
+        leaves.append(leaf.hexdigest())
+    return f"v2:{root.hexdigest()}", leaves
+
+
+def verify_hash(parameters: NDArrays | Parameters, expected: str) -> bool:
+    """Check parameters against a hash of any version, e.g. the one stored on the ledger."""
+    version = int(expected[1:expected.index(':')]) if expected.startswith('v') and ':' in expected else 1
+    return hash_params(parameters, version) == expected
+
+def params_to_bytes(parameters: NDArrays, compressed: bool = False, metadata: dict | None = None) -> bytes:
+    """Serialise model parameters to an in-memory npz blob.
+
+    Args:
+        parameters (NDArrays): The model weights.
+        compressed (bool): Deflate the blob, smaller but slower to produce. Defaults to False.
+        metadata (dict | None): JSON serialisable metadata stored next to the weights. Defaults to None.
+
+    Returns:
+        bytes: The npz blob.
+    """
+    buffer = BytesIO()
+    extra = {METADATA_KEY: np.frombuffer(json.dumps(metadata).encode(), dtype=np.uint8)} if metadata else {}
+    (np.savez_compressed if compressed else np.savez)(buffer, *parameters, **extra)
+    return buffer.getvalue()
+
+
+def bytes_to_params(blob: bytes) -> NDArrays:
+    """Deserialise model parameters from an npz blob produced by ``params_to_bytes``."""
+    with np.load(BytesIO(blob), allow_pickle=False) as data:
+        return [data[f"arr_{i}"] for i in range(sum(name.startswith("arr_") for name in data.files))]
+
+
+def bytes_to_metadata(blob: bytes) -> dict:
+    """Read the metadata of an npz blob produced by ``params_to_bytes``, empty if it has none."""
+    if blob[:len(NPZ_MAGIC)] != NPZ_MAGIC:
+        return {}
+    with np.load(BytesIO(blob), allow_pickle=False) as data:
+        return json.loads(data[METADATA_KEY].tobytes()) if METADATA_KEY in data.files else {}
+
+
+def save_params(ipfs_client: ipfshttpclient.client.Client, parameters: NDArrays, filepath: str | None = None,
+                cache: CheckpointCache | None = None, metadata: dict | None = None, hash: str | None = None) -> str:
+    """Save model parameters to ipfs and return corresponding CID hash value.
+
+    The parameters are streamed to ipfs from memory, without a filesystem round-trip.
 
     Args:
-        filepath (str): The filepath to save the aggregated parameters locally.
         ipfs_client (ipfshttpclient.client.Client): The ipfs client to perform ipfs operation on behalf of a participant.
-        model (Sequential): The model with the aggregated parameters set as its weights.
+        parameters (NDArrays): The model weights.
+        filepath (str | None): Also keep a compressed local copy at this path. Defaults to None.
+        cache (CheckpointCache | None): Local checkpoint cache to add the uploaded blob to. Defaults to None.
+        metadata (dict | None): Metadata saved with the parameters, read back by ``load_checkpoint``. Defaults to None.
+        hash (str | None): Hash of the parameters keying the cache entry, computed if it is missing. Defaults to None.
 
     Returns:
         str: CID which is a hash of the parameter stored on the private IPFS. 
     """
-    
-    model.save_weights(filepath=filepath)   
-    result_dict = ipfs_client.add(filepath) 
-    return result_dict['Hash'] 
\ No newline at end of file
+    if filepath is not None:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as f:
+            f.write(params_to_bytes(parameters, compressed=True, metadata=metadata))
+    with profiler.span("serialize", cat="checkpoint"):
+        blob = params_to_bytes(parameters, metadata=metadata)
+    with profiler.span("ipfs_add", cat="ipfs", bytes=len(blob)):
+        cid = ipfs_client.add_bytes(blob)
+    if cache is not None:
+        cache.put(cid, hash or hash_params(parameters), blob)
+    return cid
+
+
+def load_params(ipfs_client: ipfshttpclient.client.Client, url: str, model: Sequential | None = None,
+                expected_hash: str | None = None, cache: CheckpointCache | None = None) -> NDArrays:
+    """Load model parameters from the local checkpoint cache or ipfs, see ``load_checkpoint``."""
+    return load_checkpoint(ipfs_client, url, model, expected_hash, cache)[0]
+
+
+def load_checkpoint(ipfs_client: ipfshttpclient.client.Client, url: str, model: Sequential | None = None,
+                    expected_hash: str | None = None, cache: CheckpointCache | None = None) -> Tuple[NDArrays, dict]:
+    """Load model parameters and their metadata from the local checkpoint cache or ipfs.
+
+    Args:
+        ipfs_client (ipfshttpclient.client.Client): The ipfs client to perform ipfs operation on behalf of a participant.
+        url (str): The ipfs path or CID of the parameters.
+        model (Sequential | None): Model used to read checkpoints saved in the former Keras weights format.
+        expected_hash (str | None): Hash stored on the ledger to verify the parameters against. Defaults to None.
+        cache (CheckpointCache | None): Local checkpoint cache to read from and fill, only used along with
+            ``expected_hash``. Defaults to None.
+
+    Raises:
+        ValueError: If the parameters downloaded from ipfs do not match ``expected_hash``.
+
+    Returns:
+        Tuple[NDArrays, dict]: The model weights and the metadata saved with them, empty if there is none.
+    """
+    # Entries are keyed by the ledger hash as well and verified against it on every read
+    if expected_hash is None:
+        cache = None
+    blob = cache.get(url, expected_hash) if cache is not None else None
+    if blob is not None:
+        parameters = _decode(blob, model)
+        if verify_hash(parameters, expected_hash):
+            return parameters, bytes_to_metadata(blob)
+        log(WARNING, f"Cached checkpoint {url} does not match hash {expected_hash}, downloading it again")
+        cache.discard(url, expected_hash)
+
+    with profiler.span("ipfs_cat", cat="ipfs", url=url):
+        blob = ipfs_client.cat(url)
+    with profiler.span("deserialize", cat="checkpoint", bytes=len(blob)):
+        parameters = _decode(blob, model)
+    if expected_hash is not None and not verify_hash(parameters, expected_hash):
+        raise ValueError(f"Checkpoint {url} does not match hash {expected_hash}")
+    if cache is not None:
+        cache.put(url, expected_hash, blob)
+    return parameters, bytes_to_metadata(blob)
+
+
+def _decode(blob: bytes, model: Sequential | None) -> NDArrays:
+    if blob[:len(NPZ_MAGIC)] == NPZ_MAGIC or model is None:
+        return bytes_to_params(blob)
+
+    # Checkpoints published before the npz format are Keras weight files, which can only be loaded from disk
+    fd, filepath = tempfile.mkstemp(suffix='.keras')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        model.load_weights(filepath)
+        return model.get_weights()
+    finally:
+        os.remove(filepath)